@@ -42,6 +42,10 @@ License: This code is distributed under the MIT License.
         CLIP_TO_ROI: (Optional) Clip the processed image to the region of interest.
         SAVE_ASSETS : (Optional) Exports the processed collection to an asset.
         ASSET_ID : (Optional) The user id path to save the assets
+        EXPORT_MANIFEST : (Optional) Path of the local JSON record of the export tasks, so exported or running assets are skipped on reruns
+        EXPORT_WORKERS : (Optional) Number of export tasks submitted at once
+        EXPORT_WAIT : (Optional) Wait for the export tasks to finish, resubmitting failed tasks
+        EXPORT_RETRIES : (Optional) Number of times a failed export task is resubmitted
         
     Returns:
         An ee.ImageCollection with an analysis ready Sentinel 1 imagery with the specified polarization images and angle band.
@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Version: v1.0
+Date: 2026-10-17
+Description: Local (NumPy over xarray / dask) versions of the mono-temporal and multi-temporal
+             speckle filters in speckle_filter.py, for Sentinel-1 backscatter loaded from a datacube
+             rather than GEE.
+
+The filters take an xr.Dataset of linear backscatter bands (e.g. VV, VH and angle, the angle band
+is left unfiltered) or an xr.DataArray, with y and x as the last two dimensions. Any leading
+dimensions (e.g. time) are filtered image by image, so a whole stack is filtered in one call.
+Dask backed arrays are filtered a chunk at a time, with chunks overlapping by the radius of the
+filter.
+
+Neighbourhood statistics are computed with integral images (summed area tables), so their cost
+doesn't depend on the kernel size. The Refined Lee filter picks one of 8 directional kernels for
+each pixel, and only that kernel is summed (in a numba loop). As Earth Engine, pixels outside the
+image or masked (NaN) are left out of the neighbourhood statistics, variances are population
+variances and divisions by zero give zero.
+"""
+import collections
+import math
+
+import dask.array as da
+import numba
+import numpy as np
+import xarray as xr
+
+# S1-GRD images are multilooked 5 times in range
+ENL = 5
+
+# Lookup table (J.S.Lee et al 2009) for range and eta values for intensity (only 4 look is shown here)
+LEE_SIGMA_LUT = {
+    0.5: {'I1': 0.694, 'I2': 1.385, 'eta': 0.1921},
+    0.6: {'I1': 0.630, 'I2': 1.495, 'eta': 0.2348},
+    0.7: {'I1': 0.560, 'I2': 1.627, 'eta': 0.2825},
+    0.8: {'I1': 0.480, 'I2': 1.804, 'eta': 0.3354},
+    0.9: {'I1': 0.378, 'I2': 2.094, 'eta': 0.3991},
+    0.95: {'I1': 0.302, 'I2': 2.360, 'eta': 0.4391},
+}
+
+# Radius of the Refined Lee filter (7x7 directional kernels)
+REFINED_LEE_RADIUS = 3
+
+# ---------------------------------------------------------------------------//
+# 1. NEIGHBOURHOOD STATISTICS
+# ---------------------------------------------------------------------------//
+
+def _divide(numerator, denominator):
+    """
+    Divide as ee.Image.divide, giving 0 where the denominator is 0 (and NaN where the numerator
+    is NaN, as masked pixels stay masked).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator == 0, numerator * 0.0, numerator / denominator)
+
+
+def _pad(array, radius, value=0.0):
+    """
+    Pad the last two (y, x) dimensions of an array.
+    """
+    pad_width = [(0, 0)] * (array.ndim - 2) + [(radius, radius)] * 2
+    return np.pad(array, pad_width, constant_values=value)
+
+
+def _valid_moments(image):
+    """
+    Count, values and squared values of the valid (not NaN) pixels of an image, as float64 to
+    keep the precision of cumulative sums.
+    """
+    valid = np.isfinite(image)
+    values = np.where(valid, image, 0.0).astype(np.float64)
+    return valid.astype(np.float64), values, values * values
+
+
+def _mean_variance(count, total, total_sq):
+    """
+    Mean and (population) variance from sums over a neighbourhood, NaN without valid pixels.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        variance = np.maximum(total_sq / count - mean * mean, 0.0)
+    return mean, variance
+
+
+def _box_sum(array, radius):
+    """
+    Sum over a square (2 * radius + 1) window around each pixel, from the integral image.
+    """
+    size = 2 * radius + 1
+    padded = _pad(array, radius)
+    integral = np.zeros(padded.shape[:-2] + (padded.shape[-2] + 1, padded.shape[-1] + 1))
+    integral[..., 1:, 1:] = padded.cumsum(axis=-2).cumsum(axis=-1)
+    return (integral[..., size:, size:] - integral[..., :-size, size:]
+            - integral[..., size:, :-size] + integral[..., :-size, :-size])
+
+
+def box_stats(image, kernel_size):
+    """
+    Neighbourhood mean and variance over a square window.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Image(s) with y and x as the last two dimensions, NaN where masked
+    kernel_size : positive odd integer
+        Neighbourhood window size
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Mean and variance
+
+    """
+    radius = kernel_size // 2
+    return _mean_variance(*(_box_sum(moment, radius) for moment in _valid_moments(image)))
+
+
+@numba.njit(nogil=True, cache=True)
+def _directional_stats(image, directions, kernels):
+    """
+    Mean and (population) variance of each pixel of (n, y, x) images over the boolean kernel of
+    its direction (1 to the number of kernels), NaN for other directions. The kernels differ
+    between pixels, so these are summed pixel by pixel rather than from integral images.
+    """
+    n, height, width = image.shape
+    radius = kernels.shape[1] // 2
+    mean = np.full(image.shape, np.nan)
+    variance = np.full(image.shape, np.nan)
+    for k in range(n):
+        for y in range(height):
+            for x in range(width):
+                direction = directions[k, y, x]
+                if direction < 1 or direction > kernels.shape[0]:
+                    continue
+                kernel = kernels[direction - 1]
+                count = 0
+                total = 0.0
+                total_sq = 0.0
+                for i in range(max(0, radius - y), min(2 * radius + 1, height - y + radius)):
+                    for j in range(max(0, radius - x), min(2 * radius + 1, width - x + radius)):
+                        value = image[k, y + i - radius, x + j - radius]
+                        if kernel[i, j] and not np.isnan(value):
+                            count += 1
+                            total += value
+                            total_sq += value * value
+                if count > 0:
+                    mean[k, y, x] = total / count
+                    variance[k, y, x] = max(total_sq / count - mean[k, y, x] ** 2, 0.0)
+    return mean, variance
+
+
+def _shift(image, dy, dx):
+    """
+    Value of the pixel at an offset (dy, dx) from each pixel, NaN outside the image.
+    """
+    radius = max(abs(dy), abs(dx))
+    height, width = image.shape[-2:]
+    padded = _pad(image, radius, np.nan)
+    return padded[..., radius + dy:radius + dy + height, radius + dx:radius + dx + width]
+
+# ---------------------------------------------------------------------------//
+# 2. SPECKLE FILTERS (ARRAYS)
+# ---------------------------------------------------------------------------//
+
+def _boxcar(image, kernel_size):
+    mean, _ = box_stats(image, kernel_size)
+    return np.where(np.isfinite(image), mean, np.nan)
+
+
+def _mmse(image, z_bar, varz, eta):
+    """
+    MMSE estimate from the neighbourhood mean and variance, with negative weights set to zero
+    """
+    varx = (varz - z_bar ** 2 * eta ** 2) / (1 + eta ** 2)
+    b = _divide(varx, varz)
+    b = np.where(b < 0, 0.0, b)
+    return (1 - b) * np.abs(z_bar) + b * image
+
+
+def _leefilter(image, kernel_size, enl=ENL):
+    z_bar, varz = box_stats(image, kernel_size)
+    return _mmse(image, z_bar, varz, 1.0 / math.sqrt(enl))
+
+
+def _gammamap(image, kernel_size, enl=ENL):
+    z, varz = box_stats(image, kernel_size)
+    # local observed coefficient of variation
+    ci = _divide(np.sqrt(varz), z)
+    # noise coefficient of variation (or noise sigma)
+    cu = 1.0 / math.sqrt(enl)
+    # threshold for the observed coefficient of variation
+    cmax = math.sqrt(2.0) * cu
+
+    alpha = _divide(1 + cu ** 2, ci ** 2 - cu ** 2)
+    # equation 11 in Lopez et al. 1990
+    q = z ** 2 * (z * alpha - enl - 1) ** 2 + 4 * alpha * enl * image * z
+    with np.errstate(invalid='ignore'):
+        r_hat = _divide(z * (alpha - enl - 1) + np.sqrt(q), 2 * alpha)
+
+    # homogenous (boxcar), textured (Gamma MAP) or strong signal (retained), masked where the
+    # image is masked
+    filtered = np.select([ci <= cu, ci < cmax], [z, r_hat], image)
+    return np.where(np.isnan(image), np.nan, filtered)
+
+
+def _refined_lee_kernels():
+    """
+    The 7x7 directional kernels of the Refined Lee filter, in the order of the directions 1-8
+    """
+    rect = np.zeros((7, 7), dtype=bool)
+    rect[3:] = True
+    diag = np.tril(np.ones((7, 7), dtype=bool))
+    kernels = [rect, diag]
+    for i in range(1, 4):
+        # ee.Kernel.rotate turns clockwise
+        kernels += [np.rot90(rect, -i), np.rot90(diag, -i)]
+    return kernels
+
+
+def _refined_lee(image):
+    mean3, variance3 = box_stats(image, 3)
+    # the windows of masked pixels (and pixels outside the image) are masked
+    masked = np.isnan(image)
+    mean3[masked] = np.nan
+    variance3[masked] = np.nan
+
+    # the 3x3 windows centred on a 3x3 grid (2 pixels apart) inside the 7x7 window, north to
+    # south and west to east, as neighborhoodToBands
+    offsets = [(dy, dx) for dy in (-2, 0, 2) for dx in (-2, 0, 2)]
+    sample_mean = np.stack([_shift(mean3, dy, dx) for dy, dx in offsets])
+    sample_var = np.stack([_shift(variance3, dy, dx) for dy, dx in offsets])
+
+    # the 4 gradients across the sampled windows, and their directions
+    pairs = [(1, 7), (6, 2), (3, 5), (0, 8)]
+    centre = sample_mean[4]
+    with np.errstate(invalid='ignore'):
+        gradients = np.stack([np.abs(sample_mean[a] - sample_mean[b]) for a, b in pairs])
+        gradmask = gradients == gradients.max(axis=0)
+        # each gradient is one of two directions (1-4, or 5-8 for the opposite direction), and
+        # as GEE the directions of tied maximum gradients are summed (which matches no direction)
+        directions = np.zeros(image.shape, dtype=np.int8)
+        for i, (a, b) in enumerate(pairs):
+            forward = sample_mean[a] - centre > centre - sample_mean[b]
+            directions += gradmask[i] * np.where(forward, i + 1, i + 5).astype(np.int8)
+
+    # local noise variance, from the 5 most homogenous sampled windows
+    sample_stats = _divide(sample_var, sample_mean * sample_mean)
+    sigma_v = np.sort(sample_stats, axis=0)[:5].mean(axis=0)
+    sigma_v[np.isnan(sample_stats).any(axis=0)] = np.nan
+
+    # mean and variance over the directional kernel of each pixel
+    dir_mean, dir_var = _directional_stats(
+        image.reshape((-1,) + image.shape[-2:]).astype(np.float64),
+        directions.reshape((-1,) + image.shape[-2:]),
+        np.stack(_refined_lee_kernels()),
+    )
+    dir_mean = dir_mean.reshape(image.shape)
+    dir_var = dir_var.reshape(image.shape)
+
+    var_x = (dir_var - dir_mean * dir_mean * sigma_v) / (sigma_v + 1.0)
+    b = _divide(var_x, dir_var)
+    return dir_mean + b * (image - dir_mean)
+
+
+def _leesigma(image, kernel_size, sigma=0.9, enl=4, target_kernel=3):
+    # GEE retains strong scatterers where there are at least 7 pixels above the 98th percentile
+    # in a 3x3 window, counted with ee.Reducer.countDistinctNonNull. The bright pixel mask only
+    # has 2 distinct values, so no pixels are retained and the (image wide) percentile and
+    # retention are skipped here.
+
+    # MMSE estimate of the a-priori mean within a 3x3 local window (without clamping the weight,
+    # as speckle_filter.leesigma)
+    eta = 1.0 / math.sqrt(enl)
+    z_bar, varz = box_stats(image, target_kernel)
+    varx = (varz - z_bar ** 2 * eta ** 2) / (1 + eta ** 2)
+    b = _divide(varx, varz)
+    x_tilde = (1 - b) * np.abs(z_bar) + b * image
+
+    # sigma range
+    lut = LEE_SIGMA_LUT[sigma]
+    i1 = lut['I1'] * x_tilde
+    i2 = lut['I2'] * x_tilde
+
+    # MMSE filter of the pixels in the sigma range (either bound, as speckle_filter.leesigma)
+    with np.errstate(invalid='ignore'):
+        in_range = (image >= i1) | (image <= i2)
+    z = np.where(in_range, image, np.nan)
+    z_bar, varz = box_stats(z, kernel_size)
+    x_hat = _mmse(z, z_bar, varz, lut['eta'])
+    return x_hat
+
+# ---------------------------------------------------------------------------//
+# 3. SPECKLE FILTERS (XARRAY)
+# ---------------------------------------------------------------------------//
+
+def _apply(func, array, radius, **kwargs):
+    """
+    Apply an array filter to an xr.DataArray, a chunk at a time (overlapping by the radius of the
+    filter) for dask backed arrays.
+    """
+    data = array.data.astype(np.float32)
+    if isinstance(data, da.Array):
+        depth = {axis: 0 for axis in range(data.ndim - 2)}
+        depth.update({data.ndim - 2: radius, data.ndim - 1: radius})
+        filtered = data.map_overlap(
+            lambda block: func(block, **kwargs).astype(np.float32),
+            depth=depth,
+            boundary=np.nan,
+            dtype=np.float32,
+            meta=np.array((), dtype=np.float32),
+        )
+    else:
+        filtered = func(data, **kwargs).astype(np.float32)
+    return array.copy(data=filtered)
+
+
+def _filter_bands(image, func, radius, **kwargs):
+    """
+    Filter each band of an xr.Dataset (except angle), or an xr.DataArray.
+    """
+    if not hasattr(image, 'data_vars'):
+        return _apply(func, image, radius, **kwargs)
+    return image.assign({
+        name: _apply(func, band, radius, **kwargs)
+        for name, band in image.data_vars.items() if name != 'angle'
+    })
+
+
+def boxcar(image, KERNEL_SIZE):
+    """
+    Apply boxcar filter on an image (or stack of images).
+
+    Parameters
+    ----------
+    image : xr.Dataset or xr.DataArray
+        Image to be filtered
+    KERNEL_SIZE : positive odd integer
+        Neighbourhood window size
+
+    Returns
+    -------
+    xr.Dataset or xr.DataArray
+        Filtered Image
+
+    """
+    return _filter_bands(image, _boxcar, KERNEL_SIZE // 2, kernel_size=KERNEL_SIZE)
+
+
+def leefilter(image, KERNEL_SIZE):
+    """
+    Lee Filter applied to an image (or stack of images), as speckle_filter.leefilter.
+
+    Parameters
+    ----------
+    image : xr.Dataset or xr.DataArray
+        Image to be filtered
+    KERNEL_SIZE : positive odd integer
+        Neighbourhood window size
+
+    Returns
+    -------
+    xr.Dataset or xr.DataArray
+        Filtered Image
+
+    """
+    return _filter_bands(image, _leefilter, KERNEL_SIZE // 2, kernel_size=KERNEL_SIZE)
+
+
+def gammamap(image, KERNEL_SIZE):
+    """
+    Gamma Maximum a-posterior Filter applied to an image (or stack of images), as
+    speckle_filter.gammamap.
+
+    Parameters
+    ----------
+    image : xr.Dataset or xr.DataArray
+        Image to be filtered
+    KERNEL_SIZE : positive odd integer
+        Neighbourhood window size
+
+    Returns
+    -------
+    xr.Dataset or xr.DataArray
+        Filtered Image
+
+    """
+    return _filter_bands(image, _gammamap, KERNEL_SIZE // 2, kernel_size=KERNEL_SIZE)
+
+
+def RefinedLee(image):
+    """
+    Refined Lee filter applied to an image (or stack of images), as speckle_filter.RefinedLee.
+
+    Parameters
+    ----------
+    image : xr.Dataset or xr.DataArray
+        Image to be filtered (linear, i.e. not in dB)
+
+    Returns
+    -------
+    xr.Dataset or xr.DataArray
+        Filtered Image
+
+    """
+    return _filter_bands(image, _refined_lee, REFINED_LEE_RADIUS)
+
+
+def leesigma(image, KERNEL_SIZE):
+    """
+    Improved Lee sigma filter applied to an image (or stack of images), as
+    speckle_filter.leesigma.
+
+    Parameters
+    ----------
+    image : xr.Dataset or xr.DataArray
+        Image to be filtered
+    KERNEL_SIZE : positive odd integer
+        Neighbourhood window size
+
+    Returns
+    -------
+    xr.Dataset or xr.DataArray
+        Filtered Image
+
+    """
+    # the sigma range of each pixel depends on its 3x3 neighbourhood
+    return _filter_bands(image, _leesigma, KERNEL_SIZE // 2 + 1, kernel_size=KERNEL_SIZE)
+
+# ---------------------------------------------------------------------------//
+# 4. MONO-TEMPORAL SPECKLE FILTER (WRAPPER)
+# ---------------------------------------------------------------------------//
+
+SPECKLE_FILTERS = {
+    'BOXCAR': boxcar,
+    'LEE': leefilter,
+    'GAMMA MAP': gammamap,
+    'REFINED LEE': lambda image, KERNEL_SIZE: RefinedLee(image),
+    'LEE SIGMA': leesigma,
+}
+
+
+def MonoTemporal_Filter(data, KERNEL_SIZE, SPECKLE_FILTER):
+    """
+    A wrapper function for monotemporal filter
+
+    Parameters
+    ----------
+    data : xr.Dataset or xr.DataArray
+        the images to be filtered, e.g. with (time, y, x) dimensions
+    KERNEL_SIZE : odd integer
+        Spatial Neighbourhood window
+    SPECKLE_FILTER : String
+        Type of speckle filter
+
+    Returns
+    -------
+    xr.Dataset or xr.DataArray
+        The images, each filtered individually
+
+    """
+    if SPECKLE_FILTER not in SPECKLE_FILTERS:
+        raise ValueError("ERROR!!! SPECKLE_FILTER not correctly defined")
+    return SPECKLE_FILTERS[SPECKLE_FILTER](data, KERNEL_SIZE)
+
+# ---------------------------------------------------------------------------//
+# 5. MULTI-TEMPORAL SPECKLE FILTER
+# ---------------------------------------------------------------------------//
+
+def _add_ratios(ratio_sum, count, terms, sign):
+    """
+    Add (sign 1) or remove (sign -1) the ratio and valid pixels of an image from the window sums
+    """
+    for name, (ratio, valid) in terms.items():
+        ratio_sum[name] += sign * np.nan_to_num(ratio)
+        count[name] += sign * valid
+
+
+def Quegan(images, KERNEL_SIZE, SPECKLE_FILTER, NR_OF_IMAGES):
+    """
+    The multi-temporal speckle filter of speckle_filter.MultiTemporal_Filter, implemented as
+    described in
+    S. Quegan and J. J. Yu, “Filtering of multichannel SAR images,”
+    IEEE Trans Geosci. Remote Sensing, vol. 39, Nov. 2001.
+
+    Each image is filtered as
+
+        filtered / count * sum(image_i / filtered_i)
+
+    over a window of NR_OF_IMAGES images: the image and the images before it, or the first
+    NR_OF_IMAGES images for the first images (as GEE adds images after the image when there
+    aren't enough before it). Rather than re-filtering the images of each window, each image is
+    filtered once and the sum of ratios is updated as the window slides, adding the newest image
+    and removing the oldest, so filtering N images costs N spatial filters.
+
+    Images are processed as they are read (in memory, one at a time), and only the ratios of the
+    window (and, until the first window is full, the images waiting for it) are kept.
+
+    Parameters
+    ----------
+    images : iterable of xr.Dataset
+        Images of the same relative orbit on the same grid, in time order
+    KERNEL_SIZE : odd integer
+        Spatial Neighbourhood window
+    SPECKLE_FILTER : String
+        Type of speckle filter
+    NR_OF_IMAGES : positive integer
+        Number of images to use in multi-temporal filtering
+
+    Yields
+    ------
+    xr.Dataset
+        Filtered images, in the order of images
+
+    """
+    window = collections.deque()
+    ratio_sum = count = None
+    pending = []
+
+    def combine(image, filtered):
+        return image.assign({
+            name: filtered[name].copy(
+                data=(_divide(filtered[name].values, count[name]) * ratio_sum[name]).astype(np.float32)
+            )
+            for name in ratio_sum
+        })
+
+    for image in images:
+        image = image.compute()
+        filtered = MonoTemporal_Filter(image, KERNEL_SIZE, SPECKLE_FILTER)
+        terms = {}
+        for name in image.data_vars:
+            if name == 'angle':
+                continue
+            values = image[name].values
+            terms[name] = (_divide(values, filtered[name].values), np.isfinite(values))
+
+        if ratio_sum is None:
+            ratio_sum = {name: np.zeros(ratio.shape) for name, (ratio, _) in terms.items()}
+            count = {name: np.zeros(ratio.shape, dtype=np.int32) for name, (ratio, _) in terms.items()}
+        _add_ratios(ratio_sum, count, terms, 1)
+        window.append(terms)
+        if len(window) > NR_OF_IMAGES:
+            _add_ratios(ratio_sum, count, window.popleft(), -1)
+
+        pending.append((image, filtered))
+        if len(window) == NR_OF_IMAGES:
+            for waiting in pending:
+                yield combine(*waiting)
+            pending = []
+
+    # fewer than NR_OF_IMAGES images, all are in the window
+    for waiting in pending:
+        yield combine(*waiting)
+
+
+def MultiTemporal_Filter(data, KERNEL_SIZE, SPECKLE_FILTER, NR_OF_IMAGES):
+    """
+    A wrapper function for multi-temporal filter of a stack of images (see Quegan)
+
+    Parameters
+    ----------
+    data : xr.Dataset
+        the images to be filtered, of the same relative orbit with (time, y, x) dimensions
+    KERNEL_SIZE : odd integer
+        Spatial Neighbourhood window
+    SPECKLE_FILTER : String
+        Type of speckle filter
+    NR_OF_IMAGES : positive integer
+        Number of images to use in multi-temporal filtering
+
+    Returns
+    -------
+    xr.Dataset
+        The images, with a multi-temporal filter applied to each
+
+    """
+    data = data.sortby('time')
+    images = (data.isel(time=i) for i in range(data.sizes['time']))
+    return xr.concat(list(Quegan(images, KERNEL_SIZE, SPECKLE_FILTER, NR_OF_IMAGES)), dim='time')
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Version: v1.0
+Date: 2026-10-17
+Description: Local (NumPy over xarray) version of the radiometric terrain flattening in
+             terrain_flattening.py, adopted from
+Vollrath, A., Mullissa, A., & Reiche, J. (2020).
+Angular-Based Radiometric Slope Correction for Sentinel-1 on Google Earth Engine.
+  Remote Sensing, 12(11), [1867]. https://doi.org/10.3390/rs12111867
+
+Images are xr.Datasets of linear backscatter bands and the angle band on a projected grid (in
+metres), with a DEM on the same grid. The terrain geometry (slope and aspect of the DEM, and the
+slope steepness in range and azimuth for the look direction) only depends on the DEM tile and the
+orbit, so rather than being computed for every image as on GEE it is computed once for each DEM
+tile and relative orbit, and kept in a TerrainCache for the other acquisitions.
+"""
+import collections
+import itertools
+import math
+
+import numpy as np
+from scipy import ndimage
+
+# Number of (DEM tile, orbit) terrain geometries kept by a TerrainCache
+TERRAIN_CACHE_ENTRIES = 4
+
+# ---------------------------------------------------------------------------//
+# Terrain geometry
+# ---------------------------------------------------------------------------//
+
+def _resolution(array):
+    """
+    Signed pixel size (y, x) of a grid, in the units of its coordinates
+    """
+    return float(array.y[1] - array.y[0]), float(array.x[1] - array.x[0])
+
+
+def _grid_key(array):
+    """
+    Key of the grid (and name) of an xr.DataArray
+    """
+    return (array.name, array.shape, float(array.y[0]), float(array.x[0])) + _resolution(array)
+
+
+def slope_aspect(elevation, resolution, fill_missing=True):
+    """
+    Slope and aspect of a DEM as ee.Terrain.slope and ee.Terrain.aspect, from the 4-connected
+    neighbours of each pixel.
+
+    Parameters
+    ----------
+    elevation : np.ndarray
+        DEM with y and x as the last two dimensions
+    resolution : tuple
+        Signed pixel size (y, x), in the units of the elevation
+    fill_missing : bool
+        Use the value of the pixel for neighbours which are missing (e.g. outside the DEM), rather
+        than giving NaN
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Slope (radians) and aspect (degrees clockwise from north, the direction the slope faces)
+
+    """
+    pad_width = [(0, 0)] * (elevation.ndim - 2) + [(1, 1)] * 2
+    z = np.pad(np.asarray(elevation, dtype=np.float64), pad_width, constant_values=np.nan)
+    centre = z[..., 1:-1, 1:-1]
+
+    def neighbour(rows, cols):
+        values = z[..., rows, cols]
+        return np.where(np.isnan(values), centre, values) if fill_missing else values
+
+    dz_dy = (neighbour(slice(2, None), slice(1, -1)) - neighbour(slice(None, -2), slice(1, -1))) / (2 * resolution[0])
+    dz_dx = (neighbour(slice(1, -1), slice(2, None)) - neighbour(slice(1, -1), slice(None, -2))) / (2 * resolution[1])
+    slope = np.arctan(np.hypot(dz_dx, dz_dy))
+    aspect = np.degrees(np.arctan2(-dz_dx, -dz_dy)) % 360
+    return slope, aspect
+
+
+def look_direction(angle):
+    """
+    Heading of the look direction (degrees, -180 to 180) of an image, from the mean aspect of its
+    incidence angle band, as terrain_flattening.slope_correction.
+
+    Parameters
+    ----------
+    angle : xr.DataArray
+        Incidence angle band
+
+    Returns
+    -------
+    float
+        Heading (degrees), NaN if the angle band has no valid pixels with valid neighbours
+        (e.g. an image with no data over the grid)
+
+    """
+    _, aspect = slope_aspect(angle.values, _resolution(angle), fill_missing=False)
+    if not np.isfinite(aspect).any():
+        return math.nan
+    heading = np.nanmean(aspect)
+    return float(heading - 360 if heading > 180 else heading)
+
+
+def terrain_geometry(slope, aspect, heading):
+    """
+    Slope steepness in range and azimuth for a look direction (2.1.2 and 2.1.3 in the article).
+
+    Parameters
+    ----------
+    slope : np.ndarray
+        Slope of the DEM (radians)
+    aspect : np.ndarray
+        Aspect of the DEM (degrees)
+    heading : float
+        Heading of the look direction (degrees)
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Slope steepness in range and in azimuth (radians)
+
+    """
+    phi_iRad = math.radians(heading)
+    phi_sRad = -np.radians(np.where(aspect > 180, aspect - 360, aspect))
+    phi_rRad = phi_iRad - phi_sRad
+    tan_slope = np.tan(slope)
+    # slope steepness in range (eq. 2)
+    alpha_rRad = np.arctan(tan_slope * np.cos(phi_rRad))
+    # slope steepness in azimuth (eq 3)
+    alpha_azRad = np.arctan(tan_slope * np.sin(phi_rRad))
+    return alpha_rRad.astype(np.float32), alpha_azRad.astype(np.float32)
+
+
+class TerrainCache:
+    """
+    Terrain geometry of DEM tiles for each orbit, computed the first time a (DEM tile, orbit) is
+    used and kept for the following images. The heading of an orbit is given, or taken from the
+    first image of the orbit with a valid angle band, and the slope and aspect of a DEM tile are
+    shared by all orbits.
+
+    Parameters
+    ----------
+    max_entries : integer
+        Number of (DEM tile, orbit) geometries to keep, least recently used are dropped
+    headings : dict
+        Heading (degrees) of each orbit, e.g. from the unmasked angle band of a whole scene
+        (see look_direction). Other orbits take the heading of their first valid image.
+    """
+
+    def __init__(self, max_entries=TERRAIN_CACHE_ENTRIES, headings=None):
+        self.max_entries = max_entries
+        self.headings = {
+            orbit: heading for orbit, heading in (headings or {}).items() if np.isfinite(heading)
+        }
+        self.slopes = collections.OrderedDict()
+        self.geometries = collections.OrderedDict()
+
+    def _get(self, entries, key, compute):
+        if key in entries:
+            entries.move_to_end(key)
+        else:
+            entries[key] = compute()
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+        return entries[key]
+
+    def geometry(self, dem, image, orbit=None):
+        """
+        Get the slope steepness in range and azimuth of a DEM for the orbit of an image.
+
+        Parameters
+        ----------
+        dem : xr.DataArray
+            DEM on the grid of the image
+        image : xr.Dataset
+            Image with an angle band
+        orbit : hashable
+            Orbit of the image (e.g. relative orbit number). If None, or the orbit has no heading
+            yet and the angle band of the image has no valid pixels, the geometry is computed for
+            the image, and not cached.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            Slope steepness in range and in azimuth (radians)
+
+        """
+        if orbit not in self.headings:
+            heading = look_direction(image['angle'])
+            # a heading from an image without valid angles isn't kept for the orbit
+            if orbit is None or not np.isfinite(heading):
+                return terrain_geometry(*slope_aspect(dem.values, _resolution(dem)), heading)
+            self.headings[orbit] = heading
+
+        dem_key = _grid_key(dem)
+        slope, aspect = self._get(
+            self.slopes, dem_key, lambda: slope_aspect(dem.values, _resolution(dem))
+        )
+        return self._get(
+            self.geometries, (dem_key, orbit),
+            lambda: terrain_geometry(slope, aspect, self.headings[orbit])
+        )
+
+# ---------------------------------------------------------------------------//
+# Terrain Flattening
+# ---------------------------------------------------------------------------//
+
+def _volumetric_model_SCF(theta_iRad, alpha_rRad):
+    # Volume model
+    nominator = np.tan(np.pi / 2 - theta_iRad + alpha_rRad)
+    denominator = np.tan(np.pi / 2 - theta_iRad)
+    return nominator / denominator
+
+
+def _direct_model_SCF(theta_iRad, alpha_rRad, alpha_azRad):
+    # Surface model
+    nominator = np.cos(np.pi / 2 - theta_iRad)
+    denominator = np.cos(alpha_azRad) * np.cos(np.pi / 2 - theta_iRad + alpha_rRad)
+    return nominator / denominator
+
+
+def _erode(mask, distance, resolution):
+    """
+    Mask pixels within a distance (in the units of the grid) of masked pixels
+    """
+    if mask.all():
+        return mask
+    d = ndimage.distance_transform_edt(mask, sampling=np.abs(resolution))
+    return d > distance
+
+
+def _masking(alpha_rRad, theta_iRad, buffer, resolution):
+    """
+    Layover / shadow mask (True where valid), buffered by a distance
+    """
+    with np.errstate(invalid='ignore'):
+        # layover, where slope > radar viewing angle
+        layover = alpha_rRad < theta_iRad
+        # shadow
+        shadow = alpha_rRad > -(np.pi / 2 - theta_iRad)
+    # combine layover and shadow
+    mask = layover & shadow
+    # add buffer to final mask
+    if buffer > 0:
+        mask = _erode(mask, buffer, resolution)
+    return mask
+
+
+def correct(image, TERRAIN_FLATTENING_MODEL, alpha_rRad, alpha_azRad,
+            TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER):
+    """
+    Radiometric terrain normalization of an image, with the terrain geometry of its orbit.
+
+    Parameters
+    ----------
+    image : xr.Dataset
+        Image to apply the radiometric terrain normalization to (linear bands and angle)
+    TERRAIN_FLATTENING_MODEL : string
+        The radiometric terrain normalization model, either VOLUME or DIRECT
+    alpha_rRad : np.ndarray
+        Slope steepness in range
+    alpha_azRad : np.ndarray
+        Slope steepness in azimuth
+    TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER : integer
+        The additional buffer to account for the passive layover and shadow (metres)
+
+    Returns
+    -------
+    xr.Dataset
+        Radiometrically terrain corrected image
+
+    """
+    # 2.1.1 Radar geometry
+    theta_iRad = np.radians(image['angle'].values.astype(np.float32))
+
+    if TERRAIN_FLATTENING_MODEL == 'VOLUME':
+        scf = _volumetric_model_SCF(theta_iRad, alpha_rRad)
+    elif TERRAIN_FLATTENING_MODEL == 'DIRECT':
+        scf = _direct_model_SCF(theta_iRad, alpha_rRad, alpha_azRad)
+    else:
+        raise ValueError("ERROR!!! Parameter TERRAIN_FLATTENING_MODEL not correctly defined")
+
+    # 2.2 Gamma_nought, with the model applied
+    gamma0_scf = scf / np.cos(theta_iRad)
+
+    # get Layover/Shadow mask
+    mask = _masking(alpha_rRad, theta_iRad,
+                    TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER, _resolution(image['angle']))
+
+    return image.assign({
+        name: band.copy(data=np.where(mask, band.values * gamma0_scf, np.nan).astype(np.float32))
+        for name, band in image.data_vars.items() if name != 'angle'
+    })
+
+
+def slope_correction(collection, TERRAIN_FLATTENING_MODEL,
+                     DEM, TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER,
+                     orbits=None, cache=None):
+    """
+    Radiometric terrain normalization of each image of a collection, as
+    terrain_flattening.slope_correction.
+
+    Parameters
+    ----------
+    collection : iterable of xr.Dataset
+        Images (linear bands and angle) on the grid of the DEM
+    TERRAIN_FLATTENING_MODEL : string
+        The radiometric terrain normalization model, either VOLUME or DIRECT
+    DEM : xr.DataArray
+        The DEM on the grid of the images (projected, in metres)
+    TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER : integer
+        The additional buffer to account for the passive layover and shadow (metres)
+    orbits : iterable
+        Orbit of each image (e.g. relative orbit number), images of the same orbit share their
+        terrain geometry. If None the geometry is computed for each image, as on GEE.
+    cache : TerrainCache
+        Cache of terrain geometry, shared between calls (e.g. for several DEM tiles)
+
+    Yields
+    ------
+    xr.Dataset
+        Radiometrically terrain corrected images
+
+    """
+    if TERRAIN_FLATTENING_MODEL not in ('VOLUME', 'DIRECT'):
+        raise ValueError("ERROR!!! Parameter TERRAIN_FLATTENING_MODEL not correctly defined")
+    cache = cache if cache is not None else TerrainCache()
+    orbits = orbits if orbits is not None else itertools.repeat(None)
+
+    for image, orbit in zip(collection, orbits):
+        image = image.compute()
+        alpha_rRad, alpha_azRad = cache.geometry(DEM, image, orbit)
+        yield correct(image, TERRAIN_FLATTENING_MODEL, alpha_rRad, alpha_azRad,
+                      TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER)
@@ -8,6 +8,12 @@ Description: A wrapper function to derive the Sentinel-1 ARD
 """
 
 
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
 import ee
 import border_noise_correction as bnc
 import speckle_filter as sf
@@ -16,6 +22,277 @@ import helper
 
 ee.Initialize()
 
+# Number of export tasks submitted at once
+EXPORT_WORKERS = 8
+# Number of times a failed export task is resubmitted
+EXPORT_RETRIES = 2
+# Seconds between polls of the state of export tasks
+EXPORT_POLL_SECONDS = 60
+# States of export tasks which are done, or need resubmitting
+EXPORT_DONE_STATES = ['COMPLETED', 'SUCCEEDED']
+EXPORT_FAILED_STATES = ['FAILED', 'CANCELLED', 'CANCELED']
+# States of export tasks which are still to run, or running
+EXPORT_RUNNING_STATES = ['READY', 'RUNNING', 'PENDING']
+# Number of polls after which a task whose state is UNKNOWN is treated as failed
+EXPORT_UNKNOWN_POLLS = 5
+
+
+###########################################
+# EXPORT TO ASSETS
+###########################################
+
+def _list_assets(parent):
+    """
+    List the IDs of the assets in a folder (none if it doesn't exist).
+
+    Parameters
+    ----------
+    parent : String
+        The folder, e.g. users/name/folder
+
+    Returns
+    -------
+    set
+        Asset IDs
+
+    """
+    assets = set()
+    request = {'parent': parent}
+    while True:
+        try:
+            response = ee.data.listAssets(request)
+        except ee.EEException:
+            return assets
+        for asset in response.get('assets', []):
+            assets.add(asset.get('id') or asset['name'].split('/assets/')[-1])
+        if not response.get('nextPageToken'):
+            return assets
+        request['pageToken'] = response['nextPageToken']
+
+
+class ExportManifest:
+    """
+    Local record (a JSON file) of the export task of each asset, so a rerun (or a retry) only
+    submits the assets which haven't been exported or are not being exported.
+
+    Parameters
+    ----------
+    path : String
+        Path of the JSON file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def update(self, asset_id, **values):
+        with self.lock:
+            self.entries.setdefault(asset_id, {}).update(values, updated=time.time())
+            with open(self.path + '.part', 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(self.path + '.part', self.path)
+
+    def state(self, asset_id):
+        return self.entries.get(asset_id, {}).get('state')
+
+
+def _start_export(image, asset_id, region, manifest):
+    """
+    Start an export task of an image to an asset, and record it in the manifest.
+    """
+    name = asset_id.split('/')[-1]
+    task = ee.batch.Export.image.toAsset(image=image,
+                                         assetId=asset_id,
+                                         description=name,
+                                         region=region,
+                                         scale=10,
+                                         maxPixels=1e13)
+    attempts = manifest.entries.get(asset_id, {}).get('attempts', 0) + 1
+    manifest.update(asset_id, attempts=attempts)
+    task.start()
+    manifest.update(asset_id, task_id=task.id, state='READY', unknown_polls=0)
+    print('Exporting {} to {}'.format(name, asset_id))
+
+
+def _submit_exports(exports, region, manifest, workers):
+    """
+    Start export tasks for (image, asset ID) pairs, with up to `workers` requests at once.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_start_export, image, asset_id, region, manifest): asset_id
+            for image, asset_id in exports
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                print('Export to {} failed to start: {}'.format(futures[future], err))
+                manifest.update(futures[future], state='FAILED', error=str(err))
+
+
+def _poll_exports(manifest, asset_ids, unknown_polls=EXPORT_UNKNOWN_POLLS):
+    """
+    Update the state of the export tasks of assets which are not done or failed in the manifest,
+    from one listing of the operations (tasks) of the project. A task which isn't listed is
+    UNKNOWN, and is marked FAILED after `unknown_polls` polls.
+
+    Returns
+    -------
+    dict
+        Asset ID of each task polled, by task ID
+
+    """
+    pending = {
+        manifest.entries[asset_id]['task_id']: asset_id for asset_id in asset_ids
+        if manifest.entries.get(asset_id, {}).get('task_id')
+        and manifest.state(asset_id) not in EXPORT_DONE_STATES + EXPORT_FAILED_STATES
+    }
+    if not pending:
+        return pending
+
+    # operation names end with the task ID
+    operations = {
+        operation['name'].split('/')[-1]: operation for operation in ee.data.listOperations()
+    }
+    for task_id, asset_id in pending.items():
+        operation = operations.get(task_id)
+        if operation is None:
+            polls = manifest.entries[asset_id].get('unknown_polls', 0) + 1
+            if polls >= unknown_polls:
+                manifest.update(asset_id, state='FAILED', unknown_polls=polls,
+                                error='Task state UNKNOWN after {} polls'.format(polls))
+            else:
+                manifest.update(asset_id, unknown_polls=polls)
+        else:
+            manifest.update(asset_id, state=operation.get('metadata', {}).get('state', 'PENDING'),
+                            unknown_polls=0, error=operation.get('error', {}).get('message'))
+    return pending
+
+
+def wait_for_exports(manifest, exports, region, workers=EXPORT_WORKERS,
+                     retries=EXPORT_RETRIES, poll_seconds=EXPORT_POLL_SECONDS):
+    """
+    Poll the export tasks in a manifest until they are done, resubmitting failed tasks up to
+    `retries` times. Tasks whose state stays UNKNOWN for EXPORT_UNKNOWN_POLLS polls are failed.
+
+    Parameters
+    ----------
+    manifest : ExportManifest
+        Manifest of the export tasks
+    exports : dict
+        Image to export to each asset ID, for resubmitting
+    region : ee.Geometry
+        Region to export
+    workers : positive integer
+        Number of tasks submitted at once
+    retries : integer
+        Number of times a failed task is resubmitted
+    poll_seconds : number
+        Seconds between polls
+
+    Returns
+    -------
+    dict
+        Final state of the task of each asset ID
+
+    """
+    while True:
+        # one listing of the operations for the state of all tasks
+        pending = _poll_exports(manifest, exports)
+
+        retry = [
+            (exports[asset_id], asset_id) for asset_id in exports
+            if manifest.state(asset_id) in EXPORT_FAILED_STATES
+            and manifest.entries[asset_id].get('attempts', 0) <= retries
+        ]
+        if retry:
+            print('Resubmitting {} failed exports'.format(len(retry)))
+            _submit_exports(retry, region, manifest, workers)
+        elif not pending:
+            return {asset_id: manifest.state(asset_id) for asset_id in exports}
+
+        done = sum(manifest.state(asset_id) in EXPORT_DONE_STATES for asset_id in exports)
+        print('{} of {} exports completed'.format(done, len(exports)))
+        time.sleep(poll_seconds)
+
+
+def export_to_assets(collection, ASSET_ID, manifest_path=None, workers=EXPORT_WORKERS,
+                     wait=False, retries=EXPORT_RETRIES):
+    """
+    Export each image of a collection to an asset in the ASSET_ID folder, named by its
+    system:index. The IDs of the images are fetched in one request, and the tasks are started
+    concurrently. Assets which already exist are skipped, as are assets whose task (recorded in
+    the manifest) is still to run or running, checked with one listing of the operations of the
+    project. Any other asset (e.g., whose task failed, or completed but the asset was since
+    deleted) is exported again.
+
+    Parameters
+    ----------
+    collection : ee.ImageCollection
+        The images to export
+    ASSET_ID : String
+        The folder to export to
+    manifest_path : String
+        Path of the JSON manifest of export tasks, by default in the working directory
+    workers : positive integer
+        Number of tasks submitted at once
+    wait : bool
+        Wait for the tasks to finish, resubmitting failed tasks
+    retries : integer
+        Number of times a failed task is resubmitted, when waiting
+
+    Returns
+    -------
+    ExportManifest
+        Manifest of the export tasks
+
+    """
+    if manifest_path is None:
+        manifest_path = 's1_export_{}.json'.format(ASSET_ID.strip('/').replace('/', '_'))
+    manifest = ExportManifest(manifest_path)
+
+    # image IDs and properties in one request
+    info = ee.Dictionary({
+        'index': collection.aggregate_array('system:index'),
+        'time_start': collection.aggregate_array('system:time_start'),
+    }).getInfo()
+    size = len(info['index'])
+    print('Number of images to export: ', size)
+
+    existing = _list_assets(ASSET_ID)
+    imlist = collection.toList(size)
+    region = collection.geometry()
+
+    asset_ids = [ASSET_ID + '/' + name for name in info['index']]
+    # tasks recorded as running may have finished or failed since the last run, and tasks which
+    # are no longer listed won't finish
+    _poll_exports(manifest, [asset_id for asset_id in asset_ids if asset_id not in existing],
+                  unknown_polls=1)
+
+    exports = {}
+    submit = []
+    for idx, (asset_id, time_start) in enumerate(zip(asset_ids, info['time_start'])):
+        exports[asset_id] = ee.Image(imlist.get(idx))
+        if asset_id in existing:
+            manifest.update(asset_id, state='COMPLETED', time_start=time_start)
+        elif manifest.state(asset_id) in EXPORT_RUNNING_STATES:
+            continue
+        else:
+            manifest.update(asset_id, time_start=time_start, attempts=0)
+            submit.append((exports[asset_id], asset_id))
+
+    print('Skipping {} existing or running exports'.format(size - len(submit)))
+    _submit_exports(submit, region, manifest, workers)
+
+    if wait:
+        wait_for_exports(manifest, exports, region, workers, retries)
+    return manifest
+
 
 ###########################################
 # DO THE JOB
@@ -220,24 +497,10 @@ def s1_preproc(params):
         s1_1 = s1_1.map(lambda image: image.clip(ROI))
         
         
-    if (SAVE_ASSET): 
-            
-        size = s1_1.size().getInfo()
-        imlist = s1_1.toList(size)
-        for idx in range(0, size):
-            img = imlist.get(idx)
-            img = ee.Image(img)
-            name = str(img.id().getInfo())
-            #name = str(idx)
-            description = name           
-            assetId = ASSET_ID+'/'+name
-
-            task = ee.batch.Export.image.toAsset(image=img,
-                                                 assetId=assetId,
-                                                 description=description,
-                                                 region=s1_1.geometry(),
-                                                 scale=10,
-                                                 maxPixels=1e13)
-            task.start()
-            print('Exporting {} to {}'.format(name, assetId))
+    if (SAVE_ASSET):
+        export_to_assets(s1_1, ASSET_ID,
+                         manifest_path=params.get('EXPORT_MANIFEST'),
+                         workers=params.get('EXPORT_WORKERS') or EXPORT_WORKERS,
+                         wait=params.get('EXPORT_WAIT', False),
+                         retries=params.get('EXPORT_RETRIES', EXPORT_RETRIES))
     return s1_1
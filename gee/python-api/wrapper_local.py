@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Version: v1.0
+Date: 2026-10-17
+Description: A local version of wrapper.s1_preproc, to derive Sentinel-1 ARD from S1 GRD scenes on
+             local disk (or S3) without GEE.
+
+s1_preproc takes the same parameters as wrapper.s1_preproc, with local data in place of GEE assets:
+
+    INPUT : paths of the S1 GRD scenes (linear backscatter) on a common grid, each a GeoTIFF with
+            bands named by their descriptions (VV, VH, angle) and the scene metadata as tags, or a
+            zarr store with the bands as variables and the metadata as attributes. The metadata
+            has the time of the scene ('time', ISO 8601) and the properties of the
+            COPERNICUS/S1_GRD_FLOAT collection used for selection: 'platform_number',
+            'orbitProperties_pass' and 'relativeOrbitNumber_start'.
+    DEM : path of a DEM (GeoTIFF or zarr) on the grid of the scenes.
+    ROI : a shapely geometry (or bounds) in the CRS of the grid.
+    OUTPUT : path of the zarr store to write, with (time, y, x) variables for the bands.
+    CHUNK_SIZE : (optional) size of chunks in y and x, processed and stored at once.
+    WORKERS : (optional) number of chunks processed at once.
+
+The defaults are those of wrapper.s1_preproc, except SPECKLE_FILTER_FRAMEWORK which defaults to
+'MULTI': wrapper.s1_preproc defaults to 'MULTI BOXCAR', which it then rejects when speckle
+filtering is applied (only 'MONO' and 'MULTI' are accepted by both).
+
+The grid is processed a chunk at a time: each task reads a chunk (with a margin for the filters)
+of every scene of a relative orbit in time order, and streams it through border noise correction,
+speckle filtering, terrain flattening, dB conversion and clipping before writing it to the store,
+so only a window of images of one chunk is held in memory by each worker. The look direction of
+each relative orbit is computed once, from the (unmasked) angle band of a whole scene as
+terrain_flattening.slope_correction, so all chunks of an orbit share it. The terrain geometry of a
+chunk is computed once for each relative orbit, and the multi-temporal speckle filter keeps a
+rolling window of ratio images (see speckle_filter_local.Quegan).
+"""
+
+import concurrent.futures
+import itertools
+import math
+import os
+
+import dask.array as da
+import numpy as np
+import rasterio
+import rasterio.crs
+import rasterio.features
+import rasterio.transform
+import rasterio.windows
+import shapely.geometry
+from rasterio.enums import Resampling
+import xarray as xr
+import zarr
+from affine import Affine
+from rasterio.windows import Window
+
+import speckle_filter_local as sfl
+import terrain_flattening_local as trf
+
+# Size of chunks (pixels in y and x) processed and stored at once
+S1_CHUNK_SIZE = 1024
+# Angles outside which border noise is masked, as border_noise_correction.f_mask_edges
+BORDER_NOISE_ANGLES = (30.63993, 45.23993)
+# Scale (metres) the look direction of a scene is computed at, as terrain_flattening.slope_correction
+HEADING_SCALE = 1000
+
+###########################################
+# INPUT
+###########################################
+
+class Raster:
+    """
+    A raster on the processing grid, in a GeoTIFF (bands named by their descriptions, metadata in
+    tags) or a zarr store (bands as variables, metadata in attributes).
+
+    Parameters
+    ----------
+    path : string
+        Path of the GeoTIFF or zarr store
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_zarr = path.rstrip('/').endswith('.zarr')
+        if self.is_zarr:
+            self.data = xr.open_zarr(path)
+            self.bands = list(self.data.data_vars)
+            self.metadata = dict(self.data.attrs)
+            x = self.data['x'].values
+            y = self.data['y'].values
+            res_x, res_y = x[1] - x[0], y[1] - y[0]
+            self.transform = Affine(res_x, 0, x[0] - res_x / 2, 0, res_y, y[0] - res_y / 2)
+            self.shape = (y.size, x.size)
+            self.crs = self.metadata.get('crs')
+        else:
+            with rasterio.open(path) as src:
+                self.bands = [description or str(i + 1) for i, description in enumerate(src.descriptions)]
+                self.metadata = src.tags()
+                self.transform = src.transform
+                self.shape = src.shape
+                self.crs = src.crs.to_wkt() if src.crs else None
+                self.nodata = src.nodata
+
+    @property
+    def time(self):
+        return np.datetime64(self.metadata['time'].rstrip('Z'), 'ms')
+
+    @property
+    def bounds(self):
+        return rasterio.transform.array_bounds(*self.shape, self.transform)
+
+    def grid(self):
+        return (tuple(float(value) for value in tuple(self.transform)[:6]), tuple(self.shape))
+
+    def read(self, bands, window):
+        """
+        Read bands within a window (row_off, col_off, height, width), which may extend beyond the
+        raster, as float32 with NaN outside the raster and for nodata.
+        """
+        row_off, col_off, height, width = window
+        if not self.is_zarr:
+            with rasterio.open(self.path) as src:
+                data = src.read(
+                    [self.bands.index(band) + 1 for band in bands],
+                    window=Window(col_off, row_off, width, height),
+                    boundless=True,
+                    fill_value=self.nodata if self.nodata is not None else np.nan,
+                    out_dtype=np.float32,
+                )
+            if self.nodata is not None:
+                data[data == self.nodata] = np.nan
+            return dict(zip(bands, data))
+
+        # read the part of the window within the raster, and pad
+        rows = slice(max(row_off, 0), min(row_off + height, self.shape[0]))
+        cols = slice(max(col_off, 0), min(col_off + width, self.shape[1]))
+        pad_width = (
+            (rows.start - row_off, row_off + height - max(rows.stop, rows.start)),
+            (cols.start - col_off, col_off + width - max(cols.stop, cols.start)),
+        )
+        return {
+            band: np.pad(
+                self.data[band].isel(y=rows, x=cols).values.astype(np.float32),
+                pad_width, constant_values=np.nan,
+            )
+            for band in bands
+        }
+
+    def read_decimated(self, band, step):
+        """
+        Read a band at (about) every step-th pixel in y and x, as float32 with NaN for nodata.
+        Returns the data and its (signed) pixel size in y and x.
+        """
+        height, width = (math.ceil(size / step) for size in self.shape)
+        if self.is_zarr:
+            data = self.data[band].values[::step, ::step].astype(np.float32)
+        else:
+            with rasterio.open(self.path) as src:
+                data = src.read(self.bands.index(band) + 1, out_shape=(height, width),
+                                resampling=Resampling.nearest, out_dtype=np.float32)
+            if self.nodata is not None:
+                data[data == self.nodata] = np.nan
+        resolution = (self.transform.e * self.shape[0] / data.shape[0],
+                      self.transform.a * self.shape[1] / data.shape[1])
+        return data, resolution
+
+
+def _window_coords(transform, window):
+    """
+    Coordinates of the pixel centres of a window
+    """
+    row_off, col_off, height, width = window
+    return {
+        'y': transform.f + (np.arange(row_off, row_off + height) + 0.5) * transform.e,
+        'x': transform.c + (np.arange(col_off, col_off + width) + 0.5) * transform.a,
+    }
+
+###########################################
+# PROCESSING (PER CHUNK)
+###########################################
+
+def _mask_border_noise(image, mask_angle=False):
+    """
+    Mask out angles outside BORDER_NOISE_ANGLES, as border_noise_correction.f_mask_edges. The angle
+    band is only masked with mask_angle, so it can still be used by the terrain correction before
+    it is masked for the output.
+    """
+    low, high = BORDER_NOISE_ANGLES
+    angle = image['angle']
+    valid = (angle > low) & (angle < high)
+    return image.assign({
+        name: band.where(valid) for name, band in image.data_vars.items()
+        if mask_angle or name != 'angle'
+    })
+
+
+def _orbit_heading(scenes):
+    """
+    Look direction (degrees) of a relative orbit, from the unmasked angle band of its first scene
+    with valid angles at HEADING_SCALE (or finer, for small scenes, to keep the 3x3 pixels an aspect
+    needs). NaN if no scene has valid angles.
+    """
+    step = round(HEADING_SCALE / abs(scenes[0].transform.a))
+    step = max(1, min(step, (min(scenes[0].shape) - 1) // 2))
+    for scene in scenes:
+        data, (res_y, res_x) = scene.read_decimated('angle', step)
+        angle = xr.DataArray(data, dims=('y', 'x'),
+                             coords={'y': np.arange(data.shape[0]) * res_y,
+                                     'x': np.arange(data.shape[1]) * res_x})
+        heading = trf.look_direction(angle)
+        if np.isfinite(heading):
+            return heading
+    return math.nan
+
+
+def _lin_to_db(image):
+    """
+    Convert backscatter from linear to dB, as helper.lin_to_db
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return image.assign({
+            name: 10 * np.log10(band) for name, band in image.data_vars.items() if name != 'angle'
+        })
+
+
+def _halo(params, resolution):
+    """
+    Margin (pixels) read around each chunk, so the filters of the chunk use the same pixels as
+    for the whole grid
+    """
+    halo = 0
+    if params['APPLY_SPECKLE_FILTERING']:
+        if params['SPECKLE_FILTER'] == 'REFINED LEE':
+            halo = sfl.REFINED_LEE_RADIUS
+        else:
+            halo = params['SPECKLE_FILTER_KERNEL_SIZE'] // 2 + 1
+    if params['APPLY_TERRAIN_FLATTENING']:
+        buffer = params['TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER']
+        halo = max(halo, math.ceil(buffer / resolution) + 1)
+    return halo
+
+
+def _process_chunk(scenes, times, window, params, bands, halo, dem, roi, store, heading):
+    """
+    Process a chunk of the scenes of a relative orbit (in time order), with the look direction
+    (heading) of the orbit, and write it to the store. Returns the number of images written.
+    """
+    row_off, col_off, height, width = window
+    # the margin is only read within the grid, as the edges of the grid are the edges of the image
+    top, left = max(row_off - halo, 0), max(col_off - halo, 0)
+    bottom = min(row_off + height + halo, scenes[0].shape[0])
+    right = min(col_off + width + halo, scenes[0].shape[1])
+    outer = (top, left, bottom - top, right - left)
+    transform = scenes[0].transform
+    coords = _window_coords(transform, outer)
+    inner = (slice(row_off - top, row_off - top + height), slice(col_off - left, col_off - left + width))
+
+    if roi is not None and params['CLIP_TO_ROI']:
+        roi_mask = rasterio.features.geometry_mask(
+            [roi], (height, width), transform * Affine.translation(col_off, row_off), invert=True
+        )
+    else:
+        roi_mask = None
+
+    def read(scene):
+        return xr.Dataset(
+            {band: (('y', 'x'), data) for band, data in scene.read(bands, outer).items()},
+            coords=coords,
+        )
+
+    # 1. DATA SELECTION
+    images = (read(scene) for scene in scenes)
+
+    # 2. ADDITIONAL BORDER NOISE CORRECTION
+    if params['APPLY_BORDER_NOISE_CORRECTION']:
+        images = (_mask_border_noise(image) for image in images)
+
+    # 3. SPECKLE FILTERING
+    if params['APPLY_SPECKLE_FILTERING']:
+        if params['SPECKLE_FILTER_FRAMEWORK'] == 'MONO':
+            images = (
+                sfl.MonoTemporal_Filter(image, params['SPECKLE_FILTER_KERNEL_SIZE'], params['SPECKLE_FILTER'])
+                for image in images
+            )
+        else:
+            images = sfl.Quegan(images, params['SPECKLE_FILTER_KERNEL_SIZE'],
+                                params['SPECKLE_FILTER'], params['SPECKLE_FILTER_NR_OF_IMAGES'])
+
+    # 4. TERRAIN CORRECTION
+    if params['APPLY_TERRAIN_FLATTENING']:
+        orbit = scenes[0].metadata.get('relativeOrbitNumber_start')
+        dem_chunk = xr.DataArray(dem.read(dem.bands[:1], outer)[dem.bands[0]],
+                                 dims=('y', 'x'), coords=coords, name='dem')
+        images = trf.slope_correction(
+            images, params['TERRAIN_FLATTENING_MODEL'], dem_chunk,
+            params['TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER'],
+            orbits=itertools.repeat(orbit),
+            cache=trf.TerrainCache(headings={orbit: heading}),
+        )
+
+    # 5. OUTPUT
+    if params['APPLY_BORDER_NOISE_CORRECTION']:
+        images = (_mask_border_noise(image, mask_angle=True) for image in images)
+    if params['FORMAT'] == 'DB':
+        images = (_lin_to_db(image) for image in images)
+
+    written = 0
+    for time, image in zip(times, images):
+        for band in bands:
+            data = image[band].values[inner].astype(np.float32)
+            if roi_mask is not None:
+                data[~roi_mask] = np.nan
+            # the store is filled with NaN, so empty chunks aren't written
+            if np.isfinite(data).any():
+                store[band][time, row_off:row_off + height, col_off:col_off + width] = data
+        written += 1
+    return written
+
+
+def _bounded_map(func, tasks, workers):
+    """
+    Run func on each task (a tuple of arguments) in a pool of worker threads, yielding the results
+    as they complete. Tasks are taken from the (lazy) iterable as workers become free, with at most
+    2 * workers submitted at once.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for task in tasks:
+            pending.add(executor.submit(func, *task))
+            if len(pending) >= 2 * workers:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+###########################################
+# DO THE JOB
+###########################################
+
+def _check_params(params):
+    """
+    Parameters with defaults set, as wrapper.s1_preproc (but with a SPECKLE_FILTER_FRAMEWORK
+    default which is accepted, see the module description)
+    """
+    params = dict(params)
+    defaults = {
+        'APPLY_BORDER_NOISE_CORRECTION': True,
+        'APPLY_TERRAIN_FLATTENING': True,
+        'APPLY_SPECKLE_FILTERING': True,
+        'POLARIZATION': 'VVVH',
+        'ORBIT': 'DESCENDING',
+        'SPECKLE_FILTER_FRAMEWORK': 'MULTI',
+        'SPECKLE_FILTER': 'GAMMA MAP',
+        'SPECKLE_FILTER_KERNEL_SIZE': 7,
+        'SPECKLE_FILTER_NR_OF_IMAGES': 10,
+        'TERRAIN_FLATTENING_MODEL': 'VOLUME',
+        'TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER': 0,
+        'FORMAT': 'DB',
+        'CHUNK_SIZE': S1_CHUNK_SIZE,
+        'WORKERS': os.cpu_count(),
+    }
+    for key, default in defaults.items():
+        if params.get(key) is None:
+            params[key] = default
+
+    if (params['POLARIZATION'] not in ['VV', 'VH', 'VVVH']):
+        raise ValueError("ERROR!!! Parameter POLARIZATION not correctly defined")
+    if (params['ORBIT'] not in ['ASCENDING', 'DESCENDING', 'BOTH']):
+        raise ValueError("ERROR!!! Parameter ORBIT not correctly defined")
+    if (params['TERRAIN_FLATTENING_MODEL'] not in ['DIRECT', 'VOLUME']):
+        raise ValueError("ERROR!!! Parameter TERRAIN_FLATTENING_MODEL not correctly defined")
+    if (params['FORMAT'] not in ['LINEAR', 'DB']):
+        raise ValueError("ERROR!!! FORMAT not correctly defined")
+    if (params['TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER'] < 0):
+        raise ValueError("ERROR!!! TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER not correctly defined")
+    if (params['SPECKLE_FILTER_KERNEL_SIZE'] <= 0):
+        raise ValueError("ERROR!!! SPECKLE_FILTER_KERNEL_SIZE not correctly defined")
+    if params['APPLY_SPECKLE_FILTERING']:
+        if (params['SPECKLE_FILTER'] not in sfl.SPECKLE_FILTERS):
+            raise ValueError("ERROR!!! SPECKLE_FILTER not correctly defined")
+        if (params['SPECKLE_FILTER_FRAMEWORK'] not in ['MONO', 'MULTI']):
+            raise ValueError("ERROR!!! SPECKLE_FILTER_FRAMEWORK not correctly defined")
+    if params['APPLY_TERRAIN_FLATTENING'] and params.get('DEM') is None:
+        raise ValueError("ERROR!!! DEM not correctly defined")
+    return params
+
+
+def _select_scenes(params):
+    """
+    Open the input scenes and select them as wrapper.s1_preproc, in time order
+    """
+    roi = params.get('ROI')
+    if roi is not None and not hasattr(roi, 'geom_type'):
+        roi = shapely.geometry.box(*roi)
+
+    selected = []
+    for path in params['INPUT']:
+        scene = Raster(path)
+        metadata = scene.metadata
+        if 'VH' not in scene.bands:
+            continue
+        if not (np.datetime64(params['START_DATE']) <= scene.time < np.datetime64(params['STOP_DATE'])):
+            continue
+        if roi is not None and not roi.intersects(shapely.geometry.box(*scene.bounds)):
+            continue
+        if (params.get('PLATFORM_NUMBER') in ('A', 'B')
+                and metadata.get('platform_number') != params['PLATFORM_NUMBER']):
+            continue
+        if (params.get('ORBIT_NUM') is not None
+                and str(metadata.get('relativeOrbitNumber_start')) != str(params['ORBIT_NUM'])):
+            continue
+        if params['ORBIT'] != 'BOTH' and metadata.get('orbitProperties_pass') != params['ORBIT']:
+            continue
+        selected.append(scene)
+
+    grids = {scene.grid() for scene in selected}
+    crss = {rasterio.crs.CRS.from_user_input(scene.crs).to_wkt() for scene in selected if scene.crs}
+    if len(grids) > 1 or len(crss) > 1:
+        raise ValueError("ERROR!!! INPUT scenes are not on the same grid")
+    return sorted(selected, key=lambda scene: scene.time), roi
+
+
+def _create_store(path, scenes, bands, chunk_size):
+    """
+    Create the output zarr store, filled with NaN, with a (time, y, x) variable for each band
+    """
+    scene = scenes[0]
+    shape = (len(scenes),) + tuple(scene.shape)
+    coords = _window_coords(scene.transform, (0, 0) + tuple(scene.shape))
+    coords['time'] = np.array([scene.time for scene in scenes], dtype='datetime64[ns]')
+    template = xr.Dataset(
+        {
+            band: (('time', 'y', 'x'),
+                   da.full(shape, np.nan, dtype=np.float32, chunks=(1, chunk_size, chunk_size)))
+            for band in bands
+        },
+        coords=coords,
+        attrs={'crs': scene.crs or ''},
+    )
+    template.to_zarr(path, mode='w', compute=False, consolidated=True)
+    return zarr.open_group(path, mode='r+')
+
+
+def s1_preproc(params):
+    """
+    Applies preprocessing to local S1 GRD scenes to return analysis ready sentinel-1 data, as
+    wrapper.s1_preproc.
+
+    Parameters
+    ----------
+    params : Dictionary
+        These parameters determine the data selection and image processing parameters, as
+        wrapper.s1_preproc with local INPUT, DEM, ROI and OUTPUT (see the module description).
+
+    Raises
+    ------
+    ValueError
+
+
+    Returns
+    -------
+    xr.Dataset
+        The processed Sentinel-1 images, read (lazily) from the OUTPUT store
+
+    """
+    params = _check_params(params)
+
+    ###########################################
+    # 1. DATA SELECTION
+    ###########################################
+
+    scenes, roi = _select_scenes(params)
+    if not scenes:
+        raise ValueError("ERROR!!! No INPUT scenes selected")
+    params['ROI'] = roi
+    bands = {'VV': ['VV', 'angle'], 'VH': ['VH', 'angle'], 'VVVH': ['VV', 'VH', 'angle']}[params['POLARIZATION']]
+    print("Selecting POLARIZATION ", params['POLARIZATION'])
+    print('Number of images in collection: ', len(scenes))
+
+    dem = Raster(params['DEM']) if params['APPLY_TERRAIN_FLATTENING'] else None
+    if dem is not None and dem.grid() != scenes[0].grid():
+        raise ValueError("ERROR!!! DEM is not on the grid of the INPUT scenes")
+
+    ###########################################
+    # 2-5. PROCESSING, A CHUNK AT A TIME
+    ###########################################
+
+    chunk_size = params['CHUNK_SIZE']
+    store = _create_store(params['OUTPUT'], scenes, bands, chunk_size)
+    halo = _halo(params, abs(scenes[0].transform.a))
+    time_index = {id(scene): i for i, scene in enumerate(scenes)}
+
+    # images of each relative orbit are filtered (multi-temporally) and terrain corrected together
+    orbits = {}
+    for scene in scenes:
+        key = (scene.metadata.get('orbitProperties_pass'), scene.metadata.get('relativeOrbitNumber_start'))
+        orbits.setdefault(key, []).append(scene)
+
+    height, width = scenes[0].shape
+    windows = [
+        (row, col, min(chunk_size, height - row), min(chunk_size, width - col))
+        for row in range(0, height, chunk_size)
+        for col in range(0, width, chunk_size)
+    ]
+    if roi is not None and params['CLIP_TO_ROI']:
+        transform = scenes[0].transform
+        windows = [
+            window for window in windows
+            if roi.intersects(shapely.geometry.box(*rasterio.windows.bounds(
+                Window(window[1], window[0], window[3], window[2]), transform)))
+        ]
+
+    # the look direction of each orbit, shared by all its chunks
+    headings = {}
+    if params['APPLY_TERRAIN_FLATTENING']:
+        headings = {key: _orbit_heading(orbit_scenes) for key, orbit_scenes in orbits.items()}
+
+    tasks = (
+        (orbit_scenes, [time_index[id(scene)] for scene in orbit_scenes], window,
+         params, bands, halo, dem, roi, store, headings.get(key))
+        for key, orbit_scenes in orbits.items()
+        for window in windows
+    )
+    n_tasks = len(orbits) * len(windows)
+    for done, _ in enumerate(_bounded_map(_process_chunk, tasks, params['WORKERS']), start=1):
+        if done % 10 == 0 or done == n_tasks:
+            print(f'Processed {done} of {n_tasks} chunks')
+
+    zarr.consolidate_metadata(params['OUTPUT'])
+    print('Sentinel-1 ARD written to ', params['OUTPUT'])
+    return xr.open_zarr(params['OUTPUT'])
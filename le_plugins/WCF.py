@@ -1,23 +1,93 @@
 from datacube.virtual import construct, Transformation, Measurement
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import xarray as xr
 import datacube
 import pickle
-import sys
-sys.path.append("/home/jovyan/code/dea-notebooks/Tools")
-from dea_tools.classification import sklearn_unflatten
-from dea_tools.classification import sklearn_flatten
+
+from tree_model import TreeEnsemble, WCF_BANDS
+
+# Number of pixels passed to the model at once
+WCF_BATCH_SIZE = 65536
+# Model used if none is given
+WCF_DEFAULT_MODEL = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../data/wcf_model.npz")
+)
+
+# Loaded models, shared by every WCF transform in this process
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(model_file=None):
+    '''
+    Get the model saved in a file (WCF_DEFAULT_MODEL if None), loading it the
+    first time it is needed in this process (or if the file has changed).
+    Models exported to .npz (see tree_model.py) are loaded without sklearn,
+    other files are unpickled.
+    '''
+    model_file = model_file or WCF_DEFAULT_MODEL
+    key = (os.path.abspath(model_file), os.path.getmtime(model_file))
+    with _models_lock:
+        if key not in _models:
+            if model_file.endswith(".npz"):
+                model = TreeEnsemble.load(model_file)
+            else:
+                with open(model_file, "rb") as f:
+                    model = pickle.load(f)
+                # Batches are run in parallel, rather than each prediction
+                if hasattr(model, "n_jobs"):
+                    model.n_jobs = 1
+            _models[key] = model
+        return _models[key]
+
+
+def predict(model, features, batch_size=WCF_BATCH_SIZE, workers=None):
+    '''
+    Predict with a model on a (pixels, bands) float32 array, a batch of
+    pixels at a time with batches run in parallel threads (tree models
+    release the GIL while predicting). Pixels with any NaN band are NaN.
+    '''
+    out = np.full(features.shape[0], np.nan, dtype='float32')
+
+    def predict_batch(start):
+        batch = features[start:start + batch_size]
+        valid = np.isfinite(batch).all(axis=1)
+        if valid.any():
+            out[start:start + batch_size][valid] = model.predict(batch[valid])
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        list(executor.map(predict_batch, range(0, features.shape[0], batch_size)))
+    return out
+
 
 class WCF(Transformation):
     '''
-    Load in Geomedian and combine with WCF model to generate Woody Cover Fraction (WCF)           
+    Load in Geomedian and combine with WCF model to generate Woody Cover Fraction (WCF)
     '''
-    def __init__(self, model_pickle, **settings):
+    def __init__(self, model_file=None, model_pickle=None, batch_size=WCF_BATCH_SIZE, workers=None, **settings):
         """
-        Takes an existing model saved out as a pickle file.
+        Takes an existing model exported to .npz (see tree_model.py) or
+        saved out as a pickle file (model_pickle), WCF_DEFAULT_MODEL if
+        neither is given.
+        batch_size: number of pixels to predict at once, bounds memory use
+        workers: number of threads to predict with, defaults to the number of CPUs
         """
-        # Unpickle model
-        with open(model_pickle, "rb") as f:
-            self.ml_model_dict = pickle.load(f)
+        self.ml_model_dict = get_model(model_file or model_pickle)
+        self.batch_size = batch_size
+        self.workers = workers
+
+    def predict_block(self, *bands, workers=None):
+        '''
+        Predict WCF for a block of bands (in the order of WCF_BANDS)
+        '''
+        features = np.empty((bands[0].size, len(bands)), dtype='float32')
+        for i, band in enumerate(bands):
+            features[:, i] = np.ravel(band)
+        wcf = predict(self.ml_model_dict, features, self.batch_size, workers or self.workers)
+        return wcf.reshape(bands[0].shape)
 
     def compute(self, data):
         # rename bands, needed for model predict
@@ -29,12 +99,16 @@ class WCF(Transformation):
             "nbart_swir_1": "swir1",
             "nbart_swir_2": "swir2"
         })
-        
-        # apply the model and rebuild structure of xarray to same as input
-        data = data.drop_vars(['fmask'])
-        flat = sklearn_flatten(data)
-        results = self.ml_model_dict.predict(flat)
-        predicted_wcf = (sklearn_unflatten(results,data).transpose())
+
+        # apply the model, a block at a time for dask backed data (each
+        # block in a single thread, dask runs blocks in parallel)
+        predicted_wcf = xr.apply_ufunc(
+            self.predict_block,
+            *[data[band] for band in WCF_BANDS],
+            kwargs={"workers": 1} if data.chunks else {},
+            dask="parallelized",
+            output_dtypes=[np.float32],
+        )
 
         return predicted_wcf.to_dataset(name='WCF')
 
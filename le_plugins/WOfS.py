@@ -1,51 +1,220 @@
-import tempfile
-import os
+import atexit
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datacube.virtual import construct, Transformation, Measurement
+import numpy as np
 import xarray as xr
-import datacube
-from pathlib import Path
-import rioxarray
+from rasterio.io import MemoryFile
 
 # WOfS classifier
 from wofs.virtualproduct import WOfSClassifier
-from odc.algo import safe_div, apply_numexpr, keep_good_only
 
-dc = datacube.Datacube()
+from datacube_pool import get_datacube
+from annual import split_years, stack_years
 
-class WOfS(Transformation):
+# In-memory (GDAL /vsimem/) DEM GeoTIFFs for the most recently used geoboxes
+DEM_CACHE_SIZE = 4
+_dem_cache = OrderedDict()
+_dem_cache_lock = threading.Lock()
+
+
+class _DEMFile:
+    """
+    Cached in-memory DEM file and the number of callers using it. A file
+    evicted from the cache while in use is closed when the last caller is done.
+    """
+
+    def __init__(self, memfile):
+        self.memfile = memfile
+        self.refs = 0
+        self.evicted = False
+
+
+def _geobox_key(geobox):
+    return (str(geobox.crs), tuple(geobox.transform)[:6], geobox.width, geobox.height)
+
+
+def _write_dem_file(like):
+    """
+    Load the Copernicus DEM matching the geobox of `like` into an in-memory GeoTIFF
+    """
+    dem = get_datacube().load(product="copernicus_dem_30", like=like)
+    elevation = dem.elevation
+    if "time" in elevation.dims:
+        elevation = elevation.isel(time=0)
+
+    memfile = MemoryFile()
+    try:
+        with memfile.open(
+            driver="GTiff",
+            height=dem.geobox.height,
+            width=dem.geobox.width,
+            count=1,
+            dtype=elevation.dtype,
+            crs=str(dem.geobox.crs),
+            transform=dem.geobox.transform,
+            nodata=elevation.attrs.get("nodata"),
+        ) as dst:
+            dst.write(elevation.values, 1)
+    except Exception:
+        memfile.close()
+        raise
+    return memfile
+
+
+@contextmanager
+def get_dem_file(like):
+    """
+    Get the path to an in-memory GeoTIFF of the Copernicus DEM matching the
+    geobox of `like`, which can be passed to WOfSClassifier as `dsm_path`
+    within the `with` block, e.g.,
+
+        with get_dem_file(like) as dem_file:
+            ...
+
+    Nothing is written to disk. Files are cached per geobox so repeated calls
+    for the same tile skip the load; the least recently used file is dropped
+    once more than DEM_CACHE_SIZE are cached, and closed (freeing its memory)
+    once no `with` block is using it.
+    """
+    key = _geobox_key(like.geobox)
+    with _dem_cache_lock:
+        entry = _dem_cache.get(key)
+        if entry is not None:
+            _dem_cache.move_to_end(key)
+            entry.refs += 1
+
+    if entry is None:
+        entry = _DEMFile(_write_dem_file(like))
+        entry.refs += 1
+        with _dem_cache_lock:
+            if key in _dem_cache:
+                # loaded by another thread at the same time, keep theirs
+                _dem_cache[key].refs += 1
+                entry.memfile.close()
+                entry = _dem_cache[key]
+            else:
+                _dem_cache[key] = entry
+            while len(_dem_cache) > DEM_CACHE_SIZE:
+                _, old_entry = _dem_cache.popitem(last=False)
+                old_entry.evicted = True
+                if old_entry.refs == 0:
+                    old_entry.memfile.close()
+
+    try:
+        yield entry.memfile.name
+    finally:
+        with _dem_cache_lock:
+            entry.refs -= 1
+            if entry.evicted and entry.refs == 0:
+                entry.memfile.close()
+
+
+@atexit.register
+def clear_dem_cache():
+    """
+    Close all cached in-memory DEM files
+    """
+    with _dem_cache_lock:
+        while _dem_cache:
+            _, entry = _dem_cache.popitem()
+            entry.evicted = True
+            if entry.refs == 0:
+                entry.memfile.close()
+
+
+class WOfSCounts:
     '''
-    Load in Landsat SR and DEM to generate wofs summary for PNG on EASI ASIA 
-                
+    Accumulate WOfS summary counts from water observation bit flags.
+
+    Each time slice of flags is read once and the wet, clear and "some data"
+    counts are added straight into uint16 counters, so per observation
+    boolean arrays are never built for the whole time stack.
+    Based on the reduction in https://github.com/opendatacube/odc-stats/blob/develop/odc/stats/plugins/wofs.py
+
+    :param tuple shape: (y, x) shape of each time slice.
     '''
-    # Helper frunction from https://github.com/opendatacube/odc-stats/blob/develop/odc/stats/plugins/wofs.py
-    def reduce(self, xx: xr.Dataset) -> xr.Dataset:
-        nodata = -999
-        count_some = xx.some.sum(axis=0, dtype="int16")
-        count_wet = xx.wet.sum(axis=0, dtype="int16")
-        count_dry = xx.dry.sum(axis=0, dtype="int16")
-        count_clear = count_wet + count_dry
-        frequency = safe_div(count_wet, count_clear, dtype="float32")
-        
-        count_wet.attrs["nodata"] = nodata
-        count_clear.attrs["nodata"] = nodata
-        
-        is_ok = count_some > 0
-        count_wet = keep_good_only(count_wet, is_ok)
-        count_clear = keep_good_only(count_clear, is_ok)
-        
+
+    def __init__(self, shape):
+        self.count_wet = np.zeros(shape, dtype="uint16")
+        self.count_clear = np.zeros(shape, dtype="uint16")
+        self.count_some = np.zeros(shape, dtype="uint16")
+
+    def state(self):
+        '''
+        Counts as a dictionary of arrays, which can be saved and passed to
+        from_state to carry on accumulating (e.g., as new data arrive)
+        '''
+        return {"count_wet": self.count_wet,
+                "count_clear": self.count_clear,
+                "count_some": self.count_some}
+
+    @classmethod
+    def from_state(cls, state):
+        '''
+        Create counts from the dictionary returned by state()
+        '''
+        counts = cls(state["count_wet"].shape)
+        for name in ("count_wet", "count_clear", "count_some"):
+            getattr(counts, name)[:] = state[name]
+        return counts
+
+    def update(self, water):
+        '''
+        Add a (time, y, x) array of water observation flags
+        '''
+        for water_t in water:
+            # wet: only the water bit set, dry: no bits set
+            wet = water_t == 128
+            self.count_wet += wet
+            self.count_clear += wet | (water_t == 0)
+            # some: not nodata or non-contiguous (lowest two bits)
+            self.count_some += (water_t & 0b11) == 0
+
+    def result(self, coords, nodata=-999):
+        '''
+        WOfS summary dataset with count_wet, count_clear and frequency
+        '''
+        with np.errstate(divide="ignore", invalid="ignore"):
+            frequency = np.where(
+                self.count_clear > 0,
+                self.count_wet / self.count_clear.astype("float32"),
+                np.nan,
+            ).astype("float32")
+
+        is_ok = self.count_some > 0
+        count_wet = np.where(is_ok, self.count_wet, nodata).astype("int16")
+        count_clear = np.where(is_ok, self.count_clear, nodata).astype("int16")
+
+        dims = ("y", "x")
         return xr.Dataset(
             dict(
-                count_wet=count_wet,
-                count_clear=count_clear,
-                frequency=frequency,
-            )
+                count_wet=xr.DataArray(count_wet, dims=dims, attrs={"nodata": nodata}),
+                count_clear=xr.DataArray(count_clear, dims=dims, attrs={"nodata": nodata}),
+                frequency=xr.DataArray(frequency, dims=dims),
+            ),
+            coords=coords,
         )
-    
-    
-    def compute(self, data):
-        
-        # rename bands, needed for xr_geomedian function
-        data = data.rename({
+
+
+class WOfS(Transformation):
+    '''
+    Load in Landsat SR and DEM to generate wofs summary for PNG on EASI ASIA 
+                
+    '''
+
+    def __init__(self, time_chunk=8):
+        """
+        time_chunk: number of time steps to classify at once, bounds memory use
+        """
+        self.time_chunk = time_chunk
+
+    def prepare(self, data):
+        '''
+        Rename bands of the Landsat data to those the WOfS classifier expects
+        '''
+        return data.rename({
             "blue": "nbart_blue",
             "green": "nbart_green",
             "red": "nbart_red",
@@ -55,49 +224,48 @@ class WOfS(Transformation):
             "qa_pixel": "fmask"
         })
 
+    def accumulate(self, data, counts):
+        '''
+        Classify water in a (time, y, x) prepared dataset, a chunk of time
+        steps at a time, adding to WOfSCounts
+        '''
         # need a ODC dataset to use for a like call in the load DEM
         data_time_drop = data.isel(time=0)
         data_time_drop = data_time_drop.drop('time')
-        
-        # load DEM
-        dem = dc.load(product="copernicus_dem_30", like=data_time_drop)
-        elevation = dem.elevation
-        
-        # Need to save out DEM (fetched in WOfS function) - create a temp file to store this
-        temp_dem_file = tempfile.mkstemp(prefix="le_lccs_dem_", suffix=".tif")[1]
-
-        dem_path = Path(temp_dem_file)
-        dem_path.parent.mkdir(parents=True, exist_ok=True)
-        elevation.rio.to_raster(dem_path)        
-        
-        # run the WOfS classifier
-        transform = WOfSClassifier(c2_scaling=True, dsm_path=temp_dem_file)
-
-        # Compute the WOFS layer
-        wofl = transform.compute(data)
-        
-        # Rename dimensions as required
-        wofl = wofl.rename({"x": "longitude", "y": "latitude"})
-        
-        wofl["bad"] = (wofl.water & 0b0111_1110) > 0
-        wofl["some"] = apply_numexpr("((water<<30)>>30)==0", wofl, name="some")
-        wofl["dry"] = wofl.water == 0
-        wofl["wet"] = wofl.water == 128
-        wofl = wofl.drop_vars("water")
-        for dv in wofl.data_vars.values():
-            dv.attrs.pop("nodata", None)
-
-        summary = self.reduce(wofl)
+
+        # DEM (fetched in WOfS function) is passed as an in-memory file,
+        # which is kept open until the classifier is done with it
+        with get_dem_file(data_time_drop) as dem_file:
+            # run the WOfS classifier
+            transform = WOfSClassifier(c2_scaling=True, dsm_path=dem_file)
+
+            for start in range(0, data.sizes["time"], self.time_chunk):
+                wofl = transform.compute(data.isel(time=slice(start, start + self.time_chunk)))
+                counts.update(wofl.water.transpose("time", "y", "x").values)
+
+    def summarise(self, counts, coords):
+        '''
+        WOfS frequency from accumulated WOfSCounts
+        '''
+        summary = counts.result(coords)
         # drop count data variables (leaving on wofs frequency)
-        wofs = summary.drop_vars(['count_wet', 'count_clear'])
-
-        # Re-rename dimensions as required
-        wofs = wofs.rename({"longitude": "x", "latitude": "y"})
-        
-        # Remove temp DEM file
-        os.remove(temp_dem_file)
-        
-        return wofs
+        return summary.drop_vars(['count_wet', 'count_clear'])
+
+    def compute(self, data):
+
+        data = self.prepare(data)
+        coords = data.isel(time=0, drop=True).coords
+
+        # Compute the WOFS layer a chunk of time steps at a time and
+        # accumulate the summary counts for each year. Multiple years are
+        # returned along time, labelled by year start.
+        summaries = {}
+        for year, year_data in split_years(data):
+            counts = WOfSCounts((data.sizes["y"], data.sizes["x"]))
+            self.accumulate(year_data, counts)
+            summaries[year] = self.summarise(counts, coords)
+
+        return stack_years(summaries)
 
     def measurements(self, input_measurements):
         return {'wofs': Measurement(name='frequency', dtype='float32', nodata=float('nan'), units='1')}
@@ -0,0 +1,36 @@
+'''
+Helpers for transformations which summarise each calendar year of a time
+series (e.g., fractional_cover and WOfS), so a multi-year stack can be
+loaded once and reduced to one layer per year.
+'''
+import numpy as np
+import xarray as xr
+
+
+def split_years(data):
+    '''
+    Split a dataset with a time dimension into (year, dataset) pairs, one for
+    each calendar year with observations
+    '''
+    years = data.time.dt.year.values
+    for year in np.unique(years):
+        yield int(year), data.isel(time=np.flatnonzero(years == year))
+
+
+def stack_years(summaries):
+    '''
+    Combine a dictionary of {year: summary} layers. A single year is
+    returned as it is (e.g., 2D) with the start of the year as a scalar time
+    coordinate, multiple years are stacked along time, labelled with the
+    start of each year.
+    '''
+    years = sorted(summaries)
+    year_start = np.array([f'{year}-01-01' for year in years], dtype='datetime64[ns]')
+
+    if len(years) == 1:
+        return summaries[years[0]].assign_coords(time=year_start[0])
+
+    return xr.concat(
+        [summaries[year] for year in years],
+        dim=xr.DataArray(year_start, dims='time', name='time'),
+    )
@@ -0,0 +1,57 @@
+'''
+Shared datacube connection for the le_plugins transforms and the LCCS
+classification scripts.
+
+Each process has a single Datacube, created the first time it is needed and
+reused afterwards (e.g., for every tile processed by a worker), rather than
+each module opening its own connection at import time. Threads (e.g., dask
+workers) share the connection. A process forked from one which already has a
+connection creates its own, as database connections can't be shared between
+processes.
+'''
+import atexit
+import os
+import threading
+
+import datacube
+
+_lock = threading.Lock()
+_dc = None
+# Connections inherited through fork. These are kept referenced and never
+# closed in the child, so the parent's database sessions aren't terminated.
+_inherited = []
+
+
+def get_datacube(app="le_lccs"):
+    '''
+    Get the datacube connection for this process, creating it if needed.
+    `app` is only used when the connection is created.
+    '''
+    global _dc
+    with _lock:
+        if _dc is None:
+            _dc = datacube.Datacube(app=app)
+        return _dc
+
+
+@atexit.register
+def close_datacube():
+    '''
+    Close the datacube connection for this process, if one has been created
+    '''
+    global _dc
+    with _lock:
+        if _dc is not None:
+            _dc.close()
+        _dc = None
+
+
+def _reset_after_fork():
+    global _lock, _dc
+    _lock = threading.Lock()
+    if _dc is not None:
+        _inherited.append(_dc)
+    _dc = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,65 +1,329 @@
 from datacube.virtual import construct, Transformation, Measurement
+import warnings
+import numpy as np
 import xarray as xr
+import dask.array as da
 import datacube
 from datacube.utils import masking
 
 from fc.fractional_cover import fractional_cover as f_cover
 
+from annual import split_years, stack_years
+
+# Fractional cover output bands
+FC_BANDS = ["PV", "NPV", "BS", "UE"]
+
+
+def unmix_block(data):
+    '''
+    Run fractional cover unmixing on each time step of a (time, y, x) block,
+    writing the results straight into preallocated float32 arrays.
+    Negative (nodata) values are set to NaN.
+    '''
+    shape = (data.sizes['time'], data.sizes['y'], data.sizes['x'])
+    out = {band: np.empty(shape, dtype='float32') for band in FC_BANDS}
+
+    for i in range(shape[0]):
+        ds_fc_t = f_cover(data.isel(time=i))
+        for band in FC_BANDS:
+            values = ds_fc_t[band].transpose('y', 'x').values
+            out[band][i] = np.where(values >= 0, values, np.nan)
+
+    return xr.Dataset(
+        {band: (('time', 'y', 'x'), out[band]) for band in FC_BANDS},
+        coords=data.coords,
+    )
+
+
+def unmix(data):
+    '''
+    Run fractional cover unmixing over the time axis of a (time, y, x) dataset.
+
+    For dask backed data each chunk is unmixed in parallel with the dask
+    scheduler and stored directly into the preallocated output, rather than
+    building a list of time slices and concatenating them.
+    '''
+    if not data.chunks:
+        return unmix_block(data)
+
+    like = data[list(data.data_vars)[0]].transpose('time', 'y', 'x')
+    template = xr.Dataset({band: like.astype('float32') for band in FC_BANDS})
+    blocks = xr.map_blocks(unmix_block, data, template=template)
+
+    out = {band: np.empty(like.shape, dtype='float32') for band in FC_BANDS}
+    da.store([blocks[band].data for band in FC_BANDS],
+             [out[band] for band in FC_BANDS],
+             lock=False)
+
+    return xr.Dataset(
+        {band: (('time', 'y', 'x'), out[band]) for band in FC_BANDS},
+        coords=like.coords,
+    )
+
+
+def _percentile_buffer_size(q, max_count):
+    '''
+    Number of largest values needed for the percentile of up to max_count values
+    '''
+    return max(n - int(np.floor(q * (n - 1))) for n in range(1, max(max_count, 1) + 1))
+
+
+class StreamingMean:
+    '''
+    Per-pixel mean of a stream of (time, y, x) blocks, skipping NaN values.
+
+    :param tuple shape: (y, x) shape of each time step.
+    '''
+
+    def __init__(self, shape):
+        self.total = np.zeros(shape, dtype='float64')
+        self.count = np.zeros(shape, dtype='uint32')
+
+    def update(self, block):
+        '''
+        Add a (time, y, x) block of observations, NaN values are skipped
+        '''
+        valid = ~np.isnan(block)
+        self.count += valid.sum(axis=0, dtype='uint32')
+        self.total += np.where(valid, block, 0).sum(axis=0, dtype='float64')
+
+    def state(self):
+        '''
+        Sum and counts as a dictionary of arrays, which can be saved and
+        passed to from_state to carry on adding observations
+        '''
+        return {'total': self.total, 'count': self.count}
+
+    @classmethod
+    def from_state(cls, state):
+        '''
+        Create a mean from the dictionary returned by state()
+        '''
+        reducer = cls(state['count'].shape)
+        reducer.total = np.asarray(state['total'], dtype='float64')
+        reducer.count = np.asarray(state['count'], dtype='uint32')
+        return reducer
+
+    def result(self):
+        '''
+        Mean for each pixel, NaN where there were no observations
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.total / self.count, np.nan).astype('float32')
+
+
+def reducer_from_state(state):
+    '''
+    Create a StreamingMean or StreamingPercentile from its saved state()
+    '''
+    if 'top' in state:
+        return StreamingPercentile.from_state(state)
+    return StreamingMean.from_state(state)
+
+
+class StreamingPercentile:
+    '''
+    Exact per-pixel percentile of a stream of (time, y, x) blocks, using
+    bounded memory.
+
+    The percentile (with linear interpolation, as numpy.quantile) of n
+    values only depends on the largest n - floor(q * (n - 1)) of them, so
+    rather than holding the whole time stack only that many of the largest
+    values seen so far are kept for each pixel. Each new block is merged
+    into this sorted buffer and the smallest values are dropped.
+
+    If a pixel gets more than max_count observations (e.g., an incremental
+    update of a tile with overlapping paths) the buffer is grown to fit,
+    with a warning, as values dropped before then can't be recovered: the
+    percentile of those pixels is taken from the values which were kept,
+    so may be higher than the exact percentile.
+
+    :param float q: quantile to compute, between 0 and 1.
+    :param int max_count: maximum number of observations for a pixel
+                          (i.e., the number of time steps).
+    :param tuple shape: (y, x) shape of each time step.
+    '''
+
+    def __init__(self, q, max_count, shape):
+        self.q = q
+        self.max_count = max_count
+        self.k = _percentile_buffer_size(q, max_count)
+        self.top = np.full((self.k,) + tuple(shape), -np.inf, dtype='float32')
+        self.count = np.zeros(shape, dtype='uint16')
+
+    def _grow(self, max_count):
+        '''
+        Grow the buffer for up to max_count observations
+        '''
+        warnings.warn(f'More than {self.max_count} observations for a pixel, growing the '
+                      f'percentile buffer to {max_count} (the percentile may not be exact)')
+        k = _percentile_buffer_size(self.q, max_count)
+        self.top = np.concatenate(
+            [np.full((k - self.k,) + self.top.shape[1:], -np.inf, dtype='float32'), self.top], axis=0
+        )
+        self.max_count = max_count
+        self.k = k
+
+    def update(self, block):
+        '''
+        Add a (time, y, x) block of observations, NaN values are skipped
+        '''
+        valid = ~np.isnan(block)
+        self.count += valid.sum(axis=0, dtype='uint16')
+        max_count = int(self.count.max(initial=0))
+        if max_count > self.max_count:
+            # with headroom, so later updates don't grow it again
+            self._grow(max(max_count, 2 * self.max_count))
+
+        merged = np.concatenate([self.top, np.where(valid, block, -np.inf).astype('float32')], axis=0)
+        # Keep the k largest values for each pixel
+        self.top = np.partition(merged, merged.shape[0] - self.k, axis=0)[-self.k:]
+
+    def state(self):
+        '''
+        Buffer and counts as a dictionary of arrays, which can be saved and
+        passed to from_state to carry on adding observations
+        '''
+        return {'q': np.float64(self.q), 'max_count': np.int64(self.max_count),
+                'top': self.top, 'count': self.count}
+
+    @classmethod
+    def from_state(cls, state):
+        '''
+        Create a percentile from the dictionary returned by state()
+        '''
+        reducer = cls(float(state['q']), int(state['max_count']), state['count'].shape)
+        reducer.top = np.asarray(state['top'], dtype='float32')
+        reducer.count = np.asarray(state['count'], dtype='uint16')
+        return reducer
+
+    def result(self):
+        '''
+        Percentile for each pixel, NaN where there were no observations
+        '''
+        top = np.sort(self.top, axis=0)
+        n = self.count.astype('int64')
+
+        # Position of the percentile in all n values, as numpy 'linear' interpolation
+        position = self.q * np.maximum(n - 1, 0)
+        lower = np.floor(position)
+        fraction = (position - lower).astype('float32')
+
+        # Index of the values either side of the percentile in the buffer of
+        # the k largest values, limited to the values kept (all of those
+        # needed unless the buffer has been grown)
+        kept = np.isfinite(top).sum(axis=0)
+        lower_index = np.clip(self.k - n + lower.astype('int64'), self.k - kept, self.k - 1)
+        upper_index = np.minimum(lower_index + 1, self.k - 1)
+        lower_value = np.take_along_axis(top, lower_index[np.newaxis], axis=0)[0]
+        upper_value = np.take_along_axis(top, upper_index[np.newaxis], axis=0)[0]
+
+        percentile = lower_value + (upper_value - lower_value) * fraction
+        # avoid inf - inf where only the lower value is needed
+        percentile = np.where(fraction > 0, percentile, lower_value)
+        return np.where(n > 0, percentile, np.nan).astype('float32')
+
+
 class fractional_cover(Transformation):
     '''
-    Load in Landsat SR to generate fraction cover summary for PNG on EASI ASIA                 
+    Load in Landsat SR to generate fraction cover summary for PNG on EASI ASIA
     '''
 
-    def compute(self, data):
-    
+    def __init__(self, quantile=0.9, time_chunk=8, observation_percentile=False):
+        """
+        quantile: percentile of the observations of each year to calculate,
+            only used with observation_percentile
+        time_chunk: number of time steps to unmix at once, bounds memory use
+        observation_percentile: output the percentile of the observations of
+            each year (e.g., PV_PC_90). By default the annual mean of each
+            band is output (e.g., PV_MEAN), which is what the percentile of
+            the annual mean gave before.
+        """
+        self.quantile = quantile
+        self.time_chunk = time_chunk
+        self.observation_percentile = observation_percentile
+
+    def reducers(self, shape, max_count):
+        '''
+        Reducers for each band (annual mean, or percentile of up to max_count
+        observations) of a (y, x) grid
+        '''
+        if not self.observation_percentile:
+            return {band: StreamingMean(shape) for band in FC_BANDS}
+        return {band: StreamingPercentile(self.quantile, max_count, shape)
+                for band in FC_BANDS}
+
+    def accumulate(self, data, reducers):
+        '''
+        Unmix a (time, y, x) prepared dataset in chunks of time steps, adding
+        each band to its reducer
+        '''
+        for start in range(0, data.sizes['time'], self.time_chunk):
+            ds_fc = unmix(data.isel(time=slice(start, start + self.time_chunk)))
+            for band in FC_BANDS:
+                reducers[band].update(ds_fc[band].values)
+
+    def output_name(self, band):
+        '''
+        Name of the summary of a band, e.g., PV_MEAN or (for the percentile
+        of the observations) PV_PC_90
+        '''
+        if not self.observation_percentile:
+            return f'{band}_MEAN'
+        return f'{band}_PC_{int(round(self.quantile * 100))}'
+
+    def summarise(self, reducers, coords):
+        '''
+        Summary (named by output_name) of each band from the reducers
+        '''
+        return xr.Dataset(
+            {self.output_name(band): (('y', 'x'), reducers[band].result())
+             for band in FC_BANDS},
+            coords=coords,
+        )
+
+    def reduce(self, data):
+        '''
+        Unmix a (time, y, x) dataset in chunks of time steps and reduce each
+        band, without holding the whole time stack
+        '''
+        reducers = self.reducers((data.sizes['y'], data.sizes['x']), data.sizes['time'])
+        self.accumulate(data, reducers)
+        return self.summarise(reducers, data.isel(time=0, drop=True).coords)
+
+    def prepare(self, data):
+        '''
+        Rename bands of the Landsat data and mask nodata and cloud
+        '''
         # Rename the data variables to match the fractional cover function's requirements
         data = data.rename({
             "nir08": "nir",
             "swir16": "swir1",
             "swir22": "swir2",
             "qa_pixel": "fmask"
-        })   
-        
+        })
+
         # Make a mask array for the nodata value
         valid_mask = masking.valid_data_mask(data)
-        
+
         # Make a cloud mask (landsat8_c2l2_sr)
         # Multiple flags are combined as logical AND (bitwise)
         cloud_mask = masking.make_mask(data['fmask'], clear='clear')
 
         # Apply each of the masks
-        filtered_data = data.where(valid_mask & cloud_mask)
-        
-        # create ds_fc for each time step and concatenate them along time dimension
-        ds_fc_list = []
-        for t in filtered_data.time:
-            ds_t = filtered_data.sel(time=t)
-            ds_fc_t = f_cover(ds_t)
-            ds_fc_list.append(ds_fc_t)
-
-        ds_fc = xr.concat(ds_fc_list, dim='time').transpose('time', 'y', 'x')
-        # correct times added back in
-        ds_fc['time'] = filtered_data.time
-
-        # replace negative values with NaN
-        ds_fc = ds_fc.where(ds_fc >= 0)  
-
-        # Resample to annual frequency and skip NaN values
-        ds_fc = ds_fc.resample(time='A').mean(skipna=True)
-
-        # Calculate percentiles
-        fc_percentile = ds_fc.quantile(q=[0.9], dim='time')
-
-        # Convert to percentages and rename variables
-        # fc_percentile_annual = fc_percentile_annual * 100
-        fc_percentile = fc_percentile.rename({'PV': 'PV_PC_90',
-                                                            'NPV': 'NPV_PC_90',
-                                                            'BS': 'BS_PC_90',
-                                                            'UE': 'UE_PC_90'})
-        # remove 'quantile' dim
-        fc_percentile = fc_percentile.squeeze()
-
-        return fc_percentile
+        return data.where(valid_mask & cloud_mask)
+
+    def compute(self, data):
+
+        filtered_data = self.prepare(data)
+
+        # Calculate the annual summary of each year, streaming unmixed time
+        # steps through the reducer (negative values are skipped): the annual
+        # mean, or the percentile of the observations if observation_percentile
+        # is set.
+        # Multiple years are returned along time, labelled by year start.
+        return stack_years({year: self.reduce(year_data)
+                            for year, year_data in split_years(filtered_data)})
 
     def measurements(self, input_measurements):
         return {'fc_percentile': Measurement(name='fc_percentile', dtype='float32', nodata=float('nan'), units='1')}
@@ -0,0 +1,243 @@
+'''
+Portable format and predictor for tree ensemble regression models (e.g., the
+WCF random forest).
+
+sklearn models are pickled with the internals of the sklearn version which
+trained them, so they are tied to that version and slow to load. Here the
+trees of an ensemble are flattened into arrays (concatenated node arrays with
+the root of each tree), saved as a .npz with no pickled objects, and predicted
+with a numba loop over each tree and pixel. The trees are read from the pickle
+without sklearn, so any version of sklearn (or none) can export a model.
+
+Export a model (and check it predicts the same as the pickled model, where
+the pickle can be loaded with the installed sklearn):
+
+    python tree_model.py model.pickle model.npz --check
+
+'''
+import argparse
+import io
+import pickle
+
+import numba
+import numpy as np
+
+# Version of the .npz format
+TREE_MODEL_FORMAT = 1
+# Child index of leaf nodes (as sklearn)
+TREE_LEAF = -1
+# Bands (in order) the WCF model was trained on, kept here rather than in
+# WCF.py so training and exporting don't need datacube
+WCF_BANDS = ["blue", "green", "red", "nir", "swir1", "swir2"]
+
+
+class _PickledObject:
+    '''
+    Stand in for sklearn classes when reading a pickle, keeping the
+    constructor arguments and state
+    '''
+
+    def __init__(self, *args):
+        self.args = args
+        self.state = {}
+
+    def __setstate__(self, state):
+        self.state = state
+
+
+class _ModelUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module.split('.')[0] == 'sklearn':
+            return type(name, (_PickledObject,), {'module': module})
+        return super().find_class(module, name)
+
+
+def read_pickled_forest(model_pickle):
+    '''
+    Read the trees of a pickled sklearn forest or tree regressor (e.g.,
+    RandomForestRegressor), without sklearn. Returns a dictionary of
+    flattened tree arrays, as saved by export.
+    '''
+    with open(model_pickle, 'rb') as f:
+        return _forest_arrays(_ModelUnpickler(f).load())
+
+
+def sklearn_forest_arrays(model):
+    '''
+    Flattened tree arrays of a fitted sklearn tree regressor (e.g., one
+    which has just been trained), as read_pickled_forest
+    '''
+    return _forest_arrays(_ModelUnpickler(io.BytesIO(pickle.dumps(model))).load())
+
+
+def _forest_arrays(model):
+
+    if type(model).__name__ not in ('RandomForestRegressor', 'ExtraTreesRegressor',
+                                    'DecisionTreeRegressor', 'ExtraTreeRegressor'):
+        raise ValueError(f'Unsupported model {type(model).__name__}, '
+                         'only averaging tree regressors can be exported')
+    if model.state.get('n_outputs_', 1) != 1:
+        raise ValueError('Only models with a single output can be exported')
+
+    estimators = model.state.get('estimators_', [model])
+    trees = [estimator.state['tree_'].state for estimator in estimators]
+
+    roots = np.cumsum([0] + [tree['node_count'] for tree in trees[:-1]]).astype('int32')
+    nodes = np.concatenate([tree['nodes'] for tree in trees])
+    # Offset child indices of each tree to index the concatenated nodes
+    offsets = np.repeat(roots, [tree['node_count'] for tree in trees])
+
+    def children(field):
+        child = nodes[field].astype('int32')
+        return np.where(child == TREE_LEAF, TREE_LEAF, child + offsets).astype('int32')
+
+    feature_names = model.state.get('feature_names_in_')
+    # Child NaN features go to, only in models trained with sklearn >= 1.3
+    # (before which NaN features compared as above the threshold)
+    if 'missing_go_to_left' in nodes.dtype.names:
+        missing_left = nodes['missing_go_to_left'].astype('uint8')
+    else:
+        missing_left = np.zeros(nodes.shape, dtype='uint8')
+    return {
+        'format': np.int32(TREE_MODEL_FORMAT),
+        'n_features': np.int32(model.state['n_features_in_']),
+        'feature_names': np.array([] if feature_names is None
+                                  else [str(name).strip() for name in feature_names]),
+        'roots': roots,
+        'left': children('left_child'),
+        'right': children('right_child'),
+        'feature': nodes['feature'].astype('int32'),
+        'threshold': nodes['threshold'].astype('float64'),
+        'missing_left': missing_left,
+        'value': np.concatenate([tree['values'][:, 0, 0] for tree in trees]).astype('float64'),
+    }
+
+
+def export(model_pickle, out_npz):
+    '''
+    Export a pickled sklearn tree regressor to a .npz of flattened trees
+    '''
+    np.savez_compressed(out_npz, **read_pickled_forest(model_pickle))
+
+
+def export_sklearn(model, out_npz):
+    '''
+    Export a fitted sklearn tree regressor to a .npz of flattened trees
+    '''
+    np.savez_compressed(out_npz, **sklearn_forest_arrays(model))
+
+
+@numba.njit(nogil=True, cache=True)
+def _predict(features, roots, left, right, feature, threshold, missing_left, value):
+    # Trees are walked one at a time for all samples (as sklearn), which
+    # keeps each tree's nodes in cache. Leaves have no children (0).
+    out = np.zeros(features.shape[0], dtype=np.float64)
+    for t in range(roots.size):
+        root = roots[t]
+        for i in range(features.shape[0]):
+            node = root
+            while left[node] != 0:
+                x = features[i, feature[node]]
+                if np.isnan(x):
+                    node = left[node] if missing_left[node] else right[node]
+                elif x <= threshold[node]:
+                    node = left[node]
+                else:
+                    node = right[node]
+            out[i] += value[node]
+    return out / roots.size
+
+
+class TreeEnsemble:
+    '''
+    Averaging ensemble of regression trees exported with export, e.g.,
+
+        model = TreeEnsemble.load('model.npz')
+        predicted = model.predict(features)
+
+    Prediction releases the GIL, so batches can be predicted in parallel threads.
+    '''
+
+    def __init__(self, arrays):
+        if int(arrays['format']) != TREE_MODEL_FORMAT:
+            raise ValueError(f'Unsupported tree model format {int(arrays["format"])}')
+        self.n_features = int(arrays['n_features'])
+        self.feature_names = [str(name) for name in arrays['feature_names']]
+
+        # Unsigned indices avoid negative index handling when walking trees,
+        # with 0 (the root of the first tree, which is never a child) for leaves
+        left = arrays['left']
+        right = arrays['right']
+        is_leaf = left == TREE_LEAF
+        # Features are float32, so compare with the largest float32 which
+        # is <= each (float64) threshold, which gives the same splits
+        threshold = arrays['threshold'].astype(np.float32)
+        above = threshold.astype(np.float64) > arrays['threshold']
+        threshold[above] = np.nextafter(threshold[above], np.float32(-np.inf))
+
+        self.trees = (
+            arrays['roots'].astype(np.uint32),
+            np.where(is_leaf, 0, left).astype(np.uint32),
+            np.where(is_leaf, 0, right).astype(np.uint32),
+            np.where(is_leaf, 0, arrays['feature']).astype(np.uint32),
+            threshold,
+            # Exported before NaN features were handled: NaN goes right
+            arrays.get('missing_left', np.zeros(left.shape, dtype=np.uint8)).astype(np.uint8),
+            arrays['value'].astype(np.float64),
+        )
+
+    @classmethod
+    def load(cls, model_npz):
+        with np.load(model_npz, allow_pickle=False) as arrays:
+            return cls(dict(arrays))
+
+    def predict(self, features):
+        '''
+        Predict for a (samples, features) array. Features are compared as
+        float32, as sklearn trees, and NaN features go to the child sklearn
+        sends them to.
+        '''
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if features.ndim != 2 or features.shape[1] != self.n_features:
+            raise ValueError(f'Expected (samples, {self.n_features}) features, got {features.shape}')
+        return _predict(features, *self.trees)
+
+
+def check_parity(model_pickle, model_npz, n_samples=100000, low=0.0, high=0.6, seed=0):
+    '''
+    Check an exported model predicts the same as the pickled model (loaded
+    with sklearn, so this needs the version the model was pickled with) on
+    random features between low and high (e.g., surface reflectance).
+    Returns the maximum absolute difference.
+    '''
+    with open(model_pickle, 'rb') as f:
+        model = pickle.load(f)
+    exported = TreeEnsemble.load(model_npz)
+
+    rng = np.random.default_rng(seed)
+    features = rng.uniform(low, high, (n_samples, exported.n_features)).astype(np.float32)
+    return float(np.abs(model.predict(features) - exported.predict(features)).max())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export a pickled sklearn tree regressor to a portable .npz'
+    )
+    parser.add_argument('model_pickle', help='Pickled sklearn model')
+    parser.add_argument('out_npz', help='Output .npz file')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='Check the exported model predicts the same as the pickled model')
+    args = parser.parse_args(argv)
+
+    export(args.model_pickle, args.out_npz)
+    print(f'Exported {args.model_pickle} to {args.out_npz}')
+
+    if args.check:
+        difference = check_parity(args.model_pickle, args.out_npz)
+        print(f'Maximum difference from pickled model: {difference}')
+        if difference > 1e-6:
+            raise SystemExit('Exported model does not match pickled model')
+
+
+if __name__ == '__main__':
+    main()
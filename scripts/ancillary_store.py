@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Store of the static ancillary layers used by the LCCS classification,
+pre-rasterised / reprojected onto the grid of each tile:
+
+* mangrove: GMW 2020 mangroves (uint8 mask)
+* tidal_wetland: Murray tidal wetland probability (2017-2019)
+* woody: woodyarti (S1-derived woody)
+* artificial: OSM buildings, airports and roads (uint8 mask)
+
+These don't change between runs, so rather than rasterising the vector
+layers and reprojecting the rasters for every classification they are
+computed once per tile and stored as a chunked zarr group for each tile,
+which the classification reads lazily, e.g.:
+
+    ancillary_store.py -o ancillary/ -t all
+    le_lccs_png_level4.py -o out/ -t 10-20 --ancillary_store ancillary/
+
+"""
+import argparse
+import os
+import sys
+import warnings
+
+warnings.filterwarnings("ignore")
+
+import fsspec
+import numpy as np
+import xarray as xr
+import geopandas as gpd
+
+from datacube.api.query import Query
+from datacube.utils import geometry
+
+# Layers held in the store
+ANCILLARY_LAYERS = ["mangrove", "tidal_wetland", "woody", "artificial"]
+# Layers rasterised from vectors, which are stored as uint8 masks. Others are
+# stored in the data type of their source.
+RASTERISED_LAYERS = ["mangrove", "artificial"]
+# Size of chunks (pixels in x and y), matches the classification blocks
+ANCILLARY_CHUNK_SIZE = 512
+
+
+def tile_path(store, tile_id):
+    """
+    Get the path of the zarr group for a tile within a store
+    """
+    return os.path.join(store, f"tile_{tile_id:03}.zarr")
+
+
+def tile_exists(store, tile_id):
+    """
+    Check if a tile has been written to a store (local or remote)
+    """
+    return ".zmetadata" in fsspec.get_mapper(tile_path(store, tile_id))
+
+
+def tile_geobox(query):
+    """
+    Get the grid a datacube query is loaded onto (as datacube.load).
+
+    :param dict query: query with latitude, longitude, output_crs and resolution.
+
+    """
+    geopolygon = Query(latitude=query["latitude"], longitude=query["longitude"]).geopolygon
+    return geometry.GeoBox.from_geopolygon(
+        geopolygon, resolution=query["resolution"], crs=query["output_crs"]
+    )
+
+
+def geobox_like(geobox):
+    """
+    Create a layer of zeros on a grid, to rasterise / reproject onto
+    """
+    return xr.DataArray(
+        np.zeros(geobox.shape, dtype=np.uint8),
+        coords=geobox.xr_coords(with_crs=True),
+        dims=geobox.dimensions,
+    )
+
+
+def write_tile(store, tile_id, layers, chunk_size=ANCILLARY_CHUNK_SIZE):
+    """
+    Write the ancillary layers for a tile to a store.
+
+    :param str store: directory (or URL) of the store.
+    :param int tile_id: ID of the tile.
+    :param dict layers: layers named as ANCILLARY_LAYERS, all on the tile grid.
+    :param int chunk_size: size of chunks (pixels) in x and y.
+
+    """
+    ancillary = xr.Dataset(
+        {
+            name: layers[name].astype(np.uint8) if name in RASTERISED_LAYERS else layers[name]
+            for name in ANCILLARY_LAYERS
+        }
+    )
+    for name in ancillary.data_vars:
+        ancillary[name].encoding = {}
+    ancillary = ancillary.chunk({"y": chunk_size, "x": chunk_size})
+    ancillary.to_zarr(tile_path(store, tile_id), mode="w", consolidated=True)
+
+
+def read_tile(store, tile_id, like):
+    """
+    Read the ancillary layers for a tile from a store. Layers are read
+    lazily (dask backed) a chunk at a time.
+
+    Returns None if the tile isn't in the store or was stored for a
+    different grid to `like`, so the layers need to be computed.
+
+    :param str store: directory (or URL) of the store.
+    :param int tile_id: ID of the tile.
+    :param xr.DataArray like: layer on the grid of the classification.
+
+    """
+    if not tile_exists(store, tile_id):
+        return None
+
+    ancillary = xr.open_zarr(tile_path(store, tile_id), consolidated=True)
+    if ancillary.geobox != like.geobox:
+        print(f"Ancillary layers for tile {tile_id} are on a different grid, not using")
+        return None
+
+    # Use the coordinates of the classification grid
+    return ancillary.assign_coords(like.coords)
+
+
+def precompute_tile(store, tile_id, bounds_gdf, vectors=None, chunk_size=ANCILLARY_CHUNK_SIZE):
+    """
+    Rasterise / reproject the ancillary layers for a tile and write them to
+    a store.
+
+    :param str store: directory (or URL) of the store.
+    :param int tile_id: ID of the tile.
+    :param gpd.GeoDataFrame bounds_gdf: tile bounds.
+    :param VectorCache vectors: cache of vector layers.
+    :param int chunk_size: size of chunks (pixels) in x and y.
+
+    """
+    # The loaders are shared with the classification
+    import le_lccs_png_level4 as lccs
+
+    query, bbox = lccs.get_tile_query(bounds_gdf, tile_id)
+    like = geobox_like(tile_geobox(query))
+    layers = {
+        "mangrove": lccs.load_mangroves(bbox, like, vectors),
+        "tidal_wetland": lccs.load_tidal_wetland(like),
+        "woody": lccs.load_woody(like),
+        "artificial": lccs.load_artificial_surfaces(bbox, like, vectors),
+    }
+    write_tile(store, tile_id, layers, chunk_size)
+
+
+def main(argv=None):
+    import le_lccs_png_level4 as lccs
+    from datacube.utils.aws import configure_s3_access
+    from vector_cache import VectorCache
+
+    parser = argparse.ArgumentParser(
+        description="Precompute ancillary layers for the LCCS classification on the tile grid"
+    )
+    parser.add_argument(
+        "-o", "--store", help="Directory (or URL) of ancillary store", required=True
+    )
+    parser.add_argument(
+        "-t",
+        "--tile_id",
+        help="Tile IDs, ranges of IDs (e.g., 10-20) or 'all'",
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "--tile_bounds",
+        help="Vector file with bounds of tiles",
+        required=False,
+        default=lccs.PNG_TILES_S3,
+    )
+    parser.add_argument(
+        "--overwrite",
+        help="Overwrite tiles already in the store.",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+
+    lccs.print_data_sources()
+    configure_s3_access(aws_unsigned=False, requester_pays=True)
+
+    bounds_gdf = gpd.read_file(args.tile_bounds)
+    vectors = VectorCache()
+
+    failed = {}
+    for tile_id in lccs.parse_tile_ids(args.tile_id, bounds_gdf):
+        if tile_exists(args.store, tile_id) and not args.overwrite:
+            print(f"Tile {tile_id} is already in {args.store}, skipping")
+            continue
+        print(f"Precomputing ancillary layers for tile {tile_id}...")
+        try:
+            precompute_tile(args.store, tile_id, bounds_gdf, vectors)
+        except Exception as err:
+            print(f"Tile {tile_id} failed: {err}")
+            failed[tile_id] = err
+
+    if failed:
+        print(f"{len(failed)} tiles failed: {sorted(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Content addressed cache of the intermediate layers of the LCCS
+classification (e.g., fractional cover percentiles, WOfS frequency and
+rasterised ancillary layers) for each tile.
+
+Each entry is keyed by a hash of the layer name, tile, query (including the
+time range) and the code and parameters used to compute it, so changing a
+classification threshold reuses the cached inputs while changing a plugin or
+the virtual product catalog recomputes them. Entries are stored as zarr on
+local disk or under an S3 prefix, and the least recently used entries are
+evicted once the cache grows beyond a maximum size. The size of each entry
+is recorded with its last use when it is written, so eviction doesn't
+need to list the (possibly remote) files of every entry.
+"""
+import hashlib
+import inspect
+import json
+import os
+import time
+
+import fsspec
+import numpy as np
+import xarray as xr
+
+# Default maximum size of the cache
+CACHE_MAX_BYTES = 50 * 1024**3
+
+
+def code_hash(*objects):
+    """
+    Hash code (modules, classes or functions, by their source), files (by
+    their contents) and values (e.g., thresholds, by their JSON) which
+    determine the result of a computation.
+    """
+    digest = hashlib.sha256()
+    for obj in objects:
+        if inspect.ismodule(obj) or inspect.isclass(obj) or inspect.isroutine(obj):
+            digest.update(inspect.getsource(obj).encode())
+        elif isinstance(obj, str) and os.path.isfile(obj):
+            with open(obj, "rb") as f:
+                digest.update(f.read())
+        else:
+            digest.update(json.dumps(obj, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def _serialisable(attrs):
+    """
+    Attributes which can be written to zarr, others (e.g., CRS objects) are
+    written as strings
+    """
+    return {
+        key: value if isinstance(value, (str, int, float, list, tuple, np.number)) else str(value)
+        for key, value in attrs.items()
+    }
+
+
+class IntermediateCache:
+    """
+    Cache of intermediate layers on local disk or under an S3 prefix.
+
+    :param str location: directory or URL (e.g., s3://bucket/prefix) of the cache.
+    :param int max_bytes: size above which least recently used entries are evicted.
+    :param dict storage_options: options passed to fsspec for remote locations.
+    """
+
+    def __init__(self, location, max_bytes=CACHE_MAX_BYTES, storage_options=None):
+        self.location = location.rstrip("/")
+        self.max_bytes = max_bytes
+        self.fs, _ = fsspec.core.url_to_fs(location, **(storage_options or {}))
+        self.fs.makedirs(self.location, exist_ok=True)
+
+    def key(self, name, tile_id, query, code):
+        """
+        Get the key of a layer.
+
+        :param str name: name of the layer.
+        :param int tile_id: ID of the tile.
+        :param dict query: datacube query (time range, extent, CRS and resolution).
+        :param str code: hash of the code and parameters the layer depends on (see code_hash).
+
+        """
+        return code_hash(
+            {"name": name, "tile_id": tile_id, "query": query, "code": code}
+        )
+
+    def _path(self, key):
+        return f"{self.location}/{key}.zarr"
+
+    def _used_path(self, key):
+        return f"{self.location}/{key}.used"
+
+    def _read_used(self, key):
+        # Last use and size of an entry, size is None for entries written
+        # before sizes were recorded
+        try:
+            with self.fs.open(self._used_path(key), "r") as f:
+                values = (f.read() or "0").split()
+        except FileNotFoundError:
+            return 0.0, None
+        return float(values[0]), int(values[1]) if len(values) > 1 else None
+
+    def _touch(self, key, size=None):
+        # Record when an entry was last used and its size, for eviction.
+        # Access times aren't reliable (or available on S3) so these are
+        # kept alongside.
+        if size is None:
+            _, size = self._read_used(key)
+        if size is None:
+            size = self.fs.du(self._path(key))
+        with self.fs.open(self._used_path(key), "w") as f:
+            f.write(f"{time.time()} {size}")
+
+    def get(self, key):
+        """
+        Get a cached layer as an in memory dataset, None if it isn't in the cache
+        """
+        path = self._path(key)
+        if not self.fs.exists(f"{path}/.zmetadata"):
+            return None
+        data = xr.open_zarr(self.fs.get_mapper(path), consolidated=True).load()
+        self._touch(key)
+        return data
+
+    def put(self, key, data):
+        """
+        Add a layer (xr.Dataset or xr.DataArray) to the cache, evicting least
+        recently used entries if the cache is too large
+        """
+        if isinstance(data, xr.DataArray):
+            data = data.to_dataset(name=data.name or "data")
+        data = data.copy()
+        data.attrs = _serialisable(data.attrs)
+        for var in data.variables.values():
+            var.attrs = _serialisable(var.attrs)
+            var.encoding = {}
+        data.to_zarr(self.fs.get_mapper(self._path(key)), mode="w", consolidated=True)
+        self._touch(key, self.fs.du(self._path(key)))
+        self.evict()
+
+    def get_or_compute(self, key, compute):
+        """
+        Get a layer from the cache, or compute it with `compute()` and add it
+        """
+        data = self.get(key)
+        if data is None:
+            data = compute()
+            self.put(key, data)
+        return data
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is smaller than
+        max_bytes, using the sizes recorded when entries were written
+        """
+        entries = []
+        total = 0
+        for used_file in self.fs.glob(f"{self.location}/*.used"):
+            key = os.path.basename(used_file)[: -len(".used")]
+            last_used, size = self._read_used(key)
+            if size is None:
+                size = self.fs.du(self._path(key)) if self.fs.exists(self._path(key)) else 0
+            entries.append((last_used, key, size))
+            total += size
+
+        for last_used, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print(f"Evicting {key} from intermediate cache")
+            if self.fs.exists(self._path(key)):
+                self.fs.rm(self._path(key), recursive=True)
+            self.fs.rm(self._used_path(key))
+            total -= size
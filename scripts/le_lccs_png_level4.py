@@ -3,20 +3,37 @@
 A script to run through the LCCS classification system for PNG.
 Notebook written by Chris Owers (Chris.Owers@newcastle.edu.au) and Carole Planque (cap33@aber.ac.uk)
 Converted to script by Dan Clewley (dac@pml.ac.uk) and Carole Planque (cap33@aber.ac.uk)
+
+Each stage of the classification is an importable function. Tiles can be run
+one at a time or as a batch sharing a pool of long-lived worker processes, e.g.:
+
+    le_lccs_png_level4.py -o out/ -t 12
+    le_lccs_png_level4.py -o out/ -t 10-20 35 -j 4
+    le_lccs_png_level4.py -o out/ -t all -j 8
+    le_lccs_png_level4.py -o out/ -t 12 --years 2018-2020
 """
 import argparse
+import functools
+import importlib
 import os
 import sys
+import threading
 import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 warnings.filterwarnings("ignore")
 
 import numpy as np
 import xarray as xr
 import geopandas as gpd
+import numba
+import dask.array as da
 import rasterio
+import rasterio.features
+import rasterio.shutil
+from affine import Affine
+from rasterio.windows import Window
 
-import datacube
 from datacube.utils import masking
 from dea_tools.spatial import xr_rasterize
 from datacube.testutils.io import rio_slurp_xarray
@@ -29,12 +46,18 @@ from le_lccs.le_classification import lccs_l4
 sys.path.insert(
     1, os.path.abspath(os.path.join(os.path.dirname(__file__), "../le_plugins"))
 )
-import importlib
 from datacube.virtual import catalog_from_file
 from datacube.virtual import DEFAULT_RESOLVER
+from datacube.virtual.impl import VirtualDatasetBox
+from datacube_pool import get_datacube
 
-# outputs
-from datacube.utils.cog import write_cog
+# cached vector layers and precomputed ancillary layers (modules in this directory)
+from vector_cache import VectorCache
+from ancillary_store import ANCILLARY_LAYERS, read_tile
+from intermediate_cache import IntermediateCache, code_hash, CACHE_MAX_BYTES
+from tile_state import TileState
+from annual import split_years, stack_years
+from WOfS import WOfSCounts
 
 # AWS access
 from datacube.utils.aws import configure_s3_access
@@ -46,6 +69,12 @@ TIDAL_WETLAND_S3 = "/home/jovyan/data/Tidal_wetland_Murray_20172019_30m_PNG.tif"
 OSM_S3 = "/home/jovyan/data/papua-new-guinea.gpkg"
 WOODY_S3 = "/home/jovyan/data/Woodyarti_30m_PNG.tif"
 
+VIRTUAL_PRODUCT_CATALOG = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../le_plugins/virtual_product_cat.yaml")
+)
+# Transformations (modules in le_plugins) used by the virtual product catalog
+TRANSFORMATIONS = ["fractional_cover", "WOfS"]
+
 # Colour scheme
 PNG_BCE_COLOUR_SCHEME = {
     1: (54, 168, 109, 255),     # mangrove
@@ -76,6 +105,12 @@ PNG_BCE_COLOUR_SCHEME = {
 #     2200: (85, 178, 224, 255),  # waterbodies
 # }
 
+# Dense lookup table of RGBA colour for every (uint16) class code, classes not
+# in the colour scheme are transparent black
+BCE_COLOUR_LUT = np.zeros((np.iinfo(np.uint16).max + 1, 4), dtype=np.uint8)
+for class_id, colours in PNG_BCE_COLOUR_SCHEME.items():
+    BCE_COLOUR_LUT[class_id] = colours
+
 # Force using S3 (e.g., for testing)
 FORCE_S3 = False
 if not os.path.isfile(PNG_TILES_S3) or FORCE_S3:
@@ -91,14 +126,82 @@ if not os.path.isfile(OSM_S3) or FORCE_S3:
 if not os.path.isfile(WOODY_S3) or FORCE_S3:
     WOODY_S3 = "s3://oa-bluecarbon-work-easi/livingearth-png/Woodyarti_30m_PNG.tif"
 
-print(f"Loading tiles from {PNG_TILES_S3}")
-print(f"Loading GMW from {GMW_2020_S3}")
-print(f"Loading Tidal Wetlands from {TIDAL_WETLAND_S3}")
-print(f"Loading OSM from {OSM_S3}")
-print(f"Loading woody layer from {WOODY_S3}")
+# Time range to classify, unless set with --time or --years
+DEFAULT_TIME = ("2020-01-01", "2020-12-31")
+
+OUTPUT_CRS = "EPSG:32755"
+OUTPUT_RES = (30, -30)
 
-if os.environ.get("GDAL_HTTP_PROXY") is not None:
-    print(f'Will use caching proxy at: {os.environ.get("GDAL_HTTP_PROXY")}')
+# Dask chunks used to load the Landsat stack shared between transforms
+LANDSAT_DASK_CHUNKS = {"time": 1, "x": 1024, "y": 1024}
+
+# WOfS frequency above which pixels are water / aquatic
+WOFS_THRESHOLD = 0.2
+
+# Input layers and outputs of the classification, with the dtypes they are held as
+CLASSIFICATION_INPUTS = {
+    "PV": np.float32,
+    "NPV": np.float32,
+    "wofs_frequency": np.float32,
+    "mangrove": np.uint8,
+    "tidal_wetland": np.float32,
+    "woody": np.float32,
+    "artificial": np.uint8,
+}
+CLASSIFICATION_OUTPUTS = {
+    "vegetat_veg_cat": np.uint8,
+    "aquatic_wat_cat": np.uint8,
+    "cultman_agr_cat": np.uint8,
+    "artific_urb_cat": np.uint8,
+    "lifeform_veg_cat": np.uint8,
+    "level1": np.int16,
+    "level2": np.int16,
+    "level3": np.int16,
+    "level4": np.int16,
+    "bce": np.int16,
+}
+# Size of blocks (pixels in x and y) the classification is applied to
+CLASSIFICATION_CHUNK_SIZE = 512
+
+# Bands of the data output
+DATA_COG_BANDS = ["level1", "level2", "level3", "level4", "bce"]
+# Default options for output COGs. Horizontal differencing suits the
+# classification layers, which have long runs of the same value.
+COG_COMPRESS = "DEFLATE"
+COG_PREDICTOR = "YES"
+COG_OVERVIEW_RESAMPLING = "NEAREST"
+COG_BLOCKSIZE = 512
+
+# Highway classes from OSM which are sealed and fit the taxonomy of artificial surfaces
+OSM_ROAD_CLASSES = [
+    "primary",
+    "primary_link",
+    "secondary",
+    "secondary_link",
+    "trunk",
+    "trunk_link",
+]
+# OSM layers used for artificial surfaces, with the bit set for each when
+# they are rasterised per source (for diagnostics)
+OSM_ARTIFICIAL_LAYERS = {
+    "buildings": 1,
+    "aeroway_ln": 2,
+    "highway_ln": 4,
+}
+
+
+def print_data_sources():
+    """
+    Print the location of each input data source (local or S3)
+    """
+    print(f"Loading tiles from {PNG_TILES_S3}")
+    print(f"Loading GMW from {GMW_2020_S3}")
+    print(f"Loading Tidal Wetlands from {TIDAL_WETLAND_S3}")
+    print(f"Loading OSM from {OSM_S3}")
+    print(f"Loading woody layer from {WOODY_S3}")
+
+    if os.environ.get("GDAL_HTTP_PROXY") is not None:
+        print(f'Will use caching proxy at: {os.environ.get("GDAL_HTTP_PROXY")}')
 
 
 def colour_blue_carbon_ecosystems(classification_array):
@@ -111,58 +214,271 @@ def colour_blue_carbon_ecosystems(classification_array):
     * blue
     * alpha
 
+    Colours are looked up from BCE_COLOUR_LUT in a single pass, so this can
+    also be applied to blocks of a larger array.
+
     :param np.array classification_array: numpy array containing bcce classification.
 
     """
-    red = np.zeros_like(classification_array, dtype=np.uint8)
-    green = np.zeros_like(red)
-    blue = np.zeros_like(red)
-    alpha = np.zeros_like(red)
-
-    for class_id, colours in PNG_BCE_COLOUR_SCHEME.items():
-        subset = classification_array == class_id
-        red[subset], green[subset], blue[subset], alpha[subset] = colours
+    rgba = BCE_COLOUR_LUT[np.asarray(classification_array).astype(np.uint16)]
+    red, green, blue, alpha = np.moveaxis(rgba, -1, 0)
 
     return red, green, blue, alpha
 
 
-def write_rgb_cog(classification_data, red, green, blue, out_filename):
+class COGWriter:
+    """
+    Write bands to a cloud optimised GeoTiff block by block, e.g., as the
+    chunks of a dask array are computed, so a whole band is never held in
+    memory.
+
+    Blocks are written (serialised with a lock, so bands can be stored
+    concurrently from several threads) to a tiled GeoTiff next to the
+    output, which is converted to a COG with overviews when the writer is
+    closed.
+
+    The geobox is that of the data being written. Rows and / or columns are
+    reversed as they are written where the y axis is ascending or the x axis
+    descending (e.g., data loaded with a resolution of (30, -30)), so the
+    output is always north up.
+
+    :param str out_filename: output COG.
+    :param datacube.utils.geometry.GeoBox geobox: grid of the data being written.
+    :param int count: number of bands.
+    :param dtype: data type of the output.
+    :param str compress: compression for the COG.
+    :param str predictor: TIFF predictor for the COG (NO, YES / STANDARD or FLOATING_POINT).
+    :param bool overviews: build overviews.
+    :param str overview_resampling: resampling used for overviews.
+    :param int blocksize: size of internal tiles.
+    :param nodata: nodata value, if any.
+    :param dict colormap: colour table for the first band (palette outputs).
+
+    """
+
+    def __init__(
+        self,
+        out_filename,
+        geobox,
+        count,
+        dtype,
+        compress=COG_COMPRESS,
+        predictor=COG_PREDICTOR,
+        overviews=True,
+        overview_resampling=COG_OVERVIEW_RESAMPLING,
+        blocksize=COG_BLOCKSIZE,
+        nodata=None,
+        colormap=None,
+    ):
+        if geobox is None:
+            raise ValueError(f"No geobox (CRS) for data to write to {out_filename}")
+
+        self.out_filename = out_filename
+        self.height, self.width = geobox.shape
+        self.cog_options = {
+            "COMPRESS": compress,
+            "PREDICTOR": predictor,
+            "OVERVIEWS": "AUTO" if overviews else "NONE",
+            "OVERVIEW_RESAMPLING": overview_resampling,
+            "BLOCKSIZE": blocksize,
+        }
+
+        # Build a north up transform for the output
+        transform = geobox.transform
+        self.flip_x = transform.a < 0
+        self.flip_y = transform.e > 0
+        left = transform.c + transform.a * self.width if self.flip_x else transform.c
+        top = transform.f + transform.e * self.height if self.flip_y else transform.f
+        out_transform = Affine(abs(transform.a), 0, left, 0, -abs(transform.e), top)
+
+        # Stage as a tiled GeoTiff, which (unlike the COG driver) supports
+        # writing windows directly to disk
+        self.tmp_filename = f"{out_filename}.tmp.tif"
+        self.lock = threading.Lock()
+        self.dataset = rasterio.open(
+            self.tmp_filename,
+            "w",
+            driver="GTiff",
+            height=self.height,
+            width=self.width,
+            count=count,
+            dtype=dtype,
+            crs=str(geobox.crs),
+            transform=out_transform,
+            nodata=nodata,
+            tiled=True,
+            blockxsize=blocksize,
+            blockysize=blocksize,
+            photometric="PALETTE" if colormap else None,
+            BIGTIFF="IF_SAFER",
+        )
+        if colormap:
+            self.dataset.write_colormap(1, colormap)
+
+    def band(self, index):
+        """
+        Target for a band (starting at 1) which can be passed to dask.array.store
+        """
+        return _COGBand(self, index)
+
+    def write_block(self, index, region, block):
+        """
+        Write a (y, x) block of a band at the given (row, column) slices of the
+        input grid
+        """
+        rows, cols = region
+        row_start, row_stop, _ = rows.indices(self.height)
+        col_start, col_stop, _ = cols.indices(self.width)
+        if self.flip_y:
+            row_start, row_stop = self.height - row_stop, self.height - row_start
+            block = block[::-1]
+        if self.flip_x:
+            col_start, col_stop = self.width - col_stop, self.width - col_start
+            block = block[:, ::-1]
+
+        window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        with self.lock:
+            self.dataset.write(
+                np.ascontiguousarray(block, dtype=self.dataset.dtypes[index - 1]),
+                index,
+                window=window,
+            )
+
+    def close(self):
+        """
+        Finish writing and convert to a COG
+        """
+        try:
+            self.dataset.close()
+            rasterio.shutil.copy(
+                self.tmp_filename, self.out_filename, driver="COG", **self.cog_options
+            )
+        finally:
+            if os.path.isfile(self.tmp_filename):
+                os.remove(self.tmp_filename)
+
+    def abort(self):
+        """
+        Stop writing (e.g., following an error) and remove the partial output
+        """
+        self.dataset.close()
+        if os.path.isfile(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class _COGBand:
+    def __init__(self, writer, index):
+        self.writer = writer
+        self.index = index
+
+    def __setitem__(self, region, block):
+        self.writer.write_block(self.index, region, block)
+
+
+def _as_dask(band, blocksize):
+    band = band.transpose("y", "x").data
+    if isinstance(band, da.Array):
+        return band
+    return da.from_array(np.asarray(band), chunks=blocksize)
+
+
+def write_cogs(geobox, outputs, **cog_options):
+    """
+    Write several cloud optimised GeoTiffs, of bands on the same grid, in a
+    single pass. Chunks are computed in parallel with the dask scheduler and
+    written as they are ready, so shared computation (e.g., the classification
+    of a block which is written to several bands) is only done once.
+
+    :param datacube.utils.geometry.GeoBox geobox: grid of the bands.
+    :param list outputs: (out_filename, bands, dtype, colormap) for each COG,
+                         where bands is a list of 2D xarray DataArrays.
+    :param cog_options: compression / overview options passed to COGWriter.
+
+    """
+    blocksize = cog_options.get("blocksize", COG_BLOCKSIZE)
+    writers = []
+    try:
+        sources = []
+        targets = []
+        for out_filename, bands, dtype, colormap in outputs:
+            writer = COGWriter(
+                out_filename, geobox, len(bands), dtype, colormap=colormap, **cog_options
+            )
+            writers.append(writer)
+            for index, band in enumerate(bands, start=1):
+                sources.append(_as_dask(band, blocksize))
+                targets.append(writer.band(index))
+
+        # Writers serialise their own writes
+        da.store(sources, targets, lock=False)
+    except Exception:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    for writer in writers:
+        writer.close()
+
+
+def data_cog_bands(classification_data):
+    """
+    Bands of the data output:
+
+    B1 level 1
+    B2 level 2
+    B3 level 3
+    B4 level 4
+    B5 blue carbon ecosystems and level 4
+
+    """
+    return [classification_data[name] for name in DATA_COG_BANDS]
+
+
+def rgb_cog_bands(classification_data):
+    """
+    Red, green and blue bands of the blue carbon ecosystems colour image,
+    coloured block by block
+    """
+    rgba = xr.apply_ufunc(
+        lambda bce: np.stack(colour_blue_carbon_ecosystems(bce), axis=-1),
+        classification_data["bce"],
+        dask="parallelized",
+        output_dtypes=[np.uint8],
+        output_core_dims=[["band"]],
+        dask_gufunc_kwargs={"output_sizes": {"band": 4}},
+    )
+    return [rgba.isel(band=i) for i in range(3)]
+
+
+def palette_cog_bands(classification_data):
+    """
+    Blue carbon ecosystems class codes as uint16, as colour tables are only
+    supported for 8 and 16 bit unsigned data
+    """
+    return [classification_data["bce"].astype(np.uint16)]
+
+
+def write_rgb_cog(classification_data, red, green, blue, out_filename, **cog_options):
     """ "
     Write out an RGB image as a cloud optimised GeoTiff
     """
-    min_x = classification_data.coords["x"].min().values
-    max_x = classification_data.coords["x"].max().values
-    min_y = classification_data.coords["y"].min().values
-    max_y = classification_data.coords["y"].max().values
-
-    res_x = 30
-    res_y = -30
-    crs = "EPSG:32755"
-    # Write out
-    out_file_transform = [res_x, 0, min_x, 0, res_y, max_y]
-    output_x_size = int((max_x - min_x) / res_x)
-    output_y_size = int((min_y - max_y) / res_y)
-
-    # Write RGB colour scheme out
-    rgb_dataset = rasterio.open(
-        out_filename,
-        "w",
-        driver="COG",
-        height=output_y_size,
-        width=output_x_size,
-        count=3,
-        dtype=np.uint8,
-        crs=crs,
-        transform=out_file_transform,
-    )
-    # Rotate arrays by 180 degrees before writing out
-    rgb_dataset.write(np.rot90(red, 2), 1)
-    rgb_dataset.write(np.rot90(green, 2), 2)
-    rgb_dataset.write(np.rot90(blue, 2), 3)
-    rgb_dataset.close()
-
-
-def write_data_cog(classification_data, out_filename):
+    write_cogs(
+        classification_data.geobox,
+        [(out_filename, [red, green, blue], np.uint8, None)],
+        **cog_options,
+    )
+
+
+def write_data_cog(classification_data, out_filename, **cog_options):
     """ "
     Write out data as a cloud optimised GeoTiff with the following bands:
 
@@ -173,563 +489,1274 @@ def write_data_cog(classification_data, out_filename):
     B5 blue carbon ecosystems and level 4
 
     """
-    min_x = classification_data.coords["x"].min().values
-    max_x = classification_data.coords["x"].max().values
-    min_y = classification_data.coords["y"].min().values
-    max_y = classification_data.coords["y"].max().values
+    write_cogs(
+        classification_data.geobox,
+        [(out_filename, data_cog_bands(classification_data), np.int16, None)],
+        **cog_options,
+    )
 
-    res_x = 30
-    res_y = -30
-    crs = "EPSG:32755"
-    # Write out
-    out_file_transform = [res_x, 0, min_x, 0, res_y, max_y]
-    output_x_size = int((max_x - min_x) / res_x)
-    output_y_size = int((min_y - max_y) / res_y)
 
-    # Write data out
-    data_dataset = rasterio.open(
-        out_filename,
-        "w",
-        driver="COG",
-        height=output_y_size,
-        width=output_x_size,
-        count=5,
-        dtype=np.int16,
-        crs=crs,
-        transform=out_file_transform,
-    )
-    # Write out data
-    data_dataset.write(np.rot90(classification_data["level1"].values, 2), 1)
-    data_dataset.write(np.rot90(classification_data["level2"].values, 2), 2)
-    data_dataset.write(np.rot90(classification_data["level3"].values, 2), 3)
-    data_dataset.write(np.rot90(classification_data["level4"].values, 2), 4)
-    data_dataset.write(np.rot90(classification_data["bce"].values, 2), 5)
-    data_dataset.close()
-
-
-parser = argparse.ArgumentParser(
-    description="Run PNG LCCS Classification for a specified tile "
-)
-parser.add_argument(
-    "-o", "--outdir", required=True, help="Output directory for classification outputs"
-)
-parser.add_argument(
-    "-t",
-    "--tile_id",
-    type=int,
-    help=f"ID of tile to select from {PNG_TILES_S3} or file specified with '--tile_bounds'.",
-    required=True,
-    default=None,
-)
-parser.add_argument(
-    "--tile_bounds",
-    help="Vector file with bounds of tiles.",
-    required=False,
-    default=PNG_TILES_S3,
-)
-parser.add_argument(
-    "--netcdf",
-    help="Write out netCDF file with variables used for classification, useful for debugging.",
-    required=False,
-    default=False,
-    action="store_true",
-)
-parser.add_argument(
-    "--overwrite",
-    help="Overwrite existing classification.",
-    required=False,
-    default=False,
-    action="store_true",
-)
-args = parser.parse_args()
+def write_palette_cog(classification_data, out_filename, **cog_options):
+    """ "
+    Write out blue carbon ecosystems as a single band cloud optimised GeoTiff
+    with the colour scheme embedded as a colour table. Pixel values are the
+    class codes (uint16, as colour tables are only supported for 8 and 16
+    bit unsigned data).
+    """
+    write_cogs(
+        classification_data.geobox,
+        [(out_filename, palette_cog_bands(classification_data), np.uint16, PNG_BCE_COLOUR_SCHEME)],
+        **cog_options,
+    )
 
-# Set output paths
-out_bce_rgb_file = os.path.join(
-    args.outdir, f"png_lccs_classification_v0_1_bce_rgb_tile_{args.tile_id:03}.tif"
-)
-out_data_file = os.path.join(
-    args.outdir, f"png_lccs_classification_v0_1_data_tile_{args.tile_id:03}.tif"
-)
-out_data_netcdf = os.path.join(
-    args.outdir, f"png_lccs_classification_v0_1_data_tile_{args.tile_id:03}_netcdf.nc"
-)
 
-# Check if alreadt have output
-if os.path.isfile(out_data_file) and not args.overwrite:
-    print(
-        f"Output file {out_data_file} exists. Please remove or set '--overwrite' flag if you want to run again"
-    )
-    sys.exit()
+def register_transform(transformation):
+    """
+    Register a virtual product transformation from le_plugins with the
+    default resolver, so it can be referenced from the catalog.
 
-# Connect to datacube
-dc = datacube.Datacube(app="level3")
+    :param str transformation: name of the module / class in le_plugins
+    """
+    trans_loc = importlib.import_module(transformation)
+    trans_class = transformation.split(".")[-1]
 
-# virtual product catalog
-catalog = catalog_from_file(
-    os.path.abspath(
-        os.path.join(
-            os.path.dirname(__file__), "../le_plugins/virtual_product_cat.yaml"
-        )
+    DEFAULT_RESOLVER.register("transform", trans_class, getattr(trans_loc, trans_class))
+
+
+class PipelineContext:
+    """
+    Resources which are expensive to set up and are shared by every tile
+    processed within a single process: the datacube connection, the virtual
+    product catalog, the tile bounds and the cache of vector layers.
+
+    :param str tile_bounds: vector file with bounds of tiles.
+    """
+
+    def __init__(self, tile_bounds=PNG_TILES_S3):
+        # Configure AWS access
+        configure_s3_access(aws_unsigned=False, requester_pays=True)
+
+        # Connect to datacube (shared with the le_plugins transforms)
+        self.dc = get_datacube(app="level3")
+
+        # virtual product catalog
+        for transformation in TRANSFORMATIONS:
+            register_transform(transformation)
+        self.catalog = catalog_from_file(VIRTUAL_PRODUCT_CATALOG)
+
+        # Read in bounds tiles
+        self.bounds_gdf = gpd.read_file(tile_bounds)
+
+        # GMW and OSM layers, read once and queried for each tile
+        self.vectors = VectorCache()
+
+
+def parse_tile_ids(tile_specs, bounds_gdf=None):
+    """
+    Expand a list of tile specifications into a sorted list of unique tile IDs.
+
+    Each specification can be a single ID (``12``), an inclusive range
+    (``10-20``) or ``all`` for every tile in ``bounds_gdf``.
+
+    :param list tile_specs: tile specifications (strings or ints).
+    :param gpd.GeoDataFrame bounds_gdf: tile bounds, required for ``all``.
+
+    """
+    tile_ids = set()
+    for spec in tile_specs:
+        spec = str(spec).strip()
+        if spec.lower() == "all":
+            if bounds_gdf is None:
+                raise ValueError("Tile bounds are required to select 'all' tiles")
+            tile_ids.update(int(tile_id) for tile_id in bounds_gdf.id)
+        elif "-" in spec.lstrip("-"):
+            start, end = spec.split("-", 1)
+            tile_ids.update(range(int(start), int(end) + 1))
+        else:
+            tile_ids.add(int(spec))
+    return sorted(tile_ids)
+
+
+def get_output_paths(outdir, tile_id, year=None):
+    """
+    Get output file names for a tile. Returns paths to:
+
+    * data GeoTiff
+    * BCE RGB GeoTiff
+    * netCDF of classification variables
+
+    The BCE RGB GeoTiff is also used for the paletted output.
+    For multi-year runs the year is added to the end of each name.
+
+    """
+    suffix = f"tile_{tile_id:03}" if year is None else f"tile_{tile_id:03}_{year}"
+    out_data_file = os.path.join(
+        outdir, f"png_lccs_classification_v0_1_data_{suffix}.tif"
     )
-)
+    out_bce_rgb_file = os.path.join(
+        outdir, f"png_lccs_classification_v0_1_bce_rgb_{suffix}.tif"
+    )
+    out_data_netcdf = os.path.join(
+        outdir, f"png_lccs_classification_v0_1_data_{suffix}_netcdf.nc"
+    )
+    return out_data_file, out_bce_rgb_file, out_data_netcdf
 
 
-# Configure AWS access
-configure_s3_access(aws_unsigned=False, requester_pays=True)
+def parse_years(year_specs):
+    """
+    Parse years to classify. Each may be a single year or an inclusive
+    range (e.g., 2018-2020).
 
-# Read in bounds tiles
-bounds_gdf = data = gpd.read_file(args.tile_bounds)
+    :param list year_specs: years and ranges of years, as strings or ints.
 
-# Get polygon for specified tile
-tile_gdf = bounds_gdf[bounds_gdf.id == args.tile_id]
+    """
+    years = set()
+    for spec in year_specs:
+        spec = str(spec)
+        if "-" in spec:
+            start, end = (int(year) for year in spec.split("-", 1))
+            years.update(range(start, end + 1))
+        else:
+            years.add(int(spec))
+    return sorted(years)
+
+
+def years_time_range(years):
+    """
+    Get the time range covering a list of years
+    """
+    return (f"{min(years)}-01-01", f"{max(years)}-12-31")
 
 
-# Get bounds for tile
-latitude = (float(tile_gdf.bounds.maxy), float(tile_gdf.bounds.miny))
-longitude = (float(tile_gdf.bounds.minx), float(tile_gdf.bounds.maxx))
+def select_year(data, year):
+    """
+    Select the layers for a year from an annual summary (with a time
+    coordinate of the start of each year, see le_plugins/annual.py).
+    Returns None if there are no layers for the year (e.g., no observations).
+    """
+    if year not in np.atleast_1d(data.time.dt.year.values):
+        return None
+    if "time" in data.dims:
+        return data.isel(time=int(np.flatnonzero(data.time.dt.year.values == year)[0]))
+    return data
 
-# Set up time
-# TODO: read this from the command line
-time = ("2020-01-01", "2020-12-31")
 
-crs = "EPSG:32755"
-res = (30, -30)
+def get_tile_query(bounds_gdf, tile_id, time=DEFAULT_TIME):
+    """
+    Get the datacube query and bounding box (minx, miny, maxx, maxy) for a tile.
 
-query = {
-    "time": time,
-    "latitude": latitude,
-    "longitude": longitude,
-    "output_crs": crs,
-    "resolution": res,
-}
+    :param gpd.GeoDataFrame bounds_gdf: tile bounds.
+    :param int tile_id: ID of tile to select.
+    :param tuple time: start and end date of the query.
 
-print(
-    f"Running for tile {args.tile_id}. Extent {latitude[0]} - {latitude[1]} N, {longitude[0]} - {longitude[1]} E..."
-)
+    """
+    # Get polygon for specified tile
+    tile_gdf = bounds_gdf[bounds_gdf.id == tile_id]
+    if tile_gdf.empty:
+        raise ValueError(f"Tile {tile_id} not found in tile bounds")
+
+    # Get bounds for tile
+    latitude = (float(tile_gdf.bounds.maxy), float(tile_gdf.bounds.miny))
+    longitude = (float(tile_gdf.bounds.minx), float(tile_gdf.bounds.maxx))
+
+    query = {
+        "time": time,
+        "latitude": latitude,
+        "longitude": longitude,
+        "output_crs": OUTPUT_CRS,
+        "resolution": OUTPUT_RES,
+    }
+    bbox = [longitude[0], latitude[1], longitude[1], latitude[0]]
 
-# ### 1. Vegetated / Non-Vegetated
-
-#    * **Primarily Vegetated Areas**:
-#    This class applies to areas that have a vegetative cover of at least 4% for at least two months of the year, consisting of Woody (Trees, Shrubs) and/or Herbaceous (Forbs, Graminoids) lifeforms, or at least 25% cover of Lichens/Mosses when other life forms are absent.
-#
-#    * **Primarily Non-Vegetated Areas**:
-#    Areas which are not primarily vegetated.
-#
-#
-# Fractional cover (FC) is used to distinguish between vegetated and not vegetated.
-# http://data.auscover.org.au/xwiki/bin/view/Product+pages/Landsat+Fractional+Cover
-# <br>We are using the 90th annual percentile for both Photosyntheic (PV) and Non-photosynthetic (NPV) vegetation. This removes noise and outliers and gives a robust maximum annual value. A threshold is then applied where PV or NPV is greater than 50%, the rationale being that if a pixel is greater than 50% PV or NPV we can be confident that it is likely to be vegetated. In addition, a maximum threshold value is given to NPV as non-photosynthetic vegetation and bare soil (BS) fractions can be unreliable at maximum values due to inherent issues with unmixing NPV and BS signatures.
-#
-# <font color=red>**TODO:**</font> need to calculate number of observations for annual time series to define vegetation correctly as in FAO guidelines. This will likely be similar to WOfS wet/clear obervations but for FC where PV or NPV is greater than 50% for 60 days per year
-
-# Load Fractional Cover
-
-# Need to add any transformations for the VP you're using
-# Get location of transformation
-print("Loading fractional cover...")
-transformation = "fractional_cover"
-trans_loc = importlib.import_module(transformation)
-trans_class = transformation.split(".")[-1]
-
-DEFAULT_RESOLVER.register("transform", trans_class, getattr(trans_loc, trans_class))
-
-product = catalog["fractional_cover"]
-fractional_cover = product.load(dc, **query)
-fractional_cover = masking.mask_invalid_data(fractional_cover)
-
-# Load WOfS
-
-# Need to add any transformations for the VP you're using
-# Get location of transformation
-print("Loading WOfS...")
-transformation = "WOfS"
-trans_loc = importlib.import_module(transformation)
-trans_class = transformation.split(".")[-1]
-
-DEFAULT_RESOLVER.register("transform", trans_class, getattr(trans_loc, trans_class))
-
-product = catalog["WOfS"]
-wofs = product.load(dc, **query)
-wofs = masking.mask_invalid_data(wofs)
-
-wofs_mask = wofs["frequency"] >= 0.2
-
-# Create binary layer representing vegetated (1) and non-vegetated (0)
-vegetat = (fractional_cover["PV_PC_90"] > 25).fillna(0) - (
-    fractional_cover["NPV_PC_90"] > 25
-).fillna(0)
-vegetat = (vegetat.where(vegetat > 0) * 0 + 1).fillna(0)
-
-# mask out water here
-vegetat = (vegetat.where(wofs_mask == 0) * 0 + vegetat).fillna(0)
-
-# Convert to Dataset and add name
-vegetat_veg_cat_ds = vegetat.to_dataset(
-    name="vegetat_veg_cat"
-)  # .squeeze().drop('time')
-
-vegetat_veg_cat_ds.vegetat_veg_cat.plot()
-
-
-# ### 2. Aquatic / Terrestrial
-
-#    * **Primarily Vegetated, Terrestrial**: The vegetation is influenced by the edaphic substratum
-#    * **Primarily Non-Vegetated, Terrestrial**: The cover is influenced by the edaphic substratum
-#    * **Primarily Vegetated, Aquatic or regularly flooded**: The environment is significantly influenced by the presence of water over extensive periods of time. The water is the dominant factor determining natural soil development and the type of plant communities living on its surface
-#    * **Primarily Non-Vegetated, Aquatic or regularly flooded**: Permanent or regularly flood aquatic areas
-#
-#
-# Water Observations from Space (WOfS) is used to distinguish aquatic and terrestrial areas.
-# https://www.sciencedirect.com/science/article/pii/S0034425715301929?via%3Dihub
-# * A threshold of 20% is applied for the annual summary dataset to remove flood events not indicative of the landscape.
-# *i The Mangrove layer are also used for relevant coastal landscapes.
-#
-
-# note: wofs (loaded in level 1 as wofs_mask)
-
-# load mangroves as mask
-print("Loading GMW...")
-
-# load in mangrove vector data just for AOI extent
-bbox = [longitude[0], latitude[1], longitude[1], latitude[0]]
-
-# Load the mangrove vector data within the AOI extent
-gmw = gpd.read_file(GMW_2020_S3, bbox=bbox)
-
-# Check if the mangrove vector dataset is empty
-if gmw.empty:
-    # If the mangrove vector dataset is empty, create a raster of zeros matching the shape of the WOfS mask
-    mangrove = xr.DataArray(
-        np.zeros_like(wofs_mask),
-        coords=wofs_mask.coords,
-        dims=wofs_mask.dims,
-        attrs=wofs_mask.attrs,
-    )
-else:
-    # If the mangrove vector dataset is not empty, rasterize it to match the shape of the WOfS mask
-    # Get the bounding box coordinates
-    xmin, ymin, xmax, ymax = bbox
+    return query, bbox
 
-    # Get the mangrove vector data within the AOI extent
-    gmw_aoi = gmw.cx[xmin:xmax, ymin:ymax]
 
-    # Rasterize the mangrove vector data to match the shape of the WOfS mask
-    mangrove = xr_rasterize(gdf=gmw_aoi, da=wofs_mask)
-
-# Open Murray's tidal wetland probability (2017-2019) file as xarray
-tidal_wetland = rio_slurp_xarray(TIDAL_WETLAND_S3, gbox=vegetat_veg_cat_ds.geobox)
-
-# Threshold probability layer to 50%
-tidal_wetland_extent = ((tidal_wetland.where(tidal_wetland > 50)) * 0 + 1).fillna(0)
-
-# Remove mudflats from Murray's layer
-tidal_wetland_veg = vegetat_veg_cat_ds.vegetat_veg_cat * tidal_wetland_extent
-
-# Create binary layer representing aquatic (1) and terrestrial (0)
-# For coastal landscapes use the following
-aquatic_wat = wofs_mask + mangrove + tidal_wetland_veg
-aquatic_wat = (aquatic_wat.where(aquatic_wat > 0) * 0 + 1).fillna(0)
-
-# Convert to Dataset and add name
-aquatic_wat_cat_ds = aquatic_wat.to_dataset(
-    name="aquatic_wat_cat"
-)  # .squeeze().drop('time')
-
-# ### 3. Natural Vegetation / Crop or Managed Vegetation
-
-#    * **Primarily Vegetated, Terrestrial, Artificial/Managed**: Cultivated and Managed Terrestrial Areas
-#    * **Primarily Vegetated, Terrestrial, (Semi-)natural**: Natural and Semi-Natural Vegetation
-#    * **Primarily Vegetated, Aquatic or Regularly Flooded, Artificial/Managed**: Cultivated Aquatic or Regularly Flooded Areas
-#    * **Primarily Vegetated, Aquatic or Regularly Flooded, (Semi-)natural**: Natural and Semi-Natural Aquatic or Regularly Flooded Vegetation
-#
-print("Calculating natural vegetation...")
-# Create a raster of zeros
-cultman = xr.DataArray(
-    np.zeros_like(wofs_mask),
-    coords=wofs_mask.coords,
-    dims=wofs_mask.dims,
-    attrs=wofs_mask.attrs,
-)
+def zeros_like_layer(like):
+    """
+    Create a raster of zeros matching the shape of a layer
+    """
+    return xr.DataArray(
+        np.zeros_like(like),
+        coords=like.coords,
+        dims=like.dims,
+        attrs=like.attrs,
+    )
 
-# Convert to Dataset and add name
-cultman_agr_cat_ds = cultman.to_dataset(
-    name="cultman_agr_cat"
-)  # .squeeze().drop('time')
-
-# ### 4. Natural Surfaces / Artificial Surfaces
-
-# load in OSM vector data just for AOI extent
-OSM_blds = gpd.read_file(OSM_S3, layer="buildings", bbox=bbox)
-OSM_airports = gpd.read_file(OSM_S3, layer="aeroway_ln", bbox=bbox)
-OSM_roads = gpd.read_file(OSM_S3, layer="highway_ln", bbox=bbox)
-
-# get bbox to get geom of gdf
-xmin, ymin, xmax, ymax = bbox
-
-# Check if the vector dataset is empty
-if OSM_blds.empty:
-    # If the vector dataset is empty, create a raster of zeros matching the shape of the geomedians
-    OSM_blds_xr = xr.DataArray(
-        np.zeros_like(wofs_mask),
-        coords=wofs_mask.coords,
-        dims=wofs_mask.dims,
-        attrs=wofs_mask.attrs,
-    )
-else:
-    OSM_blds_AOI = OSM_blds.cx[xmin:xmax, ymin:ymax]
-    OSM_blds_xr = xr_rasterize(gdf=OSM_blds_AOI, da=wofs_mask)
-
-# Check if the vector dataset is empty
-if OSM_airports.empty:
-    # If the vector dataset is empty, create a raster of zeros matching the shape of the geomedians
-    OSM_airports_xr = xr.DataArray(
-        np.zeros_like(wofs_mask),
-        coords=wofs_mask.coords,
-        dims=wofs_mask.dims,
-        attrs=wofs_mask.attrs,
-    )
-else:
-    OSM_airports_AOI = OSM_airports.cx[xmin:xmax, ymin:ymax]
-    OSM_airports_xr = xr_rasterize(gdf=OSM_airports_AOI, da=wofs_mask)
 
+def rasterize_vector(gdf, bbox, like):
+    """
+    Rasterize vector data within a bounding box to match the shape of a layer.
+    Returns a raster of zeros if there is no vector data.
+    """
     # Check if the vector dataset is empty
-if OSM_roads.empty:
-    # If the vector dataset is empty, create a raster of zeros matching the shape of the geomedians
-    OSM_roads_xr = xr.DataArray(
-        np.zeros_like(wofs_mask),
-        coords=wofs_mask.coords,
-        dims=wofs_mask.dims,
-        attrs=wofs_mask.attrs,
-    )
-else:
-    # only selecting out roads that are sealed and fit the taxonomy of artificial surfaces
-    OSM_roads_filtered = OSM_roads[
-        OSM_roads["highway"].isin(
-            [
-                "primary",
-                "primary_link",
-                "secondary",
-                "secondary_link",
-                "trunk",
-                "trunk_link",
-            ]
-        )
-    ]
-    OSM_roads_AOI = OSM_roads.cx[xmin:xmax, ymin:ymax]
-    OSM_roads_xr = xr_rasterize(gdf=OSM_roads_AOI, da=wofs_mask)
+    if gdf.empty:
+        return zeros_like_layer(like)
 
-# combine OSM xarrays
-OSM_xr = xr.where(
-    (OSM_blds_xr == 1) | (OSM_airports_xr == 1) | (OSM_roads_xr == 1), 1, 0
-)
+    # get bbox to get geom of gdf
+    xmin, ymin, xmax, ymax = bbox
+    gdf_aoi = gdf.cx[xmin:xmax, ymin:ymax]
+    return xr_rasterize(gdf=gdf_aoi, da=like)
 
-# Convert to Dataset and add name
-artific_urb_cat_ds = OSM_xr.to_dataset(name="artific_urb_cat")
-
-# ### 5. Natural Water / Artificial Water
-
-# NONE
-
-# ### **Collect environmental variables into array for passing to classification system**
-
-variables_xarray_list = []
-variables_xarray_list.append(vegetat_veg_cat_ds)
-variables_xarray_list.append(aquatic_wat_cat_ds)
-variables_xarray_list.append(cultman_agr_cat_ds)
-variables_xarray_list.append(artific_urb_cat_ds)
-# variables_xarray_list.append(artwatr_wat_cat_ds)
-
-# **The LCCS classification is hierarchical. The 8 classes are shown below**
-#
-# | Class name                       | Code|     |
-# |----------------------------------|-----|-----|
-# | Cultivated Terrestrial Vegetated | A11 | 111 |
-# | Natural Terrestrial Vegetated    | A12 | 112 |
-# | Cultivated Aquatic Vegetated     | A23 | 123 |
-# | Natural Aquatic Vegetated        | A24 | 124 |
-# | Artificial Surface               | B15 | 215 |
-# | Natural Surface                  | B16 | 216 |
-# | Artificial Water                 | B27 | 227 |
-# | Natural Water                    | B28 | 228 |
-#
-
-print("Running Level 3 Classification...")
-# Merge to a single dataframe
-classification_data = xr.merge(variables_xarray_list)
-
-# Apply Level 3 classification using separate function. Works through in three stages
-level1, level2, level3 = lccs_l3.classify_lccs_level3(classification_data)
-
-# Save classification values back to xarray
-out_class_xarray = xr.Dataset(
-    {
-        "level1": (classification_data["vegetat_veg_cat"].dims, level1),
-        "level2": (classification_data["vegetat_veg_cat"].dims, level2),
-        "level3": (classification_data["vegetat_veg_cat"].dims, level3),
+
+def load_landsat(context, query, dask_chunks=LANDSAT_DASK_CHUNKS, persist=False):
+    """
+    Load the Landsat 8 stack (ls_8 in the virtual product catalog) for a
+    query once, so it can be shared by every transform which takes it as
+    input (fractional_cover, WOfS, geomedian and WCF) rather than each
+    transform loading it again from S3.
+
+    Data are read lazily with dask. The stack is only persisted if
+    `persist` is set, as it holds every scene of the tile in memory;
+    otherwise the transforms should be applied together to each chunk of
+    time steps as it is read (see accumulate_summaries) so it is still
+    only read once.
+    """
+    print("Loading Landsat 8...")
+    product = context.catalog["ls_8"]
+    datasets = product.query(context.dc, **query)
+    grouped = product.group(datasets, **query)
+    landsat = product.fetch(grouped, dask_chunks=dask_chunks, **query)
+    return landsat.persist() if persist else landsat
+
+
+def transform_instance(product):
+    """
+    Create the transformation of a virtual product, with the settings from
+    the catalog
+    """
+    settings = {
+        key: value for key, value in product.items() if key not in ("transform", "input")
     }
-)
-classification_data = xr.merge([classification_data, out_class_xarray])
+    return product["transform"](**settings)
 
-# Creating an array of non-valid bare surface because of the wofs' nan issue
-classification_nan = (
-    (
-        classification_data.level3.where(
-            (classification_data.level3 == 216) & (wofs.frequency.isnull())
-        )
+
+def apply_transform(product, data):
+    """
+    Apply the transformation of a virtual product to input data which has
+    already been loaded. Transforms with another transform as input (e.g.,
+    WCF on geomedian) are applied in turn.
+
+    :param product: virtual product from the catalog.
+    :param xr.Dataset data: loaded data for the underlying (non-transform) product.
+
+    """
+    if "transform" not in product:
+        return data
+
+    input_data = apply_transform(product["input"], data)
+    return keep_crs(transform_instance(product).compute(input_data), input_data)
+
+
+def keep_crs(output_data, input_data):
+    """
+    Copy the CRS of input data to data derived from it, as for data fetched
+    through the virtual product
+    """
+    if "crs" in input_data.attrs:
+        output_data.attrs["crs"] = input_data.attrs["crs"]
+        for data_var in output_data.data_vars.values():
+            data_var.attrs["crs"] = input_data.attrs["crs"]
+    return output_data
+
+
+def load_fractional_cover(context, query, landsat=None):
+    """
+    Load annual fractional cover percentiles using the virtual product catalog.
+    If the Landsat stack has already been loaded (see load_landsat) the
+    transform is applied to it rather than loading it again.
+    """
+    print("Loading fractional cover...")
+    product = context.catalog["fractional_cover"]
+    if landsat is None:
+        fractional_cover = product.load(context.dc, **query)
+    else:
+        fractional_cover = apply_transform(product, landsat)
+    return masking.mask_invalid_data(fractional_cover)
+
+
+def load_wofs(context, query, landsat=None):
+    """
+    Load annual WOfS summary using the virtual product catalog.
+    If the Landsat stack has already been loaded (see load_landsat) the
+    transform is applied to it rather than loading it again.
+    """
+    print("Loading WOfS...")
+    product = context.catalog["WOfS"]
+    if landsat is None:
+        wofs = product.load(context.dc, **query)
+    else:
+        wofs = apply_transform(product, landsat)
+    return masking.mask_invalid_data(wofs)
+
+
+def accumulate_summaries(landsat, fc_transform, fc_reducers, wofs_transform, wofs_counts):
+    """
+    Add a (time, y, x) Landsat stack to fractional cover reducers and WOfS
+    counts in a single pass. Each chunk of time steps is read once, then
+    unmixed and classified for water before the next chunk is read, so
+    neither transform reads the stack again and only one chunk of it is
+    held in memory.
+
+    :param xr.Dataset landsat: Landsat stack (e.g., from load_landsat).
+    :param fc_transform: fractional_cover transformation.
+    :param dict fc_reducers: reducer of each fractional cover band (see fractional_cover.reducers).
+    :param wofs_transform: WOfS transformation.
+    :param WOfSCounts wofs_counts: WOfS summary counts.
+
+    """
+    time_chunk = fc_transform.time_chunk
+    for start in range(0, landsat.sizes["time"], time_chunk):
+        chunk = landsat.isel(time=slice(start, start + time_chunk)).persist()
+        fc_transform.accumulate(fc_transform.prepare(chunk), fc_reducers)
+        wofs_transform.accumulate(wofs_transform.prepare(chunk), wofs_counts)
+
+
+def load_annual_summaries(context, query, shared_input=True, persist_landsat=False):
+    """
+    Load the annual fractional cover and WOfS summaries of a query (as
+    load_fractional_cover and load_wofs). With `shared_input` the Landsat
+    stack is loaded once (see load_landsat) and both summaries of each year
+    are accumulated together from each chunk of time steps as it is read
+    (see accumulate_summaries), so the stack is read once and only the
+    per-year summaries are kept in memory.
+
+    :param PipelineContext context: shared datacube, catalog and tile bounds.
+    :param dict query: datacube query for the tile.
+    :param bool shared_input: share the Landsat stack between the transforms.
+    :param bool persist_landsat: also keep the whole Landsat stack in memory.
+
+    """
+    if not shared_input:
+        return load_fractional_cover(context, query), load_wofs(context, query)
+
+    landsat = load_landsat(context, query, persist=persist_landsat)
+    print("Computing fractional cover and WOfS...")
+    fc_transform = transform_instance(context.catalog["fractional_cover"])
+    wofs_transform = transform_instance(context.catalog["WOfS"])
+
+    shape = (landsat.sizes["y"], landsat.sizes["x"])
+    coords = landsat.isel(time=0, drop=True).coords
+    fractional_cover = {}
+    wofs = {}
+    for year, year_data in split_years(landsat):
+        fc_reducers = fc_transform.reducers(shape, year_data.sizes["time"])
+        wofs_counts = WOfSCounts(shape)
+        accumulate_summaries(year_data, fc_transform, fc_reducers, wofs_transform, wofs_counts)
+        fractional_cover[year] = fc_transform.summarise(fc_reducers, coords)
+        wofs[year] = wofs_transform.summarise(wofs_counts, coords)
+
+    return (
+        masking.mask_invalid_data(keep_crs(stack_years(fractional_cover), landsat)),
+        masking.mask_invalid_data(keep_crs(stack_years(wofs), landsat)),
     )
-    * 0
-).fillna(1)
 
-# Filtering non-valid bare surface (i.e, due to NaN in WOFs) out of level 2 and level 3
-# Level2 set to zero where WOFs is NaN (i.e., info on water/terrestrial in non-veg areas isn't valid)
-classification_data["level2"] = classification_data.level2 * classification_nan
 
-# Set Level3 to Level1 value where Level2 is zero
-# Need to set this later as level4 classification doesn't recognise level3 class 200.
-# classification_data["level3"] = (
-#    classification_data.level3.where(
-#        (classification_data.level1 == 200) & (classification_data.level2 == 0)
-#    )
-#    * 0
-#    + 200
-# ).fillna(0) + (
-#    classification_data.level3.where(classification_data.level2 != 0).fillna(0)
-# )
+def read_vector(source, bbox, layer=None, vectors=None):
+    """
+    Read features of a vector layer within a bounding box, from the vector
+    cache if one is given or from the source otherwise.
 
+    :param str source: path or URL of the vector file.
+    :param list bbox: (minx, miny, maxx, maxy).
+    :param str layer: layer within the file, None for the first layer.
+    :param VectorCache vectors: cache of vector layers.
 
-# Convert level3 to Dataset and add name
-level3_ds = classification_data.level3.to_dataset(name="level3")
+    """
+    if vectors is None:
+        return gpd.read_file(source, layer=layer, bbox=bbox)
+    return vectors.query(source, bbox, layer=layer)
 
-# ### 1. Water state
-# <font color=red>**TODO:** could do this using wofs if we wanted </font>
 
-# ### 2. Water persistence
-# <font color=red>**TODO:** could do this using wofs if we wanted </font>
+def load_new_landsat(context, query, dataset_ids, dask_chunks=LANDSAT_DASK_CHUNKS):
+    """
+    Load the Landsat 8 stack for a query, only including solar days none of
+    whose datasets are in `dataset_ids` (e.g., those indexed since the last
+    incremental update). Datasets are grouped into solar days (as
+    load_landsat) before they are selected, so a day is always loaded with
+    all of its datasets.
+
+    Returns the data (None if there are no new days), the IDs of the
+    datasets loaded and the days which have already been added but have
+    since gained datasets (e.g., a scene indexed late). Nothing is loaded if
+    there are any of those, as they can't be added again without counting
+    them twice.
+    """
+    product = context.catalog["ls_8"]
+    datasets = product.query(context.dc, **query)
+    grouped = product.group(datasets, **query)
+
+    new_days = []
+    changed_days = []
+    for time, group in zip(grouped.box.time.values, grouped.box.values):
+        group_ids = {str(dataset.id) for dataset in group}
+        new_days.append(not group_ids & dataset_ids)
+        if group_ids & dataset_ids and not group_ids <= dataset_ids:
+            changed_days.append(str(time)[:10])
+    new_days = np.array(new_days, dtype=bool)
+    if changed_days or not new_days.any():
+        return None, [], changed_days
+
+    print(f"Loading {new_days.sum()} new days of Landsat 8 datasets...")
+    grouped = VirtualDatasetBox(
+        grouped.box[new_days], grouped.geobox, grouped.load_natively,
+        grouped.product_definitions, geopolygon=grouped.geopolygon,
+    )
+    landsat = product.fetch(grouped, dask_chunks=dask_chunks, **query)
+    new_ids = sorted(str(dataset.id) for group in grouped.box.values for dataset in group)
+    return landsat, new_ids, []
+
+
+def update_annual_summaries(context, tile_id, query, years, state_dir):
+    """
+    Incrementally update the annual fractional cover and WOfS summaries of
+    a tile. For each year the saved state of the summaries (see
+    tile_state.py) is loaded, only solar days of Landsat data which haven't
+    already been added to it are read and added, and the state is saved
+    again. If a day which has been added has gained datasets since, the
+    state of the year is rebuilt from all of its data.
+
+    Returns fractional cover and WOfS summaries (as load_fractional_cover
+    and load_wofs) for the years which had new data, or None for both if
+    no years did.
+
+    :param PipelineContext context: shared datacube, catalog and tile bounds.
+    :param int tile_id: ID of the tile.
+    :param dict query: datacube query for the tile.
+    :param list years: years to update.
+    :param str state_dir: directory (or URL) of saved states.
+
+    """
+    fc_transform = transform_instance(context.catalog["fractional_cover"])
+    wofs_transform = transform_instance(context.catalog["WOfS"])
+
+    fractional_cover = {}
+    wofs = {}
+    for year in years:
+        year_query = dict(query, time=years_time_range([year]))
+        state = TileState.load(state_dir, tile_id, year)
+        landsat, dataset_ids, changed_days = load_new_landsat(
+            context, year_query, state.dataset_ids if state is not None else set()
+        )
+        if changed_days:
+            print(f"Days {', '.join(changed_days)} of tile {tile_id} have new datasets, "
+                  f"rebuilding the state for {year}")
+            state = None
+            landsat, dataset_ids, _ = load_new_landsat(context, year_query, set())
+        if landsat is None:
+            print(f"No new Landsat data for tile {tile_id} in {year}")
+            continue
+
+        if state is None:
+            state = TileState.new(fc_transform, landsat.geobox)
+        elif not state.matches(landsat.geobox):
+            raise ValueError(f"Saved state for tile {tile_id} in {year} is for a different grid")
+
+        accumulate_summaries(
+            landsat, fc_transform, state.fc_reducers, wofs_transform, state.wofs_counts
+        )
+        state.dataset_ids.update(dataset_ids)
+        state.save(state_dir, tile_id, year)
+        print(f"Updated state for tile {tile_id} in {year} ({len(state.dataset_ids)} datasets)")
+
+        coords = landsat.isel(time=0, drop=True).coords
+        fractional_cover[year] = fc_transform.summarise(state.fc_reducers, coords)
+        wofs[year] = wofs_transform.summarise(state.wofs_counts, coords)
+
+    if not wofs:
+        return None, None
+    return (
+        masking.mask_invalid_data(stack_years(fractional_cover)),
+        masking.mask_invalid_data(stack_years(wofs)),
+    )
 
-# ### 3. Lifeform
-# Describes the detail of vegetated classes, separating woody from herbaceous
-# 0: Not applicable (such as in water areas)
-# 1: Woody (trees, shrubs)
-# 2: Herbaceous (grasses, forbs)
 
-# Open woodyarti tif file as xarray
-woody_s1_layer = rio_slurp_xarray(WOODY_S3, gbox=vegetat_veg_cat_ds.geobox)
+def load_mangroves(bbox, like, vectors=None):
+    """
+    Load GMW mangroves for a bounding box and rasterize to match a layer
+    """
+    print("Loading GMW...")
+    # Load the mangrove vector data within the AOI extent
+    gmw = read_vector(GMW_2020_S3, bbox, vectors=vectors)
 
-# Merge S1-derived Woody layer and GMW
-woody_layer = mangrove + woody_s1_layer
+    # Rasterize the mangrove vector data to match the shape of the WOfS mask
+    return rasterize_vector(gmw, bbox, like)
 
-# Convert binary woodyarti layer to lifeform lccs classes
-lifeform = woody_layer.where(woody_layer > 0) * 0 + 1
-lifeform = lifeform.fillna(2)
 
-# Convert to Dataset and add name
-lifeform_veg_cat_ds = lifeform.to_dataset(
-    name="lifeform_veg_cat"
-).squeeze()  # .drop('time')
+def load_tidal_wetland(like):
+    """
+    Open Murray's tidal wetland probability (2017-2019) file as xarray
+    """
+    return rio_slurp_xarray(TIDAL_WETLAND_S3, gbox=like.geobox)
 
-# ### 4. Canopy cover
-# <font color=red>**TODO:** could do this using fractional cover if we wanted </font>
 
-## Level 4 classification ##
+def load_woody(like):
+    """
+    Open woodyarti (S1-derived woody) tif file as xarray
+    """
+    return rio_slurp_xarray(WOODY_S3, gbox=like.geobox)
 
-print("Running Level 4 Classification...")
-variables_xarray_list = []
-variables_xarray_list.append(level3_ds)
-# variables_xarray_list.append(waterstt_wat_cat_ds)
-# variables_xarray_list.append(waterper_wat_cin_ds)
-variables_xarray_list.append(lifeform_veg_cat_ds)
-# variables_xarray_list.append(canopyco_veg_con_ds)
 
-# Merge to a single dataframe
-l4_classification_data = xr.merge(variables_xarray_list)
+def load_artificial_surfaces(bbox, like, vectors=None, source_bits=False):
+    """
+    Rasterize OSM buildings, airports and sealed roads (OSM_ROAD_CLASSES) for
+    a bounding box to match a layer. All geometries are burnt into a single
+    uint8 mask in one pass.
 
-# Apply Level 4 classification
-classification_array = lccs_l4.classify_lccs_level4(l4_classification_data)
+    :param list bbox: (minx, miny, maxx, maxy).
+    :param xr.DataArray like: layer to match.
+    :param VectorCache vectors: cache of vector layers.
+    :param bool source_bits: rather than a mask, set the bit for each source
+                             (OSM_ARTIFICIAL_LAYERS) covering a pixel, for diagnostics.
 
-# Set Level3 to Level1 value where Level2 is zero
-classification_data["level3"] = (
-    classification_data.level3.where(
-        (classification_data.level1 == 200) & (classification_data.level2 == 0)
+    """
+    xmin, ymin, xmax, ymax = bbox
+    geobox = like.geobox
+
+    shapes = {}
+    for layer in OSM_ARTIFICIAL_LAYERS:
+        # load in OSM vector data just for AOI extent
+        gdf = read_vector(OSM_S3, bbox, layer=layer, vectors=vectors)
+        if layer == "highway_ln" and not gdf.empty:
+            # only selecting out roads that are sealed and fit the taxonomy of artificial surfaces
+            gdf = gdf[gdf["highway"].isin(OSM_ROAD_CLASSES)]
+        gdf = gdf.cx[xmin:xmax, ymin:ymax]
+        if not gdf.empty:
+            shapes[layer] = gdf.to_crs(geobox.crs.to_wkt()).geometry.values
+
+    artificial = np.zeros(geobox.shape, dtype=np.uint8)
+    if not source_bits:
+        all_shapes = [geom for geoms in shapes.values() for geom in geoms]
+        if all_shapes:
+            rasterio.features.rasterize(
+                all_shapes, out=artificial, transform=geobox.transform, default_value=1
+            )
+    elif shapes:
+        # Burn each source into a scratch array (so overlapping geometries
+        # don't add up) and combine its bit
+        burnt = np.empty_like(artificial)
+        for layer, geoms in shapes.items():
+            burnt[:] = 0
+            rasterio.features.rasterize(
+                geoms, out=burnt, transform=geobox.transform, default_value=1
+            )
+            artificial |= burnt * np.uint8(OSM_ARTIFICIAL_LAYERS[layer])
+
+    return xr.DataArray(artificial, coords=like.coords, dims=like.dims, attrs=like.attrs)
+
+
+def load_ancillary(context, bbox, like):
+    """
+    Load the static ancillary layers (ANCILLARY_LAYERS) for a bounding box,
+    rasterized / reprojected to match a layer
+    """
+    return xr.Dataset(
+        {
+            "mangrove": load_mangroves(bbox, like, context.vectors),
+            "tidal_wetland": load_tidal_wetland(like),
+            "woody": load_woody(like),
+            "artificial": load_artificial_surfaces(bbox, like, context.vectors),
+        }
     )
-    * 0
-    + 200
-).fillna(0) + (
-    classification_data.level3.where(classification_data.level2 != 0).fillna(0)
-)
 
-classification_level4 = (classification_data.level3 * 10.0) + (
-    classification_array.lifeform_veg_cat_l4a
-)
 
-## Select out blue carbon ecosystems (mangrove, saltmarsh, tidal woody area) from level 3 and 4 ##
-
-print("Selecting out Blue Carbon Ecosystems")
-# ### 1. Mangrove ecosystem
-# - level 3 == 124
-# - lifeform == 1
-# - GMW == 1
-
-mangrove_class = (
-    level3_ds.level3.where(
-        (classification_array.level3 == 124)
-        & (classification_array.lifeform_veg_cat_l4a == 1)
-        & (mangrove == 1)
-    )
-    * 0
-    + 1
-).fillna(0)
-
-# ### 2. Tidal woody ecosystem
-# - level 3 == 124
-# - lifeform == 1
-# - GMW == 0
-
-tidal_woody_class = (
-    level3_ds.level3.where(
-        (classification_array.level3 == 124)
-        & (classification_array.lifeform_veg_cat_l4a == 1)
-        & (mangrove != 1)
-    )
-    * 0
-    + 2
-).fillna(0)
-
-# ### 3. Saltmarsh ecosystem
-# - level 3 == 124
-# - lifeform == 2
-
-saltmarsh_class = (
-    level3_ds.level3.where(
-        (classification_array.level3 == 124)
-        & (classification_array.lifeform_veg_cat_l4a == 2)
-    )
-    * 0
-    + 3
-).fillna(0)
-
-# ## <font color=blue>Blue carbon ecosystems</font>
-
-# combine
-bce = mangrove_class + saltmarsh_class + tidal_woody_class
-bce = bce.where(bce != 0, classification_level4)
-
-bce = bce.to_dataset(name="bce")
-classification_level4 = classification_level4.to_dataset(name="level4")
-classification_data = xr.merge([classification_data, classification_level4, bce])
-
-write_data_cog(classification_data, out_data_file)
-print("Classification finished")
-print(f"Wrote output to {out_data_file}")
-
-red, green, blue, alpha = colour_blue_carbon_ecosystems(classification_data.bce.values)
-write_rgb_cog(classification_data, red, green, blue, out_bce_rgb_file)
-print(f"Saved BCE RGB to {out_bce_rgb_file}")
-
-if args.netcdf:
-    classification_data.to_netcdf(
-        out_data_netcdf,
-        encoding={
-            var: {"zlib": True, "complevel": 4} for var in classification_data.data_vars
+def cached_layer(cache, name, tile_id, query, code, compute):
+    """
+    Compute an intermediate layer with `compute()`, or get it from the
+    intermediate cache if it has already been computed for the tile with the
+    same query and code.
+
+    :param IntermediateCache cache: cache of intermediate layers, None to always compute.
+    :param str name: name of the layer.
+    :param int tile_id: ID of the tile.
+    :param dict query: datacube query for the tile.
+    :param str code: hash of the code / parameters the layer depends on.
+    :param compute: function which computes the layer.
+
+    """
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(cache.key(name, tile_id, query, code), compute)
+
+
+def vegetation_layer(pv, npv, wofs_frequency):
+    """
+    Create binary layer representing vegetated (1) and non-vegetated (0),
+    from the annual PV and NPV fractional cover summaries
+    """
+    # ### 1. Vegetated / Non-Vegetated
+
+    #    * **Primarily Vegetated Areas**:
+    #    This class applies to areas that have a vegetative cover of at least 4% for at least two months of the year, consisting of Woody (Trees, Shrubs) and/or Herbaceous (Forbs, Graminoids) lifeforms, or at least 25% cover of Lichens/Mosses when other life forms are absent.
+    #
+    #    * **Primarily Non-Vegetated Areas**:
+    #    Areas which are not primarily vegetated.
+    #
+    #
+    # Fractional cover (FC) is used to distinguish between vegetated and not vegetated.
+    # http://data.auscover.org.au/xwiki/bin/view/Product+pages/Landsat+Fractional+Cover
+    # <br>We are using the 90th annual percentile for both Photosyntheic (PV) and Non-photosynthetic (NPV) vegetation. This removes noise and outliers and gives a robust maximum annual value. A threshold is then applied where PV or NPV is greater than 50%, the rationale being that if a pixel is greater than 50% PV or NPV we can be confident that it is likely to be vegetated. In addition, a maximum threshold value is given to NPV as non-photosynthetic vegetation and bare soil (BS) fractions can be unreliable at maximum values due to inherent issues with unmixing NPV and BS signatures.
+    #
+    # <font color=red>**TODO:**</font> need to calculate number of observations for annual time series to define vegetation correctly as in FAO guidelines. This will likely be similar to WOfS wet/clear obervations but for FC where PV or NPV is greater than 50% for 60 days per year
+
+    # Vegetated where PV is above the threshold and NPV is not (NaN counts as below)
+    vegetat = (pv > 25) & ~(npv > 25)
+
+    # mask out water here
+    vegetat &= ~(wofs_frequency >= WOFS_THRESHOLD)
+
+    return vegetat.astype(np.uint8)
+
+
+def aquatic_layer(vegetat, wofs_frequency, mangrove, tidal_wetland):
+    """
+    Create binary layer representing aquatic (1) and terrestrial (0)
+    """
+    # ### 2. Aquatic / Terrestrial
+
+    #    * **Primarily Vegetated, Terrestrial**: The vegetation is influenced by the edaphic substratum
+    #    * **Primarily Non-Vegetated, Terrestrial**: The cover is influenced by the edaphic substratum
+    #    * **Primarily Vegetated, Aquatic or regularly flooded**: The environment is significantly influenced by the presence of water over extensive periods of time. The water is the dominant factor determining natural soil development and the type of plant communities living on its surface
+    #    * **Primarily Non-Vegetated, Aquatic or regularly flooded**: Permanent or regularly flood aquatic areas
+    #
+    #
+    # Water Observations from Space (WOfS) is used to distinguish aquatic and terrestrial areas.
+    # https://www.sciencedirect.com/science/article/pii/S0034425715301929?via%3Dihub
+    # * A threshold of 20% is applied for the annual summary dataset to remove flood events not indicative of the landscape.
+    # *i The Mangrove layer are also used for relevant coastal landscapes.
+    #
+
+    # Threshold tidal wetland probability layer to 50% and remove mudflats
+    tidal_wetland_veg = (vegetat > 0) & (tidal_wetland > 50)
+
+    # For coastal landscapes use the following
+    aquatic_wat = (wofs_frequency >= WOFS_THRESHOLD) | (mangrove > 0) | tidal_wetland_veg
+
+    return aquatic_wat.astype(np.uint8)
+
+
+def lifeform_layer(mangrove, woody):
+    """
+    Create lifeform layer from S1-derived woody layer and GMW
+    """
+    # ### 1. Water state
+    # <font color=red>**TODO:** could do this using wofs if we wanted </font>
+
+    # ### 2. Water persistence
+    # <font color=red>**TODO:** could do this using wofs if we wanted </font>
+
+    # ### 3. Lifeform
+    # Describes the detail of vegetated classes, separating woody from herbaceous
+    # 0: Not applicable (such as in water areas)
+    # 1: Woody (trees, shrubs)
+    # 2: Herbaceous (grasses, forbs)
+
+    # Merge S1-derived Woody layer and GMW and convert to lifeform lccs classes
+    woody_layer = mangrove + woody
+    lifeform = np.where(woody_layer > 0, 1, 2)
+
+    # ### 4. Canopy cover
+    # <font color=red>**TODO:** could do this using fractional cover if we wanted </font>
+
+    return lifeform.astype(np.uint8)
+
+
+@numba.njit(cache=True)
+def _blue_carbon_kernel(level3, lifeform_l4a, mangrove, level4, bce):
+    for i in range(level3.shape[0]):
+        for j in range(level3.shape[1]):
+            if level3[i, j] == 124 and lifeform_l4a[i, j] == 1:
+                # mangrove (GMW) or tidal woody
+                bce[i, j] = 1 if mangrove[i, j] == 1 else 2
+            elif level3[i, j] == 124 and lifeform_l4a[i, j] == 2:
+                # saltmarsh
+                bce[i, j] = 3
+            else:
+                bce[i, j] = level4[i, j]
+
+
+def blue_carbon_layer(level3, lifeform_l4a, mangrove, level4):
+    """
+    Select out blue carbon ecosystems (mangrove, saltmarsh, tidal woody area)
+    from level 3 and 4. Other pixels are set to level 4.
+
+    Computed with a compiled kernel in a single pass over the inputs,
+    writing straight to the int16 output without any temporary arrays.
+    """
+    # ### 1. Mangrove ecosystem
+    # - level 3 == 124
+    # - lifeform == 1
+    # - GMW == 1
+    #
+    # ### 2. Tidal woody ecosystem
+    # - level 3 == 124
+    # - lifeform == 1
+    # - GMW == 0
+    #
+    # ### 3. Saltmarsh ecosystem
+    # - level 3 == 124
+    # - lifeform == 2
+
+    # ## <font color=blue>Blue carbon ecosystems</font>
+    bce = np.empty(level3.shape, dtype=np.int16)
+    _blue_carbon_kernel(level3, lifeform_l4a, mangrove, level4, bce)
+    return bce
+
+
+def classify_block(inputs):
+    """
+    Run the classification chain (levels 1 to 4 and blue carbon ecosystems)
+    for a block of input layers. All intermediate layers are small integer
+    arrays the size of the block.
+
+    :param xr.Dataset inputs: block of CLASSIFICATION_INPUTS.
+    :returns: xr.Dataset with CLASSIFICATION_OUTPUTS for the block.
+
+    """
+    dims = inputs["wofs_frequency"].dims
+    coords = inputs.coords
+    wofs_frequency = inputs["wofs_frequency"].values
+    mangrove = inputs["mangrove"].values
+
+    vegetat = vegetation_layer(
+        inputs["PV"].values, inputs["NPV"].values, wofs_frequency
+    )
+    aquatic_wat = aquatic_layer(
+        vegetat, wofs_frequency, mangrove, inputs["tidal_wetland"].values
+    )
+
+    # ### 3. Natural Vegetation / Crop or Managed Vegetation (none for PNG)
+    # ### 4. Natural Surfaces / Artificial Surfaces (OSM)
+    # ### 5. Natural Water / Artificial Water (none)
+
+    # ### **Collect environmental variables into array for passing to classification system**
+    classification_data = xr.Dataset(
+        {
+            "vegetat_veg_cat": (dims, vegetat),
+            "aquatic_wat_cat": (dims, aquatic_wat),
+            "cultman_agr_cat": (dims, np.zeros_like(vegetat)),
+            "artific_urb_cat": (dims, inputs["artificial"].values.astype(np.uint8)),
         },
+        coords=coords,
+    )
+
+    # **The LCCS classification is hierarchical. The 8 classes are shown below**
+    #
+    # | Class name                       | Code|     |
+    # |----------------------------------|-----|-----|
+    # | Cultivated Terrestrial Vegetated | A11 | 111 |
+    # | Natural Terrestrial Vegetated    | A12 | 112 |
+    # | Cultivated Aquatic Vegetated     | A23 | 123 |
+    # | Natural Aquatic Vegetated        | A24 | 124 |
+    # | Artificial Surface               | B15 | 215 |
+    # | Natural Surface                  | B16 | 216 |
+    # | Artificial Water                 | B27 | 227 |
+    # | Natural Water                    | B28 | 228 |
+    #
+
+    # Apply Level 3 classification using separate function. Works through in three stages
+    level1, level2, level3 = lccs_l3.classify_lccs_level3(classification_data)
+    level1 = np.asarray(level1, dtype=np.int16)
+    level2 = np.asarray(level2, dtype=np.int16)
+    level3 = np.asarray(level3, dtype=np.int16)
+
+    # Filtering non-valid bare surface (i.e, due to NaN in WOFs) out of level 2
+    # Level2 set to zero where WOFs is NaN (i.e., info on water/terrestrial in non-veg areas isn't valid)
+    level2 = np.where((level3 == 216) & np.isnan(wofs_frequency), 0, level2).astype(np.int16)
+
+    # Apply Level 4 classification
+    lifeform = lifeform_layer(mangrove, inputs["woody"].values)
+    l4_classification_data = xr.Dataset(
+        {"level3": (dims, level3), "lifeform_veg_cat": (dims, lifeform)},
+        coords=coords,
+    )
+    classification_array = lccs_l4.classify_lccs_level4(l4_classification_data)
+    lifeform_l4a = np.asarray(classification_array["lifeform_veg_cat_l4a"].values)
+
+    # Set Level3 to Level1 value where Level2 is zero
+    # Need to set this after level 4 classification as it doesn't recognise level3 class 200.
+    level3_out = np.where(
+        (level1 == 200) & (level2 == 0), 200, np.where(level2 != 0, level3, 0)
+    ).astype(np.int16)
+
+    level4 = (level3_out * 10 + lifeform_l4a).astype(np.int16)
+
+    bce = blue_carbon_layer(
+        np.asarray(classification_array["level3"].values), lifeform_l4a, mangrove, level4
+    )
+
+    outputs = {
+        "vegetat_veg_cat": vegetat,
+        "aquatic_wat_cat": aquatic_wat,
+        "cultman_agr_cat": classification_data["cultman_agr_cat"].values,
+        "artific_urb_cat": classification_data["artific_urb_cat"].values,
+        "lifeform_veg_cat": lifeform,
+        "level1": level1,
+        "level2": level2,
+        "level3": level3_out,
+        "level4": level4,
+        "bce": bce,
+    }
+    return xr.Dataset(
+        {name: (dims, outputs[name].astype(dtype)) for name, dtype in CLASSIFICATION_OUTPUTS.items()},
+        coords=coords,
+    )
+
+
+def classify(inputs, chunk_size=CLASSIFICATION_CHUNK_SIZE):
+    """
+    Apply the classification chain blockwise over a tile of input layers,
+    so memory use is bounded by the block size rather than the tile size.
+    Returns a lazy (dask backed) dataset of CLASSIFICATION_OUTPUTS.
+
+    :param xr.Dataset inputs: 2D layers named as in CLASSIFICATION_INPUTS.
+    :param int chunk_size: size of blocks (pixels) in x and y.
+
+    """
+    inputs = inputs.chunk({"y": chunk_size, "x": chunk_size})
+    like = inputs["wofs_frequency"]
+    template = xr.Dataset(
+        {name: like.astype(dtype) for name, dtype in CLASSIFICATION_OUTPUTS.items()}
+    )
+    return xr.map_blocks(classify_block, inputs, template=template)
+
+
+def write_classification(
+    classification_data,
+    out_data_file,
+    out_bce_rgb_file,
+    out_data_netcdf,
+    bce_palette=False,
+    netcdf=False,
+    cog_options=None,
+):
+    """
+    Run the (lazy) classification and write out the data and BCE colour
+    COGs, and optionally a netCDF.
+    """
+    # Classify and write both outputs block by block in a single pass
+    if bce_palette:
+        bce_output = (out_bce_rgb_file, palette_cog_bands(classification_data),
+                      np.uint16, PNG_BCE_COLOUR_SCHEME)
+    else:
+        bce_output = (out_bce_rgb_file, rgb_cog_bands(classification_data), np.uint8, None)
+    write_cogs(
+        classification_data.geobox,
+        [(out_data_file, data_cog_bands(classification_data), np.int16, None), bce_output],
+        **(cog_options or {}),
+    )
+    print("Classification finished")
+    print(f"Wrote output to {out_data_file}")
+    print(f"Saved BCE colour image to {out_bce_rgb_file}")
+
+    # The classification isn't held in memory so is run again for the
+    # netCDF, this is only used for debugging
+    if netcdf:
+        classification_data.to_netcdf(
+            out_data_netcdf,
+            encoding={
+                var: {"zlib": True, "complevel": 4} for var in classification_data.data_vars
+            },
+        )
+        print(f"Wrote output netCDF to {out_data_netcdf}")
+
+
+def run_tile(
+    context,
+    tile_id,
+    outdir,
+    time=DEFAULT_TIME,
+    years=None,
+    shared_input=True,
+    persist_landsat=False,
+    chunk_size=CLASSIFICATION_CHUNK_SIZE,
+    bce_palette=False,
+    netcdf=False,
+    overwrite=False,
+    cog_options=None,
+    ancillary_store=None,
+    cache=None,
+    cache_max_bytes=CACHE_MAX_BYTES,
+    incremental_state=None,
+):
+    """
+    Run the classification for a single tile and write out the results.
+    Returns the paths to the data files written, which is empty if the
+    tile was skipped because outputs already exist.
+
+    For multi-year runs the Landsat stack for all years is loaded once, the
+    fractional cover and WOfS transforms summarise each year from it and the
+    static ancillary layers are shared between the years.
+
+    :param PipelineContext context: shared datacube, catalog and tile bounds.
+    :param int tile_id: ID of tile to process.
+    :param str outdir: output directory for classification outputs.
+    :param tuple time: start and end date to classify, ignored if years are given.
+    :param list years: years to classify, writing outputs for each year.
+    :param bool shared_input: load the Landsat stack once and share it between
+                              the fractional cover and WOfS transforms.
+    :param bool persist_landsat: keep the whole Landsat stack of the tile in
+                                 memory, rather than only the annual summaries.
+    :param int chunk_size: size of blocks (pixels) the classification is applied to.
+    :param bool bce_palette: write BCE as a single band with a colour table
+                             rather than as RGB.
+    :param bool netcdf: also write out netCDF of variables used for classification.
+    :param bool overwrite: overwrite existing classification.
+    :param dict cog_options: compression / overview options for output COGs
+                             (see COGWriter).
+    :param str ancillary_store: store of precomputed ancillary layers
+                                (see ancillary_store.py), None to compute them.
+    :param str cache: directory or S3 prefix for the cache of intermediate
+                      layers (see intermediate_cache.py), None to not cache.
+    :param int cache_max_bytes: size above which cached layers are evicted.
+    :param str incremental_state: directory (or URL) of saved fractional cover
+                                  and WOfS summary state. If set, only Landsat
+                                  data not already in the state are loaded and
+                                  outputs are updated for years with new data.
+
+    """
+    if years:
+        time = years_time_range(years)
+        # Check if already have output for each year
+        out_paths = {year: get_output_paths(outdir, tile_id, year) for year in years}
+    else:
+        out_paths = {None: get_output_paths(outdir, tile_id)}
+
+    # Outputs are updated in incremental mode
+    if not overwrite and not incremental_state:
+        for year, (out_data_file, _, _) in list(out_paths.items()):
+            if os.path.isfile(out_data_file):
+                print(
+                    f"Output file {out_data_file} exists. Please remove or set '--overwrite' flag if you want to run again"
+                )
+                del out_paths[year]
+        if not out_paths:
+            return []
+
+    query, bbox = get_tile_query(context.bounds_gdf, tile_id, time)
+
+    print(
+        f"Running for tile {tile_id}. Extent {query['latitude'][0]} - {query['latitude'][1]} N, {query['longitude'][0]} - {query['longitude'][1]} E..."
+    )
+
+    layer_cache = IntermediateCache(cache, cache_max_bytes) if cache else None
+
+    if incremental_state:
+        # Add new data to the saved summaries of each year
+        state_years = years or list(range(int(time[0][:4]), int(time[1][:4]) + 1))
+        fractional_cover, wofs = update_annual_summaries(
+            context, tile_id, query, state_years, incremental_state
+        )
+        if wofs is None:
+            return []
+        # Only write outputs for years which were updated
+        updated = set(int(year) for year in np.atleast_1d(wofs.time.dt.year.values))
+        out_paths = {
+            year: paths for year, paths in out_paths.items() if year is None or year in updated
+        }
+    else:
+        # Load environmental variables. The Landsat stack is only loaded if a
+        # summary needs computing (i.e., isn't in the cache), and both
+        # summaries are then computed together from a single read
+        @functools.lru_cache(maxsize=None)
+        def summaries():
+            return load_annual_summaries(context, query, shared_input, persist_landsat)
+
+        fractional_cover = cached_layer(
+            layer_cache, "fractional_cover", tile_id, query,
+            code_hash(importlib.import_module("fractional_cover"), importlib.import_module("annual"),
+                      VIRTUAL_PRODUCT_CATALOG, load_landsat, apply_transform, load_fractional_cover,
+                      accumulate_summaries, load_annual_summaries),
+            lambda: summaries()[0],
+        )
+        wofs = cached_layer(
+            layer_cache, "WOfS", tile_id, query,
+            code_hash(importlib.import_module("WOfS"), importlib.import_module("annual"),
+                      VIRTUAL_PRODUCT_CATALOG, load_landsat, apply_transform, load_wofs,
+                      accumulate_summaries, load_annual_summaries),
+            lambda: summaries()[1],
+        )
+        summaries.cache_clear()
+
+    # Static layers on the 2D grid, from the ancillary store if they have
+    # been precomputed. These are shared by all years.
+    like = wofs["frequency"].isel(time=0, drop=True) if "time" in wofs.dims else wofs["frequency"]
+    ancillary = read_tile(ancillary_store, tile_id, like) if ancillary_store else None
+    if ancillary is None:
+        ancillary = cached_layer(
+            layer_cache, "ancillary", tile_id, query,
+            code_hash(load_ancillary, read_vector, rasterize_vector, load_mangroves,
+                      load_tidal_wetland, load_woody, load_artificial_surfaces,
+                      {"sources": [GMW_2020_S3, TIDAL_WETLAND_S3, OSM_S3, WOODY_S3],
+                       "road_classes": OSM_ROAD_CLASSES}),
+            lambda: load_ancillary(context, bbox, like),
+        )
+    else:
+        print(f"Using ancillary layers from {ancillary_store}")
+
+    # Names of the fractional cover summaries (e.g., PV_MEAN)
+    fc_transform = transform_instance(context.catalog["fractional_cover"])
+
+    # A time range spanning several years gives a summary for each year
+    if None in out_paths and "time" in wofs.dims:
+        out_paths = {
+            int(year): get_output_paths(outdir, tile_id, int(year))
+            for year in wofs.time.dt.year.values
+        }
+
+    written = []
+    for year, (out_data_file, out_bce_rgb_file, out_data_netcdf) in out_paths.items():
+        if year is None:
+            fractional_cover_year, wofs_year = fractional_cover, wofs
+        else:
+            fractional_cover_year = select_year(fractional_cover, year)
+            wofs_year = select_year(wofs, year)
+            if fractional_cover_year is None or wofs_year is None:
+                print(f"No observations for tile {tile_id} in {year}, skipping")
+                continue
+            print(f"Classifying {year}...")
+
+        layers = {
+            "PV": fractional_cover_year[fc_transform.output_name("PV")],
+            "NPV": fractional_cover_year[fc_transform.output_name("NPV")],
+            "wofs_frequency": wofs_year["frequency"],
+            **{name: ancillary[name] for name in ANCILLARY_LAYERS},
+        }
+        # All layers are on the same grid
+        inputs = xr.Dataset(
+            {name: (like.dims, layers[name].data.astype(dtype))
+             for name, dtype in CLASSIFICATION_INPUTS.items()},
+            coords=like.coords,
+        )
+
+        print("Running Level 3 and Level 4 Classification...")
+        classification_data = classify(inputs, chunk_size)
+        write_classification(
+            classification_data,
+            out_data_file,
+            out_bce_rgb_file,
+            out_data_netcdf,
+            bce_palette=bce_palette,
+            netcdf=netcdf,
+            cog_options=cog_options,
+        )
+        written.append(out_data_file)
+
+    return written
+
+
+# Context for each worker process, created once by _init_worker and reused for every tile
+_WORKER_CONTEXT = None
+
+
+def _init_worker(tile_bounds):
+    global _WORKER_CONTEXT
+    _WORKER_CONTEXT = PipelineContext(tile_bounds)
+
+
+def _run_tile_in_worker(tile_id, outdir, **kwargs):
+    return run_tile(_WORKER_CONTEXT, tile_id, outdir, **kwargs)
+
+
+def run_tiles(tile_ids, outdir, tile_bounds=PNG_TILES_S3, workers=1, **kwargs):
+    """
+    Run the classification for a list of tiles. Tiles are processed by a pool
+    of long-lived worker processes, each of which sets up the datacube
+    connection, virtual product catalog and tile bounds once and reuses them
+    for every tile it processes. With a single worker tiles are run in this
+    process.
+
+    A failure for one tile is reported and does not stop the others.
+    Returns a dictionary of tile ID to exception for tiles which failed.
+
+    :param list tile_ids: IDs of tiles to process.
+    :param str outdir: output directory for classification outputs.
+    :param str tile_bounds: vector file with bounds of tiles.
+    :param int workers: number of worker processes.
+    :param kwargs: passed to run_tile.
+
+    """
+    failed = {}
+    if workers <= 1:
+        context = PipelineContext(tile_bounds)
+        for tile_id in tile_ids:
+            try:
+                run_tile(context, tile_id, outdir, **kwargs)
+            except Exception as err:
+                print(f"Tile {tile_id} failed: {err}")
+                failed[tile_id] = err
+        return failed
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(tile_bounds,)
+    ) as executor:
+        futures = {
+            executor.submit(_run_tile_in_worker, tile_id, outdir, **kwargs): tile_id
+            for tile_id in tile_ids
+        }
+        for future in as_completed(futures):
+            tile_id = futures[future]
+            try:
+                future.result()
+            except Exception as err:
+                print(f"Tile {tile_id} failed: {err}")
+                failed[tile_id] = err
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run PNG LCCS Classification for specified tiles "
+    )
+    parser.add_argument(
+        "-o", "--outdir", required=True, help="Output directory for classification outputs"
+    )
+    parser.add_argument(
+        "-t",
+        "--tile_id",
+        nargs="+",
+        help=f"ID(s) of tiles to select from {PNG_TILES_S3} or file specified with '--tile_bounds'. "
+        "Accepts single IDs, inclusive ranges (e.g., 10-20) or 'all'.",
+        required=True,
+        default=None,
     )
-    print(f"Wrote output netCDF to {out_data_netcdf}")
+    parser.add_argument(
+        "--tile_bounds",
+        help="Vector file with bounds of tiles.",
+        required=False,
+        default=PNG_TILES_S3,
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="Number of worker processes to run tiles with.",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--no_shared_input",
+        help="Load the Landsat stack separately for each transform rather than once per tile.",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--persist_landsat",
+        help="Keep the whole Landsat stack of a tile in memory rather than only the annual summaries "
+        "(uses memory for every scene of the tile in each worker).",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bce_palette",
+        help="Write BCE as a single band with an embedded colour table rather than three RGB bands.",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--netcdf",
+        help="Write out netCDF file with variables used for classification, useful for debugging.",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--time",
+        help=f"Start and end date to classify (default {DEFAULT_TIME[0]} {DEFAULT_TIME[1]}). "
+        "A range spanning several years is classified for each year.",
+        nargs=2,
+        metavar=("START", "END"),
+        required=False,
+        default=DEFAULT_TIME,
+    )
+    parser.add_argument(
+        "--years",
+        help="Years to classify, e.g., 2018 2020 or 2018-2020. Landsat data for all years "
+        "are loaded once and outputs are written for each year.",
+        nargs="+",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Directory (or S3 prefix) of saved fractional cover and WOfS state for each tile and year. "
+        "Only Landsat datasets indexed since the last run are loaded and added to the annual summaries, "
+        "and outputs for years with new data are updated.",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--ancillary_store",
+        help="Store of ancillary layers precomputed with ancillary_store.py. Tiles not in the store are computed.",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Directory or S3 prefix to cache intermediate layers (fractional cover, WOfS and ancillary layers) in.",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        help="Size of cache above which least recently used layers are removed.",
+        required=False,
+        type=float,
+        default=CACHE_MAX_BYTES / 1024**3,
+    )
+    parser.add_argument(
+        "--compress",
+        help="Compression for output COGs.",
+        required=False,
+        default=COG_COMPRESS,
+    )
+    parser.add_argument(
+        "--no_overviews",
+        help="Don't build overviews for output COGs.",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--overwrite",
+        help="Overwrite existing classification.",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+
+    print_data_sources()
+
+    bounds_gdf = None
+    if any(str(spec).lower() == "all" for spec in args.tile_id):
+        bounds_gdf = gpd.read_file(args.tile_bounds)
+    tile_ids = parse_tile_ids(args.tile_id, bounds_gdf)
+
+    failed = run_tiles(
+        tile_ids,
+        args.outdir,
+        tile_bounds=args.tile_bounds,
+        workers=args.workers,
+        time=tuple(args.time),
+        years=parse_years(args.years) if args.years else None,
+        shared_input=not args.no_shared_input,
+        persist_landsat=args.persist_landsat,
+        bce_palette=args.bce_palette,
+        netcdf=args.netcdf,
+        overwrite=args.overwrite,
+        cog_options={"compress": args.compress, "overviews": not args.no_overviews},
+        ancillary_store=args.ancillary_store,
+        cache=args.cache,
+        cache_max_bytes=int(args.cache_max_gb * 1024**3),
+        incremental_state=args.incremental,
+    )
+    if failed:
+        print(f"{len(failed)} of {len(tile_ids)} tiles failed: {sorted(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Persisted state of the annual fractional cover and WOfS summaries of a
+tile, for incremental updates.
+
+The state holds the accumulators of the summaries (the WOfS wet / clear
+counts and the sum and count, or buffer of largest values for a
+percentile, of each fractional cover band) and the IDs of the Landsat datasets which have been added to
+them, so as new scenes are indexed during a year only those need to be
+read and added, rather than the whole year.
+"""
+import io
+import json
+
+import fsspec
+import numpy as np
+
+# from le_plugins
+from fractional_cover import FC_BANDS, reducer_from_state
+from WOfS import WOfSCounts
+
+# Maximum number of (solar day) observations of a pixel in a year, which
+# bounds the memory used for each fractional cover percentile (buffers
+# are grown if a pixel has more)
+ANNUAL_MAX_OBSERVATIONS = 92
+
+
+def state_path(state_dir, tile_id, year):
+    """
+    Get the path of the state file for a tile and year
+    """
+    return f"{state_dir.rstrip('/')}/tile_{tile_id:03}_{year}.npz"
+
+
+def _geobox_key(geobox):
+    return [str(geobox.crs), list(geobox.transform)[:6], list(geobox.shape)]
+
+
+class TileState:
+    """
+    Accumulated fractional cover and WOfS state for a tile and year.
+
+    :param dict fc_reducers: StreamingMean or StreamingPercentile for each fractional cover band.
+    :param WOfSCounts wofs_counts: WOfS summary counts.
+    :param set dataset_ids: IDs of datasets which have been added.
+    :param list grid: CRS, transform and shape of the grid of the state.
+    """
+
+    def __init__(self, fc_reducers, wofs_counts, dataset_ids, grid):
+        self.fc_reducers = fc_reducers
+        self.wofs_counts = wofs_counts
+        self.dataset_ids = set(dataset_ids)
+        self.grid = grid
+
+    @classmethod
+    def new(cls, fc_transform, geobox, max_count=ANNUAL_MAX_OBSERVATIONS):
+        """
+        Create an empty state for a grid.
+
+        :param fc_transform: fractional_cover transformation (sets the percentile).
+        :param GeoBox geobox: grid of the tile.
+        :param int max_count: maximum number of observations of a pixel.
+
+        """
+        return cls(
+            fc_transform.reducers(geobox.shape, max_count),
+            WOfSCounts(geobox.shape),
+            set(),
+            _geobox_key(geobox),
+        )
+
+    def matches(self, geobox):
+        """
+        Check the state is for a grid
+        """
+        return self.grid == _geobox_key(geobox)
+
+    @classmethod
+    def load(cls, state_dir, tile_id, year):
+        """
+        Load the state for a tile and year, None if there isn't one
+        """
+        path = state_path(state_dir, tile_id, year)
+        fs, fs_path = fsspec.core.url_to_fs(path)
+        if not fs.exists(fs_path):
+            return None
+
+        with fs.open(fs_path, "rb") as f:
+            arrays = dict(np.load(io.BytesIO(f.read())))
+
+        fc_reducers = {
+            band: reducer_from_state({
+                name[len(f"fc_{band}_"):]: value
+                for name, value in arrays.items() if name.startswith(f"fc_{band}_")
+            })
+            for band in FC_BANDS
+        }
+        wofs_counts = WOfSCounts.from_state(
+            {name: arrays[f"wofs_{name}"] for name in ("count_wet", "count_clear", "count_some")}
+        )
+        metadata = json.loads(str(arrays["metadata"]))
+        return cls(fc_reducers, wofs_counts, metadata["dataset_ids"], metadata["grid"])
+
+    def save(self, state_dir, tile_id, year):
+        """
+        Save the state for a tile and year. The file is replaced in one
+        operation so an interrupted save doesn't corrupt the previous state.
+        """
+        arrays = {
+            "metadata": np.array(
+                json.dumps({"dataset_ids": sorted(self.dataset_ids), "grid": self.grid})
+            )
+        }
+        for band, reducer in self.fc_reducers.items():
+            for name, value in reducer.state().items():
+                arrays[f"fc_{band}_{name}"] = value
+        for name, value in self.wofs_counts.state().items():
+            arrays[f"wofs_{name}"] = value
+
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+
+        path = state_path(state_dir, tile_id, year)
+        fs, fs_path = fsspec.core.url_to_fs(path)
+        fs.makedirs(fs._parent(fs_path), exist_ok=True)
+        with fs.open(f"{fs_path}.part", "wb") as f:
+            f.write(buffer.getvalue())
+        fs.mv(f"{fs_path}.part", fs_path)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Train the woody cover fraction (WCF) model used by the WCF transform
+(le_plugins/WCF.py) from the training data in data/WCF_traindata_14122019.csv,
+a WCF value with Landsat surface reflectance (blue, green, red, nir, swir1
+and swir2, scaled to 0 - 1) for each sample.
+
+The model is a random forest regressor. As well as training a single model
+(by default with the settings of data/wcf_pickle_sklearn_version_1.pickle),
+a range of forest sizes can be benchmarked, reporting the accuracy on held
+out samples against the cost of inference (number of nodes, depth and time
+to predict a million pixels with the exported model), e.g.:
+
+    train_wcf.py --benchmark
+    train_wcf.py --trees 25 --max_depth 12 -o ../data/wcf_model.npz
+
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import train_test_split
+
+# for the exported model format and band names used by the WCF transform
+sys.path.insert(
+    1, os.path.abspath(os.path.join(os.path.dirname(__file__), "../le_plugins"))
+)
+from tree_model import TreeEnsemble, WCF_BANDS, sklearn_forest_arrays, export_sklearn
+
+WCF_TRAINING_DATA = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../data/WCF_traindata_14122019.csv")
+)
+
+# Settings of the model in data/wcf_pickle_sklearn_version_1.pickle
+WCF_MODEL_SETTINGS = {
+    "n_estimators": 100,
+    "max_depth": None,
+    "min_samples_leaf": 50,
+    "random_state": 20,
+}
+# Forest sizes (number of trees, maximum depth) compared by --benchmark
+BENCHMARK_TREES = [10, 25, 50, 100]
+BENCHMARK_MAX_DEPTH = [8, 12, 16, None]
+# Fraction of samples held out to measure accuracy
+TEST_FRACTION = 0.25
+# Number of pixels timed to measure inference cost
+BENCHMARK_PIXELS = 1000000
+
+
+def load_training_data(training_csv=WCF_TRAINING_DATA):
+    """
+    Load training data, returns features (samples, bands) in the order of
+    WCF_BANDS and the WCF of each sample.
+
+    :param str training_csv: CSV with WCF and band columns.
+
+    """
+    training_data = pd.read_csv(training_csv, skipinitialspace=True)
+    training_data.columns = training_data.columns.str.strip()
+    features = training_data[WCF_BANDS].to_numpy(dtype=np.float32)
+    wcf = training_data["WCF"].to_numpy(dtype=np.float64)
+    return features, wcf
+
+
+def train(features, wcf, n_estimators, max_depth=None, min_samples_leaf=50, random_state=20, n_jobs=-1):
+    """
+    Train a random forest regressor for WCF.
+    """
+    model = RandomForestRegressor(
+        n_estimators=n_estimators,
+        max_depth=max_depth,
+        min_samples_leaf=min_samples_leaf,
+        max_features=1.0,
+        random_state=random_state,
+        n_jobs=n_jobs,
+    )
+    return model.fit(features, wcf)
+
+
+def evaluate(model, features, wcf, n_pixels=BENCHMARK_PIXELS, seed=0):
+    """
+    Accuracy of a model on test samples and the cost of inference with the
+    exported model (see le_plugins/tree_model.py). Returns a dictionary of:
+
+    * rmse, mae, r2: of predicted WCF
+    * nodes: total number of nodes of all trees
+    * mean_depth: mean depth of the trees
+    * seconds_per_million: time to predict a million pixels (single thread)
+
+    """
+    exported = TreeEnsemble(sklearn_forest_arrays(model))
+    residuals = exported.predict(features) - wcf
+
+    # Time on random reflectances in the range of the training data
+    rng = np.random.default_rng(seed)
+    pixels = rng.uniform(features.min(axis=0), features.max(axis=0),
+                         (n_pixels, features.shape[1])).astype(np.float32)
+    exported.predict(pixels[:10])
+    start = time.perf_counter()
+    exported.predict(pixels)
+    seconds = time.perf_counter() - start
+
+    return {
+        "rmse": float(np.sqrt(np.mean(residuals**2))),
+        "mae": float(np.mean(np.abs(residuals))),
+        "r2": float(1 - np.sum(residuals**2) / np.sum((wcf - wcf.mean())**2)),
+        "nodes": int(sum(tree.tree_.node_count for tree in model.estimators_)),
+        "mean_depth": float(np.mean([tree.tree_.max_depth for tree in model.estimators_])),
+        "seconds_per_million": seconds * 1e6 / n_pixels,
+    }
+
+
+def benchmark(features, wcf, trees=BENCHMARK_TREES, max_depths=BENCHMARK_MAX_DEPTH,
+              min_samples_leaf=50, random_state=20):
+    """
+    Train and evaluate models for each number of trees and maximum depth on
+    a train / test split of the training data, printing a table of accuracy
+    against inference cost. Returns a list of the results.
+    """
+    train_features, test_features, train_wcf, test_wcf = train_test_split(
+        features, wcf, test_size=TEST_FRACTION, random_state=random_state
+    )
+
+    print(f"{'trees':>5} {'max_depth':>9} {'rmse':>7} {'mae':>7} {'r2':>6} "
+          f"{'nodes':>8} {'depth':>6} {'s/Mpx':>7}")
+    results = []
+    for n_estimators in trees:
+        for max_depth in max_depths:
+            model = train(train_features, train_wcf, n_estimators, max_depth,
+                          min_samples_leaf, random_state)
+            result = evaluate(model, test_features, test_wcf)
+            result.update(trees=n_estimators, max_depth=max_depth)
+            results.append(result)
+            print(f"{n_estimators:>5} {str(max_depth):>9} {result['rmse']:7.4f} "
+                  f"{result['mae']:7.4f} {result['r2']:6.3f} {result['nodes']:>8} "
+                  f"{result['mean_depth']:6.1f} {result['seconds_per_million']:7.3f}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the WCF model")
+    parser.add_argument(
+        "--training_data", help="CSV of training data", required=False, default=WCF_TRAINING_DATA
+    )
+    parser.add_argument(
+        "--benchmark",
+        help="Compare accuracy and inference cost of a range of forest sizes.",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trees", help="Number of trees", required=False, type=int,
+        default=WCF_MODEL_SETTINGS["n_estimators"],
+    )
+    parser.add_argument(
+        "--max_depth", help="Maximum depth of trees", required=False, type=int,
+        default=WCF_MODEL_SETTINGS["max_depth"],
+    )
+    parser.add_argument(
+        "--min_samples_leaf", help="Minimum number of samples in a leaf", required=False, type=int,
+        default=WCF_MODEL_SETTINGS["min_samples_leaf"],
+    )
+    parser.add_argument(
+        "-o", "--output", help="Output model (.npz, or a pickle for other extensions)", required=False,
+        default=None,
+    )
+    args = parser.parse_args(argv)
+
+    features, wcf = load_training_data(args.training_data)
+    print(f"Loaded {len(wcf)} samples from {args.training_data}")
+
+    if args.benchmark:
+        benchmark(features, wcf, min_samples_leaf=args.min_samples_leaf)
+
+    if args.output is None:
+        return
+
+    # Report held out accuracy of the chosen settings, then fit to all samples
+    train_features, test_features, train_wcf, test_wcf = train_test_split(
+        features, wcf, test_size=TEST_FRACTION, random_state=WCF_MODEL_SETTINGS["random_state"]
+    )
+    model = train(train_features, train_wcf, args.trees, args.max_depth, args.min_samples_leaf)
+    print(f"Held out accuracy: {evaluate(model, test_features, test_wcf)}")
+
+    model = train(features, wcf, args.trees, args.max_depth, args.min_samples_leaf)
+    if args.output.endswith(".npz"):
+        export_sklearn(model, args.output)
+    else:
+        with open(args.output, "wb") as f:
+            pickle.dump(model, f)
+    print(f"Saved model to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
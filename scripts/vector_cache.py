@@ -0,0 +1,118 @@
+"""
+Cache of the vector layers (GMW mangroves and OpenStreetMap) used by the
+LCCS classification scripts.
+
+Each source is fetched once per node into a local cache directory (shared
+between processes and runs) and each layer is read once per process. Bounding
+box queries for every subsequent tile are then answered from memory using the
+layer's R-tree spatial index, rather than scanning the GeoPackage (often on
+S3) again for every tile.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import fsspec
+import geopandas as gpd
+from shapely.geometry import box
+
+# Local directory for cached copies of remote sources
+VECTOR_CACHE_DIR = os.environ.get(
+    "LE_LCCS_VECTOR_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "livingearth_png", "vectors"),
+)
+
+
+def is_remote(source):
+    """
+    Check if a source is a remote (e.g., s3://) path rather than a local file
+    """
+    return "://" in source
+
+
+class VectorCache:
+    """
+    Answer bounding box queries on vector layers from memory.
+
+    :param str cache_dir: directory for local copies of remote sources.
+    :param dict storage_options: options passed to fsspec when fetching remote sources.
+    """
+
+    def __init__(self, cache_dir=VECTOR_CACHE_DIR, storage_options=None):
+        self.cache_dir = cache_dir
+        self.storage_options = storage_options or {"requester_pays": True}
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def local_path(self, source):
+        """
+        Get the path of a local copy of a source, fetching it if it isn't
+        already in the cache. Local files are used as they are.
+
+        :param str source: path or URL of the vector file.
+
+        """
+        if not is_remote(source):
+            return source
+
+        # Name by a hash of the URL so sources with the same file name don't clash
+        url_hash = hashlib.sha1(source.encode()).hexdigest()[:12]
+        local_file = os.path.join(self.cache_dir, url_hash, os.path.basename(source))
+        if os.path.isfile(local_file):
+            return local_file
+
+        print(f"Fetching {source} to {local_file}")
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        # Download to a temporary file and move into place, so other
+        # processes never see a partial copy
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(local_file), suffix=".part")
+        try:
+            with fsspec.open(source, "rb", **self.storage_options) as remote, os.fdopen(
+                fd, "wb"
+            ) as local:
+                shutil.copyfileobj(remote, local, length=16 * 1024 * 1024)
+            os.replace(tmp_file, local_file)
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+        return local_file
+
+    def layer(self, source, layer=None):
+        """
+        Get a whole layer of a source as a GeoDataFrame, reading it the first
+        time it is needed. The spatial index is built when the layer is read.
+
+        :param str source: path or URL of the vector file.
+        :param str layer: layer within the file, None for the first layer.
+
+        """
+        key = (source, layer)
+        with self._lock:
+            if key not in self._layers:
+                gdf = gpd.read_file(self.local_path(source), layer=layer)
+                gdf.sindex
+                self._layers[key] = gdf
+            return self._layers[key]
+
+    def query(self, source, bbox, layer=None):
+        """
+        Get features of a layer whose bounding box intersects a bounding box,
+        as gpd.read_file(source, layer=layer, bbox=bbox).
+
+        :param str source: path or URL of the vector file.
+        :param list bbox: (minx, miny, maxx, maxy) in the CRS of the layer.
+        :param str layer: layer within the file, None for the first layer.
+
+        """
+        gdf = self.layer(source, layer)
+        index = gdf.sindex.query(box(*bbox))
+        return gdf.iloc[sorted(index)]
+
+    def clear(self):
+        """
+        Drop layers held in memory (local copies are kept)
+        """
+        with self._lock:
+            self._layers.clear()
@@ -0,0 +1,178 @@
+"""
+Tests of the local terrain flattening (gee/python-api/terrain_flattening_local.py): the volume
+and direct model corrections of a tilted plane DEM against their closed form (Vollrath et al.,
+2020), the layover / shadow buffer against the unbuffered mask and the reuse of the terrain
+geometry of an orbit by TerrainCache.
+"""
+import math
+import os
+import sys
+
+import numpy as np
+import pytest
+
+xr = pytest.importorskip("xarray")
+pytest.importorskip("scipy")
+
+sys.path.insert(
+    1, os.path.abspath(os.path.join(os.path.dirname(__file__), "../gee/python-api"))
+)
+import terrain_flattening_local as trf  # noqa: E402
+
+HEIGHT, WIDTH = 30, 40
+RESOLUTION = 10.0
+SIGMA0 = 0.1
+
+
+def _coords():
+    # north up grid in metres
+    return {"y": 5000.0 - RESOLUTION * np.arange(HEIGHT), "x": 1000.0 + RESOLUTION * np.arange(WIDTH)}
+
+
+def _dem(elevation):
+    return xr.DataArray(elevation, dims=("y", "x"), coords=_coords(), name="elevation")
+
+
+def tilted_plane(slope, aspect):
+    """
+    DEM of a plane with a slope (degrees) facing an aspect (degrees clockwise from north)
+    """
+    coords = _coords()
+    y, x = np.meshgrid(coords["y"], coords["x"], indexing="ij")
+    tan_slope = math.tan(math.radians(slope))
+    downhill = math.sin(math.radians(aspect)) * x + math.cos(math.radians(aspect)) * y
+    return _dem(-tan_slope * downhill)
+
+
+def _image(angle=35.0, scale=1.0):
+    dims = ("y", "x")
+    return xr.Dataset(
+        {
+            "VV": (dims, np.full((HEIGHT, WIDTH), SIGMA0 * scale, dtype=np.float32)),
+            "angle": (dims, np.full((HEIGHT, WIDTH), angle, dtype=np.float32)),
+        },
+        coords=_coords(),
+    )
+
+
+def closed_form(model, slope, aspect, heading, angle):
+    """
+    Gamma nought of SIGMA0 on a plane, from equations 2-6 of the article
+    """
+    theta = math.radians(angle)
+    phi_s = -math.radians(aspect - 360 if aspect > 180 else aspect)
+    phi_r = math.radians(heading) - phi_s
+    alpha_r = math.atan(math.tan(math.radians(slope)) * math.cos(phi_r))
+    alpha_az = math.atan(math.tan(math.radians(slope)) * math.sin(phi_r))
+    if model == "VOLUME":
+        scf = math.tan(math.pi / 2 - theta + alpha_r) / math.tan(math.pi / 2 - theta)
+    else:
+        scf = math.cos(math.pi / 2 - theta) / (math.cos(alpha_az) * math.cos(math.pi / 2 - theta + alpha_r))
+    return SIGMA0 * scf / math.cos(theta)
+
+
+@pytest.mark.parametrize("model", ["VOLUME", "DIRECT"])
+@pytest.mark.parametrize("slope, aspect", [(10.0, 120.0), (20.0, 300.0), (5.0, 200.0)])
+def test_plane_matches_closed_form(model, slope, aspect):
+    heading = -100.0
+    corrected = next(trf.slope_correction(
+        [_image()], model, tilted_plane(slope, aspect), 0,
+        orbits=[1], cache=trf.TerrainCache(headings={1: heading}),
+    ))
+    # edge pixels have one sided slopes
+    values = corrected["VV"].values[1:-1, 1:-1]
+    np.testing.assert_allclose(values, closed_form(model, slope, aspect, heading, 35.0), rtol=1e-5)
+    # the angle band isn't corrected
+    np.testing.assert_array_equal(corrected["angle"].values, _image()["angle"].values)
+
+
+def test_slope_aspect_of_plane():
+    slope, aspect = trf.slope_aspect(tilted_plane(15.0, 250.0).values, (-RESOLUTION, RESOLUTION))
+    np.testing.assert_allclose(slope[1:-1, 1:-1], math.radians(15.0), rtol=1e-9)
+    np.testing.assert_allclose(aspect[1:-1, 1:-1], 250.0, rtol=1e-9)
+
+
+def test_look_direction():
+    # the incidence angle grows away from the sensor, here to the east, so the angle band faces west
+    x = _coords()["x"]
+    angle = xr.DataArray(
+        np.broadcast_to(30.0 + 0.001 * (x - x[0]), (HEIGHT, WIDTH)), dims=("y", "x"), coords=_coords()
+    )
+    assert trf.look_direction(angle) == pytest.approx(-90.0)
+    assert math.isnan(trf.look_direction(angle.where(angle < 0)))
+
+
+def _ridge():
+    # a steep slope facing the sensor (layover) in a band across a flat DEM
+    dem = np.zeros((HEIGHT, WIDTH))
+    columns = np.arange(15, 20)
+    dem[:, columns] = (columns - 14) * RESOLUTION * math.tan(math.radians(60.0))
+    dem[:, 20:] = dem[:, 19:20]
+    return _dem(dem)
+
+
+@pytest.mark.parametrize("buffer", [10, 25, 40])
+def test_layover_shadow_buffer(buffer):
+    cache = trf.TerrainCache(headings={1: -90.0})
+    unbuffered = next(trf.slope_correction([_image()], "VOLUME", _ridge(), 0, [1], cache))
+    buffered = next(trf.slope_correction([_image()], "VOLUME", _ridge(), buffer, [1], cache))
+    valid = np.isfinite(unbuffered["VV"].values)
+    assert 0 < valid.sum() < valid.size
+
+    # pixels further than the buffer from every masked pixel
+    rows, cols = np.nonzero(~valid)
+    y, x = np.mgrid[:HEIGHT, :WIDTH]
+    distance = np.hypot(
+        (y[..., np.newaxis] - rows) * RESOLUTION, (x[..., np.newaxis] - cols) * RESOLUTION
+    ).min(axis=-1)
+    np.testing.assert_array_equal(np.isfinite(buffered["VV"].values), valid & (distance > buffer))
+    # buffering only masks pixels, the others are unchanged
+    np.testing.assert_array_equal(buffered["VV"].values[valid & (distance > buffer)],
+                                  unbuffered["VV"].values[valid & (distance > buffer)])
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError):
+        next(trf.slope_correction([_image()], "SURFACE", tilted_plane(10.0, 90.0), 0))
+
+
+def test_cache_reuses_orbit_geometry():
+    dem = tilted_plane(10.0, 120.0)
+    cache = trf.TerrainCache(headings={1: -100.0})
+    first = cache.geometry(dem, _image(), 1)
+    # a second acquisition of the orbit reuses the geometry
+    assert cache.geometry(dem, _image(scale=2.0), 1) is first
+    list(trf.slope_correction([_image(), _image(scale=3.0)], "VOLUME", dem, 0, [1, 1], cache))
+    assert len(cache.geometries) == 1 and len(cache.slopes) == 1
+
+    # another orbit has its own geometry (from the heading of its first image), on the same slopes
+    other_orbit = cache.geometry(dem, _image(), 2)
+    assert other_orbit is not first
+    assert not np.allclose(other_orbit[0], first[0])
+    assert len(cache.geometries) == 2 and len(cache.slopes) == 1
+
+    # another DEM tile doesn't reuse the geometry of the orbit
+    other_dem = tilted_plane(20.0, 300.0)
+    other_dem = other_dem.assign_coords(x=other_dem.x + WIDTH * RESOLUTION)
+    assert cache.geometry(other_dem, _image(), 1) is not first
+    assert len(cache.geometries) == 3 and len(cache.slopes) == 2
+
+
+def test_cache_drops_least_recently_used():
+    cache = trf.TerrainCache(max_entries=2, headings={1: -100.0, 2: 80.0, 3: 0.0})
+    dem = tilted_plane(10.0, 120.0)
+    first = cache.geometry(dem, _image(), 1)
+    cache.geometry(dem, _image(), 2)
+    cache.geometry(dem, _image(), 1)
+    cache.geometry(dem, _image(), 3)
+    assert cache.geometry(dem, _image(), 1) is first
+    assert list(cache.geometries) == [(trf._grid_key(dem), 3), (trf._grid_key(dem), 1)]
+
+
+def test_no_heading_not_cached():
+    # an image with no valid angles doesn't set the heading of its orbit
+    cache = trf.TerrainCache()
+    image = _image()
+    image["angle"][:] = np.nan
+    cache.geometry(tilted_plane(10.0, 120.0), image, 1)
+    assert 1 not in cache.headings and not cache.geometries
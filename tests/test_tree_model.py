@@ -0,0 +1,113 @@
+"""
+Parity tests of the portable tree ensemble (le_plugins/tree_model.py): a small sklearn random
+forest trained on random data is exported to .npz, loaded with TreeEnsemble and must predict
+the same as sklearn, including for features which are NaN.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+ensemble = pytest.importorskip("sklearn.ensemble")
+
+sys.path.insert(
+    1, os.path.abspath(os.path.join(os.path.dirname(__file__), "../le_plugins"))
+)
+import tree_model  # noqa: E402
+
+N_FEATURES = 6
+
+
+def _features(rng, n_samples, nan_fraction=0.0):
+    """
+    Random features (e.g., surface reflectance), with a fraction of values NaN
+    """
+    features = rng.uniform(0.0, 0.6, (n_samples, N_FEATURES)).astype(np.float32)
+    features[rng.random(features.shape) < nan_fraction] = np.nan
+    return features
+
+
+def _train(nan_fraction):
+    rng = np.random.default_rng(0)
+    features = _features(rng, 400, nan_fraction)
+    filled = np.nan_to_num(features)
+    target = 2 * filled[:, 0] + np.sin(5 * filled[:, 3]) + rng.normal(0, 0.05, len(features))
+    return ensemble.RandomForestRegressor(n_estimators=8, max_depth=8, random_state=0).fit(
+        features, target
+    )
+
+
+@pytest.fixture(scope="module", params=[0.0, 0.1], ids=["trained_without_nan", "trained_with_nan"])
+def forest(request):
+    return _train(request.param)
+
+
+@pytest.fixture(scope="module")
+def exported(forest, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("tree_model") / "model.npz")
+    tree_model.export_sklearn(forest, path)
+    return tree_model.TreeEnsemble.load(path)
+
+
+def test_predict_matches_sklearn(forest, exported):
+    features = _features(np.random.default_rng(1), 2000)
+    np.testing.assert_allclose(exported.predict(features), forest.predict(features), rtol=1e-12)
+
+
+def test_predict_nan_matches_sklearn(forest, exported):
+    # NaN features go to the child sklearn sends them to, which for a model trained without
+    # missing values is the child with the most training samples
+    features = _features(np.random.default_rng(2), 2000, nan_fraction=0.2)
+    assert np.isnan(features).any(axis=1).sum() > 1000
+    np.testing.assert_allclose(exported.predict(features), forest.predict(features), rtol=1e-12)
+
+
+def test_predict_thresholds(forest, exported):
+    # features exactly at (and next to) the split thresholds go the same way as in sklearn
+    thresholds = np.concatenate([
+        estimator.tree_.threshold[estimator.tree_.feature >= 0] for estimator in forest.estimators_
+    ]).astype(np.float32)
+    # (splits of missing values from the rest have an infinite threshold)
+    thresholds = thresholds[np.isfinite(thresholds)]
+    values = np.concatenate([
+        thresholds,
+        np.nextafter(thresholds, np.float32(np.inf)),
+        np.nextafter(thresholds, np.float32(-np.inf)),
+    ])
+    features = np.repeat(values[:, np.newaxis], N_FEATURES, axis=1)
+    np.testing.assert_allclose(exported.predict(features), forest.predict(features), rtol=1e-12)
+
+
+def test_export_npz(forest, tmp_path):
+    path = str(tmp_path / "model.npz")
+    tree_model.export_sklearn(forest, path)
+    with np.load(path, allow_pickle=False) as arrays:
+        assert int(arrays["format"]) == tree_model.TREE_MODEL_FORMAT
+        assert int(arrays["n_features"]) == N_FEATURES
+        assert len(arrays["roots"]) == len(forest.estimators_)
+        assert len(arrays["left"]) == sum(estimator.tree_.node_count for estimator in forest.estimators_)
+
+
+def test_predict_feature_count(exported):
+    with pytest.raises(ValueError):
+        exported.predict(np.zeros((3, N_FEATURES + 1), dtype=np.float32))
+
+
+def test_unsupported_model():
+    model = ensemble.GradientBoostingRegressor(n_estimators=2).fit(
+        np.random.default_rng(0).random((20, 2)), np.arange(20.0)
+    )
+    with pytest.raises(ValueError):
+        tree_model.sklearn_forest_arrays(model)
+
+
+def test_shipped_model_loads():
+    # the WCF model in the repository, exported before NaN features were handled
+    path = os.path.join(os.path.dirname(__file__), "../data/wcf_model.npz")
+    if not os.path.exists(path):
+        pytest.skip("WCF model not available")
+    model = tree_model.TreeEnsemble.load(path)
+    predicted = model.predict(_features(np.random.default_rng(3), 100))
+    assert np.isfinite(predicted).all()
@@ -0,0 +1,168 @@
+"""
+Tests of the local S1 ARD pipeline (gee/python-api/wrapper_local.py) on a small synthetic set of
+GeoTIFF scenes (two relative orbits, with border noise and a nodata patch) and a hilly DEM with
+layover. The grid is processed a chunk at a time with a margin (halo) for the filters and the
+layover / shadow buffer, so processing it in small chunks must give the same output as a single
+chunk.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+pytest.importorskip("dask")
+pytest.importorskip("scipy")
+pytest.importorskip("shapely")
+pytest.importorskip("zarr")
+rasterio = pytest.importorskip("rasterio")
+xr = pytest.importorskip("xarray")
+
+sys.path.insert(
+    1, os.path.abspath(os.path.join(os.path.dirname(__file__), "../gee/python-api"))
+)
+import speckle_filter_local as sfl  # noqa: E402
+import wrapper_local  # noqa: E402
+
+HEIGHT, WIDTH = 70, 90
+RESOLUTION = 10.0
+TRANSFORM = rasterio.transform.from_origin(500000.0, 9000000.0, RESOLUTION, RESOLUTION)
+CRS = "EPSG:32755"
+# (time, orbit pass, relative orbit) of each scene
+SCENES = [
+    ("2020-01-03T08:00:00", "DESCENDING", 9),
+    ("2020-01-09T20:00:00", "ASCENDING", 16),
+    ("2020-01-15T08:00:00", "DESCENDING", 9),
+    ("2020-01-21T20:00:00", "ASCENDING", 16),
+    ("2020-01-27T08:00:00", "DESCENDING", 9),
+    ("2020-02-08T08:00:00", "DESCENDING", 9),
+]
+
+
+def _write(path, bands, tags=None):
+    with rasterio.open(
+        path, "w", driver="GTiff", height=HEIGHT, width=WIDTH, count=len(bands),
+        dtype="float32", crs=CRS, transform=TRANSFORM,
+    ) as dst:
+        for i, (name, data) in enumerate(bands.items(), start=1):
+            dst.write(data.astype(np.float32), i)
+            dst.set_band_description(i, name)
+        dst.update_tags(**(tags or {}))
+
+
+@pytest.fixture(scope="module")
+def scene_set(tmp_path_factory):
+    """
+    Paths of the scenes and of the DEM
+    """
+    directory = tmp_path_factory.mktemp("wrapper_local")
+    rng = np.random.default_rng(7)
+    y, x = np.mgrid[:HEIGHT, :WIDTH]
+
+    # hills, with a steep ridge facing east and west for layover and shadow, placed so that the
+    # masked pixels start just east of the chunk boundary at x = 32 (within the 40 m buffer, but
+    # further than the filter halo)
+    dem = 60 * np.sin(x / 9.0) * np.cos(y / 13.0)
+    dem += 150 * np.clip(1 - np.abs(x - 40) / 6.0, 0, None)
+    dem_path = str(directory / "dem.tif")
+    _write(dem_path, {"elevation": dem})
+
+    scene_paths = []
+    base = 0.05 * (1.5 + np.sin(y / 7.0) * np.cos(x / 11.0))
+    for i, (time, orbit_pass, orbit) in enumerate(SCENES):
+        # incidence angle across range (with border noise at both edges), increasing away from
+        # the sensor, which looks west (descending) or east (ascending)
+        across = x if orbit_pass == "ASCENDING" else WIDTH - 1 - x
+        angle = 29.0 + 18.0 * across / (WIDTH - 1) + 0.01 * y
+        vv = base * rng.gamma(sfl.ENL, 1.0 / sfl.ENL, base.shape)
+        vh = 0.2 * base * rng.gamma(sfl.ENL, 1.0 / sfl.ENL, base.shape)
+        if i == 2:
+            # no data in a corner of one scene
+            vv[:12, :20] = np.nan
+            vh[:12, :20] = np.nan
+        path = str(directory / f"s1_{i}.tif")
+        _write(path, {"VV": vv, "VH": vh, "angle": angle}, {
+            "time": time, "platform_number": "A",
+            "orbitProperties_pass": orbit_pass, "relativeOrbitNumber_start": str(orbit),
+        })
+        scene_paths.append(path)
+    return scene_paths, dem_path
+
+
+def _params(scene_set, output, **params):
+    scene_paths, dem_path = scene_set
+    return dict({
+        "INPUT": scene_paths,
+        "DEM": dem_path,
+        "OUTPUT": str(output),
+        "START_DATE": "2020-01-01",
+        "STOP_DATE": "2020-03-01",
+        "ORBIT": "BOTH",
+        "CLIP_TO_ROI": False,
+        "SPECKLE_FILTER_NR_OF_IMAGES": 3,
+        "TERRAIN_FLATTENING_ADDITIONAL_LAYOVER_SHADOW_BUFFER": 40,
+        "WORKERS": 2,
+    }, **params)
+
+
+def _run(scene_set, output, **params):
+    return wrapper_local.s1_preproc(_params(scene_set, output, **params)).load()
+
+
+@pytest.mark.parametrize("framework", ["MONO", "MULTI"])
+@pytest.mark.parametrize("speckle_filter", list(sfl.SPECKLE_FILTERS))
+def test_chunked_matches_single_chunk(scene_set, tmp_path, framework, speckle_filter):
+    params = dict(SPECKLE_FILTER=speckle_filter, SPECKLE_FILTER_FRAMEWORK=framework,
+                  SPECKLE_FILTER_KERNEL_SIZE=5)
+    chunked = _run(scene_set, tmp_path / "chunked.zarr", CHUNK_SIZE=32, **params)
+    single = _run(scene_set, tmp_path / "single.zarr", CHUNK_SIZE=512, **params)
+
+    assert chunked.sizes == {"time": len(SCENES), "y": HEIGHT, "x": WIDTH}
+    for band in ("VV", "VH", "angle"):
+        np.testing.assert_array_equal(chunked[band].values, single[band].values, err_msg=band)
+    # the layover / shadow and border noise masks and the nodata patch leave some pixels masked
+    valid = np.isfinite(chunked["VV"].values)
+    assert 0.2 < valid.mean() < 0.95
+
+
+def test_border_noise_masks_all_bands(scene_set, tmp_path):
+    output = _run(scene_set, tmp_path / "out.zarr", CHUNK_SIZE=32, APPLY_SPECKLE_FILTERING=False,
+                  APPLY_TERRAIN_FLATTENING=False)
+    low, high = wrapper_local.BORDER_NOISE_ANGLES
+    for i, path in enumerate(scene_set[0]):
+        with rasterio.open(path) as src:
+            angle = src.read(3)
+        noise = (angle <= low) | (angle >= high)
+        assert noise.any()
+        # the angle band is masked in the output, as border_noise_correction.f_mask_edges
+        for band in ("VV", "VH", "angle"):
+            assert np.isnan(output[band].values[i][noise]).all()
+        np.testing.assert_allclose(output["angle"].values[i][~noise], angle[~noise])
+
+
+def test_orbit_heading(scene_set):
+    scenes = [wrapper_local.Raster(path) for path in scene_set[0]]
+    descending = wrapper_local._orbit_heading(scenes[0::2])
+    ascending = wrapper_local._orbit_heading(scenes[1::2])
+    # the angle band faces the sensor: east for the descending and west for the ascending scenes
+    assert 80 < descending < 100
+    assert -100 < ascending < -80
+
+
+def test_selection(scene_set, tmp_path):
+    output = _run(scene_set, tmp_path / "out.zarr", ORBIT="DESCENDING", POLARIZATION="VV",
+                  STOP_DATE="2020-02-01", APPLY_SPECKLE_FILTERING=False, APPLY_TERRAIN_FLATTENING=False)
+    assert set(output.data_vars) == {"VV", "angle"}
+    expected = [time for time, orbit_pass, _ in SCENES
+                if orbit_pass == "DESCENDING" and time < "2020-02-01"]
+    np.testing.assert_array_equal(output.time.values, np.array(expected, dtype="datetime64[ns]"))
+
+
+def test_check_params():
+    params = wrapper_local._check_params({"DEM": "dem.tif"})
+    assert params["SPECKLE_FILTER_FRAMEWORK"] == "MULTI"
+    with pytest.raises(ValueError):
+        wrapper_local._check_params({"DEM": "dem.tif", "SPECKLE_FILTER": "MEDIAN"})
+    with pytest.raises(ValueError):
+        wrapper_local._check_params({})